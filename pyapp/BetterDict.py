@@ -1,38 +1,107 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import fcntl
 import glob
 import json
 import os
 import re
 import shutil
+import signal
 import sys
+import tempfile
+import threading
 import time
 import typing
 from base64 import b16encode
-from collections import defaultdict
+from collections import deque
 from struct import unpack
 from subprocess import *
 
 import click
 import meilisearch
-from bs4 import BeautifulSoup
 
 import alfred
 import appledict
+import checkpoint
+import defstore
+import dictdiscovery
+import headwords
+import importstats
+import manifest
 import plist
-from ProgressBar import IndefiniteProgressBar
+import querycache
+import querydaemon
+import reversesearch
+import searchbackend
+import searchserver
+from entryfields import extract_fields
+from extsort import TitleGrouper
+from ProgressBar import available_cpus
 from ProgressBar import run_parallely_with_progress_bar
 from WorkflowGraph import WorkflowGraph
 
 HOME = os.path.expanduser("~")
 SEARCH_IP = os.environ.get("SEARCH_IP", "127.0.0.1")
 SEARCH_PORT = os.environ.get("SEARCH_PORT", "6789")
+# number of threads decompressing sections of Body.data
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+# number of processes importing definitions (0: one per available CPU)
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "0"))
+# number of definitions sent to an import worker at once
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "256"))
+# number of dictionaries imported at once by batch imports (0: one per two
+# CPUs of their budget, see import_dicts)
+IMPORT_JOBS = int(os.environ.get("IMPORT_JOBS", "0"))
+# definitions stored and indexed between two checkpoints of an import,
+# at most that many are imported again when resuming it (see checkpoint.py)
+IMPORT_CHECKPOINT_EVERY = int(os.environ.get("IMPORT_CHECKPOINT_EVERY", "2000"))
+# memory ceiling for the definitions held in memory while importing
+IMPORT_MEMORY_LIMIT_MB = int(os.environ.get("IMPORT_MEMORY_LIMIT_MB", "256"))
+# how definitions are stored, one of defstore.STORES
+DEFINITION_STORE = os.environ.get("DEFINITION_STORE", "pack")
+# search backend of newly imported dictionaries, one of
+# searchbackend.BACKENDS
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "meilisearch")
+# what newly imported dictionaries are searched by, one of
+# searchbackend.INDEX_PROFILES
+INDEX_PROFILE = os.environ.get(
+    "INDEX_PROFILE", searchbackend.DEFAULT_INDEX_PROFILE
+)
+# stop the search server after this many minutes without searches
+# (0: never)
+SEARCH_SERVER_IDLE_MINUTES = float(
+    os.environ.get("SEARCH_SERVER_IDLE_MINUTES", "0")
+)
+# where dictionaries are looked for, recursively
+DICT_ROOTS = [
+    "/System/Library/AssetsV2",
+    "/Library/Dictionaries",
+    f"{HOME}/Library/Dictionaries",
+]
+# dictionaries found in DICT_ROOTS, see dictdiscovery.py
+DISCOVERY_CACHE = "discovery-cache.json"
+# temporary directories (in the dictionary's import dir) where the entries
+# are grouped by word
+GROUPING_DIR_PREFIX = "grouping-"
+# responses of recent queries, kept by the query daemon (see querycache.py)
+QUERY_CACHE = "query-cache.json"
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "2000"))
+QUERY_CACHE_TTL_HOURS = float(os.environ.get("QUERY_CACHE_TTL_HOURS", "168"))
+# run this stage of imports (e.g. group) under cProfile or tracemalloc,
+# see importstats.py
+IMPORT_PROFILE_STAGE = os.environ.get("IMPORT_PROFILE_STAGE")
+IMPORT_TRACEMALLOC_STAGE = os.environ.get("IMPORT_TRACEMALLOC_STAGE")
 WORKFLOW_DIR = alfred.get_workflow_dir()
 WORKFLOW_ID = plist.read(f"{WORKFLOW_DIR}/info.plist")["bundleid"]
 DEFAULT_WORKFLOW_DATA_DIR = alfred.default_workflow_data_dir(WORKFLOW_ID)
+# Unix socket of the query daemon, the same as in search.sh. Not in the
+# workflow data dir: macOS limits socket paths to 104 bytes, and the data
+# dir alone takes about 90 of them.
+QUERY_SOCKET = f"/tmp/{WORKFLOW_ID}-{os.getuid()}.sock"
 
 
-def noop():
+def noop(*args):
     pass
 
 
@@ -40,13 +109,37 @@ def read_int(f: typing.BinaryIO) -> int:
     return unpack("i", f.read(4))[0]
 
 
-def get_word_defs_map(dict_data_path):
-    """returns a dict where key is the word
-    and value is a list of its definitions."""
-    word_to_defs_map = defaultdict(list)
+def get_word_defs_groups(dict_data_path, tmp_dir, timings=None):
+    """returns an EntryTable (or a TitleGrouper) whose groups() are pairs
+    of a word and the list of its definitions.
 
+    if the decompressed dictionary fits in IMPORT_MEMORY_LIMIT_MB, it is
+    held as it is, in an EntryTable. otherwise, definitions are spilled
+    to <tmp_dir> whenever more than IMPORT_MEMORY_LIMIT_MB of them are
+    held in memory.
+
+    the time spent reading (decompressing) the definitions is added to
+    <timings>, if given."""
     dict_body = appledict.DictBody(dict_data_path)
-    for defn in dict_body.definitions():
+    if dict_body.decompressed_size() <= IMPORT_MEMORY_LIMIT_MB << 20:
+        start = time.perf_counter()
+        table = appledict.EntryTable(dict_data_path, workers=PARSE_WORKERS)
+        if timings is not None:
+            timings["definitions_s"] = time.perf_counter() - start
+        return table
+
+    definitions = dict_body.definitions(workers=PARSE_WORKERS)
+    if timings is not None:
+        definitions = importstats.timed_iter(
+            definitions, timings, "definitions_s"
+        )
+    return group_definitions(definitions, tmp_dir)
+
+
+def group_definitions(definitions, tmp_dir) -> TitleGrouper:
+    """see get_word_defs_groups"""
+    grouper = TitleGrouper(tmp_dir, memory_limit=IMPORT_MEMORY_LIMIT_MB << 20)
+    for defn in definitions:
         # Example XML defn opening tag:
         # <d:entry
         #   xmlns:d=".apple.com/DTDs/DictionaryService-1.0.rng"
@@ -57,8 +150,8 @@ def get_word_defs_map(dict_data_path):
         # would be to parse the XML and then get 'd:title' from it,
         # however, that's too slow, so we resort to regex matching.
         word = re.search('d:title="(.*?)"', defn).group(1)
-        word_to_defs_map[word].append(defn)
-    return word_to_defs_map
+        grouper.add(word, defn)
+    return grouper
 
 
 def base16(input_str):
@@ -81,116 +174,274 @@ def filename_defn_pairs(word, defns):
     ]
 
 
-def create_html_file(word, definitions, html_dir):
-    """for <word> and its nth definition,
-    create an HTML file whose name is
-    base16(<word>n).html and content is the definition
+class IndexerGroup:
+    """adds to, and deletes from, several indexers at once"""
 
-    need some sort of 'safe' encoding as words might contain
-    characters that can't be part of a filename. also, we don't
-    want collisions on case-insensitive filesystems.
-    """
-    for filename, definition in filename_defn_pairs(word, definitions):
-        with open(f"{html_dir}/{filename}", "wb") as f:
-            f.write(
-                f"""<!DOCTYPE html>
-        <html lang="en">
-          <head>
-            <meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>
-          </head>
-          <body> {definition} </body>
-        </html>""".encode(
-                    "utf-8"
-                )
-            )
+    def __init__(self, *indexers):
+        self.indexers = indexers
 
+    def add(self, items):
+        for indexer in self.indexers:
+            indexer.add(items)
 
-def create_html_files(word_defs_map_items, html_dir):
-    title = "Creating HTML files..."
-    run_parallely_with_progress_bar(
-        items=word_defs_map_items,
-        func=lambda x: create_html_file(x[0], x[1], html_dir),
-        msgfunc=lambda x: x[0],
-        title=title,
-    )
+    def delete(self, ids):
+        for indexer in self.indexers:
+            indexer.delete(ids)
 
+    def finish(self):
+        for indexer in self.indexers:
+            indexer.finish()
 
-class AccumulatedIndexer:
-    def __init__(self, index):
-        self.items = []
-        self.index = index
+    def checkpoint(self) -> list:
+        return [indexer.checkpoint() for indexer in self.indexers]
 
-    def add(self, items):
-        self.items.extend(items)
+    def resumable(self, states) -> bool:
+        return all(
+            indexer.resumable([state[i] for state in states])
+            for i, indexer in enumerate(self.indexers)
+        )
+
+    def resume(self, states):
+        for i, indexer in enumerate(self.indexers):
+            indexer.resume([state[i] for state in states])
+
+    @property
+    def wait_s(self) -> float:
+        """time spent waiting on search servers"""
+        return sum(getattr(indexer, "wait_s", 0.0) for indexer in self.indexers)
+
+
+def import_word(word, defs, store, previous_hashes):
+    """returns (pages, alfred items, hashes) for the definitions of <word>.
+
+    hashes are the (id, content hash) of all the definitions. definitions
+    whose hash is the same as in <previous_hashes> are left out of pages
+    and alfred items, as they were already imported. pages are the
+    (id, page) pairs that are still to be added to the definitions
+    <store>."""
+    pages, items, hashes = [], [], []
+    for filename, definition in filename_defn_pairs(word, defs):
+        def_id = filename.split(".")[0]
+        digest = manifest.content_hash(definition)
+        hashes.append((def_id, digest))
+        if previous_hashes.get(def_id) == digest:
+            continue
+        page = store.prepare(def_id, definition)
+        if page is not None:
+            pages.append((def_id, page))
+        if word != "":
+            items.append(make_alfred_item(word, filename, definition, store))
+    return pages, items, hashes
+
+
+class ImportAccumulator:
+    """Adds the results of import_word to the definitions store and the
+    index, and at the end, removes definitions that no longer exist and
+    records the content hashes for the next re-import.
+
+    Definitions whose hash is the same as in <unchanged_hashes> are kept
+    from the previous import.
+
+    Every IMPORT_CHECKPOINT_EVERY definitions, what was added so far is
+    made durable, and checkpointed in the <journal>. Given the
+    <checkpoints> of an interrupted import, the store and the indexer
+    resume from the last one, and the definitions they record aren't
+    added again.
+    """
+
+    def __init__(
+        self,
+        store,
+        backend_name,
+        profile_name,
+        indexer,
+        manifest_path,
+        previous_hashes,
+        unchanged_hashes,
+        journal,
+        checkpoints,
+    ):
+        self.store = store
+        self.backend_name = backend_name
+        self.profile_name = profile_name
+        self.indexer = indexer
+        self.manifest_path = manifest_path
+        self.previous_hashes = previous_hashes
+        self.unchanged_hashes = unchanged_hashes
+        self.journal = journal
+        self.checkpoints = checkpoints
+        self.resumed_hashes = resumed_hashes(checkpoints)
+        self.started = False
+        self.hashes = {}
+        # (id, content hash) of the definitions added since the last
+        # checkpoint
+        self.unjournaled = []
+        # seconds spent in the store and the indexer
+        self.timings = {"store_s": 0.0, "index_s": 0.0, "checkpoint_s": 0.0}
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        if self.checkpoints:
+            self.store.resume([c["store"] for c in self.checkpoints])
+            self.indexer.resume([c["indexer"] for c in self.checkpoints])
+        self.journal.start(self.checkpoints)
+
+    def add(self, result):
+        self.start()
+        pages, items, hashes = result
+        start = time.perf_counter()
+        for def_id, page in pages:
+            self.store.add(def_id, page)
+        for def_id, digest in hashes:
+            self.hashes[def_id] = digest
+            if self.resumed_hashes.get(def_id) == digest:
+                # stored and indexed before the interruption
+                continue
+            self.unjournaled.append((def_id, digest))
+            if self.unchanged_hashes.get(def_id) == digest:
+                self.store.keep(def_id)
+        stored = time.perf_counter()
+        self.indexer.add(items)
+        self.timings["store_s"] += stored - start
+        self.timings["index_s"] += time.perf_counter() - stored
+        if len(self.unjournaled) >= IMPORT_CHECKPOINT_EVERY:
+            self.checkpoint()
+
+    def checkpoint(self):
+        start = time.perf_counter()
+        self.journal.append(
+            {
+                "store": self.store.checkpoint(),
+                "indexer": self.indexer.checkpoint(),
+                "hashes": self.unjournaled,
+            }
+        )
+        self.unjournaled = []
+        self.timings["checkpoint_s"] += time.perf_counter() - start
 
     def finish(self):
-        task_info = self.index.add_documents(self.items)
+        self.start()
+        vanished = self.previous_hashes.keys() - self.hashes.keys()
+        start = time.perf_counter()
+        self.store.remove(vanished)
+        self.store.finish()
+        stored = time.perf_counter()
+        self.indexer.delete(vanished)
+        self.indexer.finish()
+        self.timings["store_s"] += stored - start
+        self.timings["index_s"] += time.perf_counter() - stored
+        self.timings["index_server_wait_s"] = getattr(
+            self.indexer, "wait_s", 0.0
+        )
+        manifest.write(
+            self.manifest_path,
+            self.store.name,
+            self.backend_name,
+            self.profile_name,
+            self.hashes,
+        )
+        # removed once the import is registered, see import_dict
+        self.journal.close()
 
-        def status():
-            return self.index.get_task(task_info.task_uid).status
 
-        ipb = IndefiniteProgressBar(title="Waiting for index to be ready...")
-        while (s := status()) != "succeeded":
-            ipb.update(message="")
-            time.sleep(2)
-        ipb.finish()
+def resumed_hashes(checkpoints) -> dict:
+    """{id: content hash} of the definitions recorded in <checkpoints>"""
+    return {
+        def_id: digest
+        for checkpoint in checkpoints
+        for def_id, digest in checkpoint["hashes"]
+    }
 
 
-def build_index(word_defs_map_items, dict_id, db_path, html_dir):
-    index = create_index(dict_id, db_path)
-    title = "Building index for instant search..."
+def import_definitions(word_defs_groups, backend, store, dest_dir, journal):
+    """store, and index into the search <backend>, the headword index and
+    the reverse-search index, the definitions of each word as they stream
+    out of <word_defs_groups>.
 
-    def make_alfred_items(word, defs):
-        return [
-            make_alfred_item(word, filename, definition, html_dir)
-            for filename, definition in filename_defn_pairs(word, defs)
-            if word != ""
-        ]
+    if the dictionary was imported before, only the definitions that
+    changed since are stored and indexed again. if the import was
+    interrupted, it resumes from the last checkpoint in <journal>.
 
-    run_parallely_with_progress_bar(
-        items=word_defs_map_items,
-        func=lambda word_n_defs: make_alfred_items(*word_n_defs),
+    returns where the time went, see run_parallely_with_progress_bar."""
+    title = "Importing definitions..."
+    manifest_path = f"{dest_dir}/manifest.tsv"
+    previous_hashes = manifest.read(
+        manifest_path, store.name, backend.name, backend.profile
+    )
+    indexer = IndexerGroup(
+        backend.indexer(),
+        headwords.HeadwordIndexer(headwords.headword_index_path(dest_dir)),
+        reversesearch.ReverseIndexer(
+            reversesearch.reverse_index_path(dest_dir)
+        ),
+    )
+    checkpoints = journal.checkpoints()
+    if checkpoints and not (
+        store.resumable([c["store"] for c in checkpoints])
+        and indexer.resumable([c["indexer"] for c in checkpoints])
+    ):
+        print(
+            "Unable to resume the interrupted import, starting over",
+            file=sys.stderr,
+        )
+        checkpoints = []
+    # definitions whose page went missing from the store are imported
+    # again rather than kept
+    unchanged_hashes = store.keepable(previous_hashes)
+    # definitions imported before the interruption are skipped like the
+    # unchanged ones
+    skipped_hashes = {**unchanged_hashes, **resumed_hashes(checkpoints)}
+
+    stats = run_parallely_with_progress_bar(
+        items=word_defs_groups.groups(),
+        total=len(word_defs_groups),
+        func=lambda word_n_defs: import_word(
+            *word_n_defs, store, skipped_hashes
+        ),
         msgfunc=lambda word_n_defs: word_n_defs[0],
-        accumulator=AccumulatedIndexer(index),
+        weightfunc=lambda word_n_defs: len(word_n_defs[1]),
+        workers=IMPORT_WORKERS or None,
+        chunk_weight=IMPORT_CHUNK_SIZE,
+        accumulator=ImportAccumulator(
+            store,
+            backend.name,
+            backend.profile,
+            indexer,
+            manifest_path,
+            previous_hashes,
+            unchanged_hashes,
+            journal,
+            checkpoints,
+        ),
         title=title,
     )
+    stats["resumed"] = sum(len(c["hashes"]) for c in checkpoints)
+    return stats
 
 
-def make_alfred_item(word, filename, definition, html_dir):
-    soup = BeautifulSoup(definition, "lxml")
-    fulltext = soup.get_text()
-    snippet = fulltext
-    snippet_div = soup.find(attrs={"d:def": "1"})
-    if snippet_div is not None:
-        snippet = snippet_div.get_text()
-
-    # forms of a word typically include:
-    # plural forms of a noun: (mouse, mice)
-    # intensifiers for odjectives: (good, better, best)
-    # past-tense variations of verbs: (fly, flew, flown)
-    forms = ""
-    forms_div = soup.find(attrs={"class": "infg"})
-    if forms_div is not None:
-        forms = forms_div.get_text()
-
-    html_path = f"{html_dir}/{filename}"
+def make_alfred_item(word, filename, definition, store):
+    fields = extract_fields(definition)
+
+    def_id = filename.split(".")[0]
+    url = store.url(def_id)
     item = {
-        "arg": html_path,
+        "arg": url,
         "title": word,
-        "id": filename.split(".")[0],
-        "forms": forms,
-        "subtitle": forms + snippet,
-        "fulltext": fulltext,
-        "quicklookurl": html_path,
+        "id": def_id,
+        "forms": fields.forms,
+        "subtitle": fields.forms + fields.snippet,
+        "fulltext": fields.fulltext,
+        "quicklookurl": url,
+        # only kept by the reverse-search index
+        "reverse_terms": reversesearch.definition_terms(word, fields),
     }
 
-    ipa_div = soup.find(attrs={"d:prn": "IPA solitary"})
-    if ipa_div is None:
-        ipa_div = soup.find(attrs={"d:prn": "IPA"})
-    if ipa_div is None:
+    if fields.ipa is None:
         return item
 
-    pronunciation = ipa_div.get_text().split(",")[0]
+    pronunciation = fields.ipa.split(",")[0]
 
     item["subtitle"] = "[⌘: 🗣] " + item["subtitle"]
     item["mods"] = {
@@ -204,32 +455,12 @@ def dict_info(dict_path):
     return plist.read(f"{dict_path}/Contents/Info.plist")
 
 
-def all_dict_paths():
-    dict_paths = []
-    dict_globs = [
-        "/System/Library/AssetsV2/**/*.dictionary",
-        "/Library/Dictionaries/**/*.dictionary",
-        f"{HOME}/Library/Dictionaries/**/*.dictionary",
-    ]
-    for dict_glob in dict_globs:
-        dict_paths.extend(glob.glob(dict_glob, recursive=True))
-    return [
-        dict_path
-        for dict_path in dict_paths
-        if any(
-            map(
-                os.path.exists,
-                [
-                    f"{dict_path}/Contents/Resources/Body.data",
-                    # While all dictionaries that come bundled with macOS store Body.data
-                    # in the Contents/Resources folder,
-                    # https://agiletortoise.com/terminology/mac/ stores the Body.data
-                    # directly in the Contents folder.
-                    f"{dict_path}/Contents/Body.data",
-                ],
-            )
-        )
-    ]
+def dictionary_discovery(import_base_dir):
+    return dictdiscovery.DictionaryDiscovery(
+        f"{import_base_dir}/{DISCOVERY_CACHE}",
+        DICT_ROOTS,
+        lambda dict_path: get_dict_name(dict_info(dict_path)),
+    )
 
 
 def get_dict_id(info):
@@ -251,6 +482,10 @@ def get_dict_name(info):
 
 def create_workflow_objects(dict_name, dict_id):
     wf = WorkflowGraph(f"{WORKFLOW_DIR}/info.plist")
+    # they may have been created by an import interrupted before it could
+    # record it in imported.json
+    if wf.hasRouterOutput(wf.getObjWithLabel("router"), dict_id):
+        return
 
     # Functional:
     junction = wf.newJunction()
@@ -262,11 +497,7 @@ def create_workflow_objects(dict_name, dict_id):
     script_filter = wf.newBashScriptFilter(
         note=dict_name,
         title=f"search {dict_name}",
-        script=(
-            "open -g ./AlfredExtraPane.app\n\n"
-            'query="$1"\n\n'
-            f'./search.sh "$query" "{dict_id}"'
-        ),
+        script=('query="$1"\n\n' f'./search.sh "$query" "{dict_id}"'),
     )
     router = wf.getObjWithLabel("router")
     router_output = wf.addOutputToRouter(router, output=dict_id)
@@ -304,7 +535,15 @@ def create_workflow_objects(dict_name, dict_id):
     wf.save()
 
 
-def import_dict(dict_path, import_base_dir):
+def import_dict(
+    dict_path,
+    import_base_dir,
+    backend_name=None,
+    profile_name=None,
+):
+    """<backend_name> and <profile_name> default to those the dictionary
+    was imported with the last time (to SEARCH_BACKEND and INDEX_PROFILE
+    the first time)."""
     info = dict_info(dict_path)
     dict_id = get_dict_id(info)
     dict_name = get_dict_name(info)
@@ -316,117 +555,318 @@ def import_dict(dict_path, import_base_dir):
         data_path = f"{dict_path}/Contents/Body.data"
 
     dest_dir = f"{import_base_dir}/{dict_id}"
-    dest_html_dir = f"{dest_dir}/html"
-    db_path = f"{import_base_dir}/db"
+    os.makedirs(dest_dir, exist_ok=True)
+    # another import of the same dictionary is waited for
+    with locked(f"{dest_dir}/import.lock"):
+        # left behind by an import that was killed
+        for stale_dir in glob.glob(f"{dest_dir}/{GROUPING_DIR_PREFIX}*"):
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        body = os.stat(data_path)
+        previous = querydaemon.dict_details(read_imported(import_base_dir)).get(
+            dict_id
+        )
+        if previous is None:
+            previous_backend_name = previous_profile_name = None
+        else:
+            previous_backend_name = previous.get("backend", "meilisearch")
+            previous_profile_name = previous.get(
+                "profile", searchbackend.DEFAULT_INDEX_PROFILE
+            )
+        backend = search_backend(
+            backend_name or previous_backend_name or SEARCH_BACKEND,
+            dict_id,
+            import_base_dir,
+            profile_name or previous_profile_name or INDEX_PROFILE,
+        )
 
-    if not is_search_server_up():
-        start_search_server(db_path)
+        store = defstore.STORES[DEFINITION_STORE](dest_dir, dict_id)
+        # an interrupted import resumes only if it was importing the same
+        # thing the same way
+        journal = checkpoint.Journal(
+            checkpoint.journal_path(dest_dir),
+            {
+                "version": manifest.VERSION,
+                "dict_path": dict_path,
+                "body": [body.st_size, body.st_mtime_ns],
+                "store": store.name,
+                "backend": backend.name,
+                "profile": backend.profile,
+            },
+        )
+        stats = importstats.ImportStats(
+            dict_id,
+            dict_name,
+            [dest_dir, f"{import_base_dir}/db"],
+            profile_stage=IMPORT_PROFILE_STAGE,
+            tracemalloc_stage=IMPORT_TRACEMALLOC_STAGE,
+            profile_dir=f"{import_base_dir}/profiles/{dict_id}",
+        )
 
-    os.makedirs(dest_html_dir, exist_ok=True)
+        # keeps an idle query daemon from stopping the search server
+        # mid-import
+        with search_server(import_base_dir).in_use():
+            with tempfile.TemporaryDirectory(
+                prefix=GROUPING_DIR_PREFIX, dir=dest_dir
+            ) as tmp_dir:
+                with stats.stage("group") as stage:
+                    timings = {}
+                    word_defs_groups = get_word_defs_groups(
+                        data_path, tmp_dir, timings
+                    )
+                    stage["entries"] = len(word_defs_groups)
+                    stage["breakdown"] = {
+                        key: round(value, 3) for key, value in timings.items()
+                    }
+                with stats.stage(
+                    "import_definitions", entries=len(word_defs_groups)
+                ) as stage:
+                    stage["breakdown"] = import_definitions(
+                        word_defs_groups, backend, store, dest_dir, journal
+                    )
+
+        # concurrent imports take turns, each re-reading what the others wrote
+        with locked(registry_lock_path(import_base_dir)):
+            with stats.stage("register"):
+                imported = read_imported(import_base_dir)
+                # re-importing a dictionary only updates its details
+                if dict_id not in [item["arg"] for item in imported["items"]]:
+                    imported["items"].append(
+                        {"title": dict_name, "arg": dict_id}
+                    )
+                    create_workflow_objects(dict_name, dict_id)
+                # details of each import, not shown in Alfred (backfilled
+                # for the dictionaries imported before they were recorded)
+                imported["dicts"] = querydaemon.dict_details(imported)
+                imported["dicts"][dict_id] = {
+                    "path": dict_path,
+                    "store": store.name,
+                    "backend": backend.name,
+                    "profile": backend.profile,
+                }
+                # with several dictionaries, they can be searched all at once
+                all_dicts = querydaemon.ALL_DICTS
+                if len(imported["dicts"]) > 1 and all_dicts not in [
+                    item["arg"] for item in imported["items"]
+                ]:
+                    name = querydaemon.ALL_DICTS_NAME
+                    imported["items"].insert(
+                        0, {"title": name, "arg": all_dicts}
+                    )
+                    create_workflow_objects(name, all_dicts)
+
+                write_imported(import_base_dir, imported)
+            stats.save(f"{import_base_dir}/{importstats.STATS_FILE}")
+        journal.remove()
+
+        # a dictionary moved to another backend leaves nothing in the old
+        # one, once it is searched in the new one
+        if previous is not None and previous_backend_name != backend.name:
+            drop_index(previous_backend_name, dict_id, import_base_dir)
+
+
+def drop_index(backend_name, dict_id, import_base_dir):
+    """drop the index of <dict_id> in the search backend <backend_name>.
+
+    the manifest is forgotten first if it records an import into that
+    backend, so that a later import into it redoes every definition."""
+    manifest.invalidate(
+        f"{import_base_dir}/{dict_id}/manifest.tsv", backend_name
+    )
+    search_backend(backend_name, dict_id, import_base_dir).drop()
 
-    word_defs_map = get_word_defs_map(data_path)
-    word_defs_map_items = word_defs_map.items()
-    create_html_files(word_defs_map_items, dest_html_dir)
-    build_index(word_defs_map_items, dict_id, db_path, dest_html_dir)
 
-    imported = {"items": []}
-    imported_json_path = f"{import_base_dir}/imported.json"
+@contextlib.contextmanager
+def locked(lock_path):
+    """hold an exclusive lock on <lock_path>, waiting for it if needed.
+
+    unlike flock(), lockf() locks aren't shared with forked processes
+    (such as the import workers): the lock goes away with this process,
+    even if they live on."""
+    with open(lock_path, "w") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        yield
 
-    if os.path.exists(imported_json_path):
-        with open(imported_json_path) as f:
-            imported = json.load(f)
 
-    imported["items"].append({"title": dict_name, "arg": dict_id})
+def registry_lock_path(import_base_dir) -> str:
+    """lock taken to update imported.json, the workflow's info.plist and
+    import-stats.json"""
+    return f"{import_base_dir}/imported.lock"
 
-    create_workflow_objects(dict_name, dict_id)
-    with open(imported_json_path, "w") as f:
+
+def read_imported(import_base_dir) -> dict:
+    imported_json_path = f"{import_base_dir}/imported.json"
+    if not os.path.exists(imported_json_path):
+        return {"items": []}
+    with open(imported_json_path) as f:
+        return json.load(f)
+
+
+def write_imported(import_base_dir, imported):
+    imported_json_path = f"{import_base_dir}/imported.json"
+    tmp_path = f"{imported_json_path}.tmp"
+    with open(tmp_path, "w") as f:
         json.dump(imported, f, indent=2)
+    os.replace(tmp_path, imported_json_path)
 
 
-def is_search_server_up():
-    return call(["pgrep", "alfred-dict-server"], stdout=DEVNULL) == 0
+class ImportJob(typing.NamedTuple):
+    dict_path: str
+    # None: as the dictionary was imported the last time, see import_dict
+    backend_name: typing.Optional[str]
+    profile_name: typing.Optional[str]
 
 
-def start_search_server(db_path):
-    with open(f"{db_path}.log", "wb") as logfile:
-        cmd = [
-            f"{WORKFLOW_DIR}/alfred-dict-server",
-            "--db-path",
-            db_path,
-            "--http-addr",
-            f"{SEARCH_IP}:{SEARCH_PORT}",
-            "--http-payload-size-limit",
-            "1000000000",
-        ]
-        Popen(cmd, stdout=logfile, stderr=logfile)
+def import_dicts(jobs, import_base_dir, workers=None) -> list[ImportJob]:
+    """Import several dictionaries, a few (IMPORT_JOBS) at once, each in
+    a process of its own, sharing a budget of <workers> CPUs (all the
+    available ones by default).
 
+    While one dictionary is being decompressed or grouped, mostly on one
+    CPU, others are being imported on the rest of the budget.
 
-def search_client(db_path):
-    if not is_search_server_up():
-        start_search_server(db_path)
-    while not is_search_server_up():
-        time.sleep(0.1)
-    client = meilisearch.Client(f"http://{SEARCH_IP}:{SEARCH_PORT}")
-    while not client.is_healthy():
+    The split is static: each import gets an equal share of the budget
+    when it starts and keeps that many workers until it ends. CPUs freed
+    by an import that ends go to the imports started after it, not to
+    those already running.
+
+    Returns the jobs that failed.
+    """
+    budget = workers or available_cpus()
+    concurrency = IMPORT_JOBS or max(1, budget // 2)
+    pending = deque(jobs)
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < concurrency:
+            job = pending.popleft()
+            sharing = min(concurrency, len(running) + 1 + len(pending))
+            share = max(1, budget // sharing)
+            running[spawn_import(job, import_base_dir, share)] = job
         time.sleep(0.1)
-    return client
-
-
-def create_index(dict_id, db_path):
-    db = search_client(db_path)
-    task_info = db.create_index(dict_id)
-    db.wait_for_task(task_info.task_uid, timeout_in_ms=10000)
-    index = db.get_index(dict_id)
-    index.update_searchable_attributes(
-        [
-            "title",
-            "forms",
-            "subtitle",
-            "fulltext",
-        ]
-    )
-    index.update_ranking_rules(
-        [
-            "exactness",
-            "attribute",
-            "typo",
-            "words",
-            "proximity",
-        ]
+        for proc in [proc for proc in running if proc.poll() is not None]:
+            job = running.pop(proc)
+            if proc.returncode != 0:
+                failed.append(job)
+    return failed
+
+
+def spawn_import(job, import_base_dir, workers) -> Popen:
+    cmd = [
+        sys.executable,
+        f"{WORKFLOW_DIR}/pyapp/BetterDict.py",
+        "import",
+        job.dict_path,
+        import_base_dir,
+    ]
+    if job.backend_name:
+        cmd += ["--backend", job.backend_name]
+    if job.profile_name:
+        cmd += ["--profile", job.profile_name]
+    env = {
+        **os.environ,
+        "IMPORT_WORKERS": str(workers),
+        "PARSE_WORKERS": str(workers),
+    }
+    return Popen(cmd, env=env)
+
+
+def search_server(import_base_dir) -> searchserver.SearchServer:
+    return searchserver.SearchServer(
+        f"{WORKFLOW_DIR}/alfred-dict-server",
+        f"{import_base_dir}/db",
+        SEARCH_IP,
+        SEARCH_PORT,
+        import_base_dir,
     )
-    index.update_displayed_attributes(
-        [
-            # everything except id, forms, and fulltext
-            "arg",
-            "mods",
-            "title",
-            "subtitle",
-            "quicklookurl",
+
+
+def open_extra_pane():
+    Popen(["open", "-g", f"{WORKFLOW_DIR}/AlfredExtraPane.app"])
+
+
+def extra_pane_reopener(interval=10):
+    """function reopening AlfredExtraPane if it isn't running, to be
+    called on every query. It only looks for it every <interval> seconds
+    at most, in the background."""
+    lock = threading.Lock()
+    last_check = None
+
+    def reopen():
+        if call(["pgrep", "-x", "AlfredExtraPane"], stdout=DEVNULL) != 0:
+            open_extra_pane()
+
+    def on_query():
+        nonlocal last_check
+        with lock:
+            now = time.monotonic()
+            if last_check is not None and now - last_check < interval:
+                return
+            last_check = now
+        threading.Thread(target=reopen, daemon=True).start()
+
+    return on_query
+
+
+def is_defs_server_up():
+    cmd = ["pgrep", "-f", "BetterDict.py serve-definitions"]
+    return call(cmd, stdout=DEVNULL) == 0
+
+
+def start_defs_server(workflow_data_dir):
+    with open(f"{workflow_data_dir}/defs.log", "wb") as logfile:
+        cmd = [
+            sys.executable,
+            f"{WORKFLOW_DIR}/pyapp/BetterDict.py",
+            "serve-definitions",
+            workflow_data_dir,
         ]
+        Popen(cmd, stdout=logfile, stderr=logfile)
+
+
+def search_backend(
+    name, dict_id, import_base_dir, profile=searchbackend.DEFAULT_INDEX_PROFILE
+):
+    if profile not in searchbackend.INDEX_PROFILES:
+        raise ValueError(
+            f"unknown index profile {profile!r}, expected one of "
+            f"{', '.join(searchbackend.INDEX_PROFILES)}"
+        )
+    if name == searchbackend.SqliteBackend.name:
+        return searchbackend.SqliteBackend(
+            f"{import_base_dir}/{dict_id}", profile
+        )
+    if name == searchbackend.MeilisearchBackend.name:
+        return searchbackend.MeilisearchBackend(
+            dict_id, lambda: search_client(import_base_dir), profile
+        )
+    raise ValueError(
+        f"unknown search backend {name!r}, expected one of "
+        f"{', '.join(searchbackend.BACKENDS)}"
     )
-    return index
 
 
-def list_unimported_dicts(import_base_dir) -> list[alfred.Item]:
-    alfreditems = []
+def search_client(import_base_dir):
+    search_server(import_base_dir).start()
+    return meilisearch.Client(f"http://{SEARCH_IP}:{SEARCH_PORT}")
 
-    imported = []
-    imported_json_path = f"{import_base_dir}/imported.json"
 
-    if os.path.exists(imported_json_path):
-        with open(imported_json_path) as f:
-            imported = [i["title"] for i in json.load(f)["items"]]
+def meilisearch_dict_ids(import_base_dir) -> list[str]:
+    dicts = querydaemon.dict_details(read_imported(import_base_dir))
+    return [
+        dict_id
+        for dict_id, details in dicts.items()
+        if details.get("backend", "meilisearch") == "meilisearch"
+    ]
 
-    for dict_path in all_dict_paths():
-        try:
-            info = dict_info(dict_path)
-            dict_name = get_dict_name(info)
-            if dict_name in imported:
-                continue
-            alfreditems.append(alfred.Item(title=dict_name, arg=dict_path))
-        except Exception as e:
-            print(f'Unable to process "{dict_path}": {e}', file=sys.stderr)
-    return alfreditems
+
+def list_unimported_dicts(import_base_dir) -> list[alfred.Item]:
+    imported = [i["title"] for i in read_imported(import_base_dir)["items"]]
+    dicts = dictionary_discovery(import_base_dir).dictionaries()
+    return [
+        alfred.Item(title=dict_name, arg=dict_path)
+        for dict_path, dict_name in dicts.items()
+        if dict_name not in imported
+    ]
 
 
 @click.group()
@@ -457,8 +897,315 @@ def list_unimported(workflow_data_dir: str):
     envvar="alfred_workflow_data",
     default=DEFAULT_WORKFLOW_DATA_DIR,
 )
-def import_(dict_path: str, workflow_data_dir: str):
-    import_dict(dict_path, workflow_data_dir)
+@click.option(
+    "--backend",
+    type=click.Choice(searchbackend.BACKENDS),
+    help="Search backend to index the dictionary into (by default, the "
+    "one it was imported into the last time, or SEARCH_BACKEND).",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(list(searchbackend.INDEX_PROFILES)),
+    help="What the dictionary is searched by: headwords (and their "
+    "inflected forms), the snippets of their definitions too, or the "
+    "full text of the definitions. By default, the profile it was "
+    "imported with the last time, or INDEX_PROFILE.",
+)
+def import_(dict_path: str, workflow_data_dir: str, backend: str, profile: str):
+    import_dict(dict_path, workflow_data_dir, backend, profile)
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+@click.option(
+    "--workers",
+    default=0,
+    help="CPUs shared by the imports (0: all the available ones).",
+)
+def reimport(workflow_data_dir: str, workers: int):
+    """re-import all imported dictionaries, redoing only what changed"""
+    jobs = []
+    imported = read_imported(workflow_data_dir)
+    names = {item["arg"]: item["title"] for item in imported["items"]}
+    discovered = None
+    for dict_id, details in querydaemon.dict_details(imported).items():
+        path = details.get("path")
+        if path is None:
+            # imported before paths were recorded: found by name, as by
+            # list_unimported_dicts
+            if discovered is None:
+                dicts = dictionary_discovery(workflow_data_dir).dictionaries()
+                discovered = {name: path for path, name in dicts.items()}
+            path = discovered.get(names[dict_id])
+        if path is not None and os.path.exists(path):
+            jobs.append(
+                ImportJob(
+                    path,
+                    details.get("backend", "meilisearch"),
+                    details.get("profile", searchbackend.DEFAULT_INDEX_PROFILE),
+                )
+            )
+        else:
+            print(
+                f'"{path or names[dict_id]}" no longer exists', file=sys.stderr
+            )
+    exit_if_failed(import_dicts(jobs, workflow_data_dir, workers))
+
+
+@main.command()
+@click.argument(
+    "dict_paths",
+    nargs=-1,
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+)
+@click.option(
+    "--all-unimported",
+    is_flag=True,
+    help="Import all the dictionaries not imported yet too.",
+)
+@click.option(
+    "--workflow-data-dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+@click.option(
+    "--backend",
+    type=click.Choice(searchbackend.BACKENDS),
+    help="Search backend to index the dictionaries into (see import).",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(list(searchbackend.INDEX_PROFILES)),
+    help="What the dictionaries are searched by, see import.",
+)
+@click.option(
+    "--workers",
+    default=0,
+    help="CPUs shared by the imports (0: all the available ones).",
+)
+def import_batch(
+    dict_paths: list[str],
+    all_unimported: bool,
+    workflow_data_dir: str,
+    backend: str,
+    profile: str,
+    workers: int,
+):
+    """import several dictionaries at once (see import_dicts)"""
+    dict_paths = list(dict_paths)
+    if all_unimported:
+        dict_paths += [
+            item.arg for item in list_unimported_dicts(workflow_data_dir)
+        ]
+    # each dictionary once, in the given order
+    jobs = [
+        ImportJob(dict_path, backend, profile)
+        for dict_path in dict.fromkeys(dict_paths)
+    ]
+    exit_if_failed(import_dicts(jobs, workflow_data_dir, workers))
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+@click.option(
+    "--workers",
+    default=0,
+    help="CPUs shared by the imports (0: all the available ones).",
+)
+def resume(workflow_data_dir: str, workers: int):
+    """resume the imports that were interrupted, from their last checkpoint"""
+    jobs = []
+    for path in sorted(
+        glob.glob(checkpoint.journal_path(f"{workflow_data_dir}/*"))
+    ):
+        header = checkpoint.read_header(path)
+        if header is None:
+            continue
+        if os.path.exists(header["dict_path"]):
+            jobs.append(
+                ImportJob(
+                    header["dict_path"], header["backend"], header["profile"]
+                )
+            )
+        else:
+            print(f'"{header["dict_path"]}" no longer exists', file=sys.stderr)
+    if not jobs:
+        print("No interrupted import to resume", file=sys.stderr)
+    exit_if_failed(import_dicts(jobs, workflow_data_dir, workers))
+
+
+def exit_if_failed(failed_jobs: list[ImportJob]):
+    if failed_jobs:
+        paths = "\n".join(job.dict_path for job in failed_jobs)
+        raise click.ClickException(f"Failed to import:\n{paths}")
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+def serve_definitions(workflow_data_dir: str):
+    """serve the definitions of dictionaries imported into packs"""
+    defstore.serve(workflow_data_dir)
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+def serve_queries(workflow_data_dir: str):
+    """answer the script filters over a Unix socket (see search.sh)"""
+    server = search_server(workflow_data_dir)
+
+    def ensure_search_server():
+        # warm up the indexes, so that the first searches after a restart
+        # of the server aren't the slow ones
+        server.start_in_background(
+            on_ready=lambda: server.warm_up(
+                meilisearch_dict_ids(workflow_data_dir)
+            )
+        )
+
+    if meilisearch_dict_ids(workflow_data_dir):
+        ensure_search_server()
+    if not is_defs_server_up():
+        start_defs_server(workflow_data_dir)
+
+    on_search = noop
+    if SEARCH_SERVER_IDLE_MINUTES > 0:
+        idle_shutdown = searchserver.IdleShutdown(
+            server, SEARCH_SERVER_IDLE_MINUTES * 60
+        )
+        idle_shutdown.start()
+
+        def on_search(backend_name):
+            if backend_name == searchbackend.MeilisearchBackend.name:
+                idle_shutdown.touch()
+
+    searchers = {
+        searchbackend.MeilisearchBackend.name: (
+            searchbackend.MeilisearchSearcher(SEARCH_IP, SEARCH_PORT)
+        ),
+        searchbackend.SqliteBackend.name: (
+            searchbackend.SqliteSearcher(workflow_data_dir)
+        ),
+    }
+    cache = query_cache(workflow_data_dir)
+    cache.autosave()
+    daemon = querydaemon.QueryDaemon(
+        QUERY_SOCKET,
+        workflow_data_dir,
+        searchers,
+        on_query=extra_pane_reopener(),
+        on_search=on_search,
+        on_unreachable=ensure_search_server,
+        cache=cache,
+    )
+    # pkill (see setup.sh) shouldn't lose the latest cache entries
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    finally:
+        cache.save()
+
+
+def query_cache(workflow_data_dir) -> querycache.QueryCache:
+    return querycache.QueryCache(
+        f"{workflow_data_dir}/{QUERY_CACHE}",
+        workflow_data_dir,
+        max_entries=QUERY_CACHE_SIZE,
+        ttl_s=QUERY_CACHE_TTL_HOURS * 3600,
+    )
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+def query_cache_stats(workflow_data_dir: str):
+    """print the size and hit rate of the query cache, as last saved by
+    the query daemon"""
+    print(json.dumps(query_cache(workflow_data_dir).stats(), indent=2))
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+@click.option("--dict-id", help="Only this dictionary.")
+@click.option("--json", "as_json", is_flag=True, help="Print the raw report.")
+def stats(workflow_data_dir: str, dict_id: str, as_json: bool):
+    """print where the time went in the latest import of each dictionary"""
+    reports = importstats.load(f"{workflow_data_dir}/{importstats.STATS_FILE}")
+    if dict_id is not None:
+        reports = {dict_id: reports[dict_id]} if dict_id in reports else {}
+    if as_json:
+        print(json.dumps(reports, indent=2))
+        return
+    print("\n\n".join(map(importstats.format_report, reports.values())))
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+def start_server(workflow_data_dir: str):
+    """start the search server, and wait until it is ready"""
+    server = search_server(workflow_data_dir)
+    started = server.start()
+    server.warm_up(meilisearch_dict_ids(workflow_data_dir))
+    print("started" if started else "already running")
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+def stop_server(workflow_data_dir: str):
+    """stop the search server"""
+    stopped = search_server(workflow_data_dir).stop()
+    print("stopped" if stopped else "not running")
+
+
+@main.command()
+@click.argument(
+    "workflow_data_dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    default=DEFAULT_WORKFLOW_DATA_DIR,
+)
+def server_status(workflow_data_dir: str):
+    """print the state of the search server as JSON"""
+    print(json.dumps(search_server(workflow_data_dir).status(), indent=2))
 
 
 @main.command()
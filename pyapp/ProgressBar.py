@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import json
+import os
+import queue
+import sys
 import time
+import traceback
+import typing
 from subprocess import Popen, PIPE
 
 from multiprocess import Process, Queue
@@ -9,65 +16,167 @@ import alfred
 
 WORKFLOW_DIR = alfred.get_workflow_dir()
 CD_PATH = f"{WORKFLOW_DIR}/cocoaDialog.app/Contents/MacOS/cocoaDialog"
+# total weight of the items sent to a worker at once, see
+# run_parallely_with_progress_bar
+CHUNK_WEIGHT = 256
+# where progress is shown, one of SINKS, or "auto": cocoaDialog on macOS,
+# the terminal if stderr is one, JSON lines (on stderr) otherwise
+PROGRESS_SINK = os.environ.get("PROGRESS_SINK", "auto")
+# most updates shown per second, the others are dropped
+PROGRESS_UPDATES_PER_S = float(os.environ.get("PROGRESS_UPDATES_PER_S", "4"))
+# the ETA is based on the progress made in this many last seconds
+ETA_WINDOW_S = 30
+# seconds between checks that no process of run_parallely_with_progress_bar
+# died (or, in a worker, that the parent didn't), while waiting on a queue
+LIVENESS_CHECK_S = 0.5
+
+
+class CocoaDialogSink:
+    def __init__(self, title: str, message: str, indeterminate: bool):
+        cmd = [CD_PATH, "progressbar", "--title", title, "--text", message]
+        cmd += ["--indeterminate"] if indeterminate else ["--percent", "0"]
+        self.proc = Popen(cmd, stdin=PIPE, encoding="utf-8")
+
+    def show(self, percent: typing.Optional[float], text: str):
+        self.proc.stdin.write(f"{int(percent or 0)} {text}\n")
+        self.proc.stdin.flush()
+
+    def close(self):
+        self.proc.kill()
+
+
+class TerminalSink:
+    def __init__(self, title: str, message: str, indeterminate: bool):
+        self.title = title
+        self.width = 0
+
+    def show(self, percent: typing.Optional[float], text: str):
+        line = f"{self.title} {text}"
+        if percent is not None:
+            line = f"{self.title} {percent:5.1f}% {text}"
+        # overwrite the previous line
+        sys.stderr.write(f"\r{line:<{self.width}}")
+        sys.stderr.flush()
+        self.width = len(line)
+
+    def close(self):
+        sys.stderr.write("\n")
+        sys.stderr.flush()
+
+
+class JsonLinesSink:
+    """one JSON object per update, on stderr, for headless runs"""
+
+    def __init__(self, title: str, message: str, indeterminate: bool):
+        self.title = title
+
+    def show(self, percent: typing.Optional[float], text: str):
+        line = {"title": self.title, "percent": percent, "text": text}
+        sys.stderr.write(json.dumps(line) + "\n")
+        sys.stderr.flush()
+
+    def close(self):
+        self.show(None, "done")
+
+
+class NoOpSink:
+    def __init__(self, title: str, message: str, indeterminate: bool):
+        pass
+
+    def show(self, percent: typing.Optional[float], text: str):
+        pass
+
+    def close(self):
+        pass
+
+
+SINKS = {
+    "cocoadialog": CocoaDialogSink,
+    "terminal": TerminalSink,
+    "jsonl": JsonLinesSink,
+    "none": NoOpSink,
+}
+
+
+def make_sink(title: str, message: str, indeterminate: bool):
+    name = PROGRESS_SINK
+    if name == "auto":
+        if sys.platform == "darwin":
+            name = "cocoadialog"
+        elif sys.stderr.isatty():
+            name = "terminal"
+        else:
+            name = "jsonl"
+    return SINKS[name](title, message, indeterminate)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
 
 
 class ProgressBar:
+    """Shows the progress of a task on one of the SINKS, along with an ETA
+    based on the average progress rate of the last ETA_WINDOW_S seconds.
 
-    def __init__(self, title="Progress", message="", percent=0.01):
-        cmd = [
-            CD_PATH,
-            "progressbar",
-            "--title",
-            title,
-            "--text",
-            message,
-            "--percent",
-            str(percent),
-        ]
-        self.proc = Popen(cmd, stdin=PIPE, encoding="utf-8")
-        self.message = message
-        self.start_time = time.time()
+    Updates can be made as often as wanted: at most
+    PROGRESS_UPDATES_PER_S of them are shown, the others only cost a
+    clock read.
+    """
+
+    def __init__(self, title="Progress", message=""):
+        self.sink = make_sink(title, message, indeterminate=False)
+        self.shown_at = None
+        # (time, percent) of the updates shown within the ETA window
+        self.samples = collections.deque([(time.monotonic(), 0.0)])
 
     def update(self, percent, message):
-        elapsed_seconds = time.time() - self.start_time
-        estimated_total_seconds = elapsed_seconds * 100 / percent
-        estimated_remaining_seconds = estimated_total_seconds - elapsed_seconds
-        rs = int(estimated_remaining_seconds) % 60
-        rm = int(estimated_remaining_seconds) // 60
-        eta_n_message = f"[ETA {rm:02d}:{rs:02d}] {message}"
-        self.proc.stdin.write(f"{int(percent)} {eta_n_message}\n")
-        self.proc.stdin.flush()
+        now = time.monotonic()
+        if (
+            self.shown_at is not None
+            and now - self.shown_at < 1 / PROGRESS_UPDATES_PER_S
+            and percent < 100
+        ):
+            return
+        self.shown_at = now
+        self.samples.append((now, percent))
+        while len(self.samples) > 2 and now - self.samples[0][0] > ETA_WINDOW_S:
+            self.samples.popleft()
+        self.sink.show(percent, f"[ETA {self.eta(now)}] {message}")
+
+    def eta(self, now: float) -> str:
+        (start, start_percent), (_, percent) = self.samples[0], self.samples[-1]
+        if percent <= start_percent or now <= start:
+            return "--:--"
+        rate = (percent - start_percent) / (now - start)
+        return format_duration((100 - percent) / rate)
 
     def finish(self):
-        self.proc.kill()
+        self.sink.close()
 
 
 class IndefiniteProgressBar:
+    """Like ProgressBar, for tasks whose progress is unknown: shows the
+    time elapsed instead."""
 
     def __init__(self, title="Progress", message=""):
-        cmd = [
-            CD_PATH,
-            "progressbar",
-            "--title",
-            title,
-            "--text",
-            message,
-            "--indeterminate",
-        ]
-        self.proc = Popen(cmd, stdin=PIPE, encoding="utf-8")
-        self.message = message
-        self.start_time = time.time()
+        self.sink = make_sink(title, message, indeterminate=True)
+        self.start_time = time.monotonic()
+        self.shown_at = None
 
     def update(self, message):
-        elapsed_seconds = time.time() - self.start_time
-        es = int(elapsed_seconds) % 60
-        em = int(elapsed_seconds) // 60
-        time_n_message = f"[Elapsed {em:02d}:{es:02d}] {message}"
-        self.proc.stdin.write(f"0 {time_n_message}\n")
-        self.proc.stdin.flush()
+        now = time.monotonic()
+        if (
+            self.shown_at is not None
+            and now - self.shown_at < 1 / PROGRESS_UPDATES_PER_S
+        ):
+            return
+        self.shown_at = now
+        elapsed = format_duration(now - self.start_time)
+        self.sink.show(None, f"[Elapsed {elapsed}] {message}")
 
     def finish(self):
-        self.proc.kill()
+        self.sink.close()
 
 
 class NoOpAcc:
@@ -78,41 +187,252 @@ class NoOpAcc:
         pass
 
 
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on macOS
+        return os.cpu_count() or 1
+
+
+def chunked(items, chunk_weight, weightfunc):
+    """lists of consecutive <items>, each weighing (see weightfunc) at
+    least <chunk_weight>, except for the last one"""
+    chunk, weight = [], 0
+    for item in items:
+        chunk.append(item)
+        weight += weightfunc(item)
+        if weight >= chunk_weight:
+            yield chunk
+            chunk, weight = [], 0
+    if chunk:
+        yield chunk
+
+
+def while_parent_alive(operation, parent_pid: int):
+    """call the queue <operation> (with a timeout) until it succeeds, but
+    exit as soon as the parent process is found dead: nobody is left to
+    take or give what goes through the queue"""
+    while True:
+        if os.getppid() != parent_pid:
+            os._exit(1)
+        try:
+            return operation(timeout=LIVENESS_CHECK_S)
+        except (queue.Empty, queue.Full):
+            pass
+
+
+class Failure(typing.NamedTuple):
+    """sent by a process of run_parallely_with_progress_bar instead of
+    its results, when it raises"""
+
+    process: str
+    traceback: str
+
+
 def run_parallely_with_progress_bar(
-    items, func, msgfunc, accumulator=NoOpAcc(), title=""
-):
-    PROC_COUNT = 5
+    items,
+    func,
+    msgfunc,
+    accumulator=NoOpAcc(),
+    title="",
+    total=None,
+    weightfunc=lambda item: 1,
+    workers=None,
+    chunk_weight=CHUNK_WEIGHT,
+) -> dict:
+    """Apply <func> to <items> on <workers> worker processes (by default,
+    one per available CPU), and feed the results to <accumulator> while
+    showing progress.
 
-    total = len(items)
+    <items> are sent to the workers in chunks weighing <chunk_weight>
+    (see weightfunc), and each chunk's results come back at once, so that
+    the cost of going through the queues is paid per chunk rather than
+    per item.
+
+    <items> can be a generator, in which case it is consumed lazily:
+    the work queue is bounded, so at most a couple of chunks per worker
+    are held in memory at any time. Progress is measured as the sum of
+    <weightfunc> over the processed items, out of <total>
+    (by default, the number of items).
+
+    Returns once all the results have been accumulated, with where the
+    time went (in seconds, summed over the workers where it applies):
+    getting <items>, waiting on the queues, and in the <accumulator>,
+    along with the accumulator's own `timings`, if it has any.
+
+    If <func> or the <accumulator> raises, or a process dies, the other
+    processes are terminated, and a RuntimeError (with the traceback of
+    the failure, if any) is raised. If this process dies, the others exit
+    on their own.
+    """
+    workers = workers or available_cpus()
+
+    if total is None:
+        total = len(items)
+
+    task_queue = Queue(maxsize=2 * workers)
+    done_queue = Queue(maxsize=2 * workers)
+    stats_queue = Queue()
+    parent_pid = os.getpid()
+
+    def get(q):
+        return while_parent_alive(q.get, parent_pid)
+
+    def put(q, message):
+        return while_parent_alive(
+            lambda timeout: q.put(message, timeout=timeout), parent_pid
+        )
 
-    task_queue = Queue()
-    done_queue = Queue()
+    def pb_updater(results_q, stats_q):
+        try:
+            accumulate(results_q, stats_q)
+        except BaseException:
+            put(stats_q, Failure("accumulator", traceback.format_exc()))
+            raise
 
-    def pb_updater(inq, results_q):
+    def accumulate(results_q, stats_q):
         pb = ProgressBar(title)
-        for i in range(total):
-            msg, result = results_q.get()
-            accumulator.add(result)
-            pb.update(percent=((i + 1) * 100) / total, message=msg)
+        done = 0
+        running = workers
+        stats = {"results_wait_s": 0.0, "accumulate_s": 0.0}
+        while running:
+            start = time.perf_counter()
+            message = get(results_q)
+            got = time.perf_counter()
+            stats["results_wait_s"] += got - start
+            if isinstance(message, Failure):
+                # a worker raised, there won't be all the results
+                pb.finish()
+                put(stats_q, message)
+                return
+            if isinstance(message, dict):
+                # the stats of a worker, its last message
+                running -= 1
+                for key, value in message.items():
+                    stats[key] = stats.get(key, 0.0) + value
+                continue
+            msg, weight, results = message
+            for result in results:
+                accumulator.add(result)
+            stats["accumulate_s"] += time.perf_counter() - got
+            done += weight
+            pb.update(percent=(done * 100) / total, message=msg)
         pb.finish()
+        start = time.perf_counter()
         accumulator.finish()
-
-        # tell the workers to stop
-        for i in range(PROC_COUNT):
-            inq.put("STOP")
+        stats["accumulator_finish_s"] = time.perf_counter() - start
+        stats["accumulator_cpu_s"] = time.process_time()
+        put(stats_q, {**stats, **getattr(accumulator, "timings", {})})
 
     def worker(inq, outq):
-        for item in iter(inq.get, "STOP"):
-            result = func(item)
-            outq.put((msgfunc(item), result))
+        try:
+            work(inq, outq)
+        except BaseException:
+            put(outq, Failure("worker", traceback.format_exc()))
+            raise
 
-    for i in range(PROC_COUNT):
-        Process(target=worker, args=(task_queue, done_queue)).start()
+    def work(inq, outq):
+        tasks_wait_s = 0.0
+        results_put_s = 0.0
+        while True:
+            start = time.perf_counter()
+            chunk = get(inq)
+            tasks_wait_s += time.perf_counter() - start
+            if chunk is None:
+                break
+            results = [func(item) for item in chunk]
+            weight = sum(weightfunc(item) for item in chunk)
+            start = time.perf_counter()
+            put(outq, (msgfunc(chunk[-1]), weight, results))
+            results_put_s += time.perf_counter() - start
+        put(
+            outq,
+            {
+                "tasks_wait_s": tasks_wait_s,
+                "results_put_wait_s": results_put_s,
+                "workers_cpu_s": time.process_time(),
+            },
+        )
 
-    updater = Process(target=pb_updater, args=(task_queue, done_queue))
+    processes = [
+        Process(target=worker, args=(task_queue, done_queue), daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    updater = Process(
+        target=pb_updater, args=(done_queue, stats_queue), daemon=True
+    )
     updater.start()
-    for item in items:
-        task_queue.put(item)
+    everyone = [*processes, updater]
+
+    def check_alive():
+        """raise if a process died before doing all its work"""
+        if all(process.exitcode in (None, 0) for process in everyone):
+            return
+        # what failed reaches the stats queue, unless the updater died too
+        try:
+            failure = stats_queue.get(timeout=5)
+        except queue.Empty:
+            failure = None
+        raise_failure(failure)
+
+    def put_task(task):
+        while True:
+            try:
+                return task_queue.put(task, timeout=LIVENESS_CHECK_S)
+            except queue.Full:
+                check_alive()
+
+    def get_stats() -> dict:
+        while True:
+            try:
+                message = stats_queue.get(timeout=LIVENESS_CHECK_S)
+            except queue.Empty:
+                check_alive()
+                continue
+            if isinstance(message, Failure):
+                raise_failure(message)
+            return message
+
+    def raise_failure(failure: typing.Optional[Failure]):
+        if failure is None:
+            exitcodes = [process.exitcode for process in everyone]
+            raise RuntimeError(f"a process died, exit codes: {exitcodes}")
+        raise RuntimeError(f"{failure.process} failed:\n{failure.traceback}")
+
+    stats = {"workers": workers, "chunks": 0}
+    stats.update(items_s=0.0, tasks_put_wait_s=0.0)
+    chunks = chunked(items, chunk_weight, weightfunc)
+    try:
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            got = time.perf_counter()
+            stats["items_s"] += got - start
+            if chunk is None:
+                break
+            put_task(chunk)
+            stats["chunks"] += 1
+            stats["tasks_put_wait_s"] += time.perf_counter() - got
+
+        # no more work: each worker exits after its last chunk
+        for process in processes:
+            put_task(None)
+        stats.update(get_stats())
+    except BaseException:
+        # the tasks nobody will read mustn't keep this process from exiting
+        task_queue.cancel_join_thread()
+        for process in everyone:
+            process.terminate()
+        for process in everyone:
+            process.join()
+        raise
+    for process in processes:
+        process.join()
+    updater.join()
+    return {key: round(value, 3) for key, value in stats.items()}
 
 
 def _run_parallely_with_progress_bar(items, func, msgfunc, title):
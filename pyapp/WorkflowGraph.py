@@ -140,6 +140,12 @@ class WorkflowGraph:
         )
         return output_uuid
 
+    def hasRouterOutput(self, router, output):
+        return any(
+            condition["outputlabel"] == output
+            for condition in router["config"]["conditions"]
+        )
+
     def connect(self, src, dst, mod=0, src_out=None):
         connection = {
             "destinationuid": dst["uid"],
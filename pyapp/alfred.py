@@ -14,14 +14,20 @@ def infer_workflow_dir():
     return candidate
 
 
+def source_workflow_dir():
+    """the workflow directory this code is part of, e.g. a git checkout
+    (which, outside of Alfred, can't be inferred from its name)"""
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
 def get_workflow_dir():
     prefs_dir = os.environ.get("alfred_preferences")
     if prefs_dir is None:
-        return infer_workflow_dir()
+        return infer_workflow_dir() or source_workflow_dir()
 
     workflow_uid = os.environ.get("alfred_workflow_uid")
     if workflow_uid is None:
-        return infer_workflow_dir()
+        return infer_workflow_dir() or source_workflow_dir()
 
     return f"{prefs_dir}/workflows/{workflow_uid}"
 
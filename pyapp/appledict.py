@@ -1,86 +1,207 @@
 # -*- coding: utf-8 -*-
 
-import io
+import array
+import collections
+import mmap
+import os
+import re
 import struct
 import typing
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 
 def read_int(f: typing.BinaryIO) -> int:
     return struct.unpack("i", f.read(4))[0]
 
 
+class SectionHeader(typing.NamedTuple):
+    offset: int  # position of the compressed data in Body.data
+    compressed_size: int
+    decompressed_size: int
+
+
+def decompress(compressed: bytes, header: SectionHeader) -> bytes:
+    return zlib.decompress(compressed)[: header.decompressed_size]
+
+
+def entry_spans(section: bytes) -> typing.Iterable[tuple[int, int]]:
+    """Return (start, size) of each definition in a decompressed section.
+
+    Each decompressed section:
+      1) either contains one single definition,
+      2) or multiple definitions of the format:
+         [defn_size (4 bytes (not including itself)),
+          XML defn  (defn_size bytes)]
+    """
+    opening_tag = b"<d:entry"
+    if section[: len(opening_tag)] == opening_tag:
+        yield 0, len(section)
+    else:
+        section_size = len(section)
+        pos = 0
+        while pos < section_size:
+            (defn_size,) = struct.unpack_from("i", section, pos)
+            yield pos + 4, defn_size
+            pos += 4 + defn_size
+
+
+class RawEntry(typing.NamedTuple):
+    """A definition, as it is in its decompressed section."""
+
+    section_idx: int
+    offset: int  # of the definition in its section
+    data: memoryview  # of the XML definition, without copying it
+    title: bytes  # d:title, still UTF-8 encoded
+    entry_id: bytes  # id, still UTF-8 encoded
+
+    def text(self) -> str:
+        return str(self.data, "utf-8")
+
+
 # original source for parsing the '.dictionary' format:
 # https://gist.github.com/josephg/5e134adf70760ee7e49d
 class DictBody:
     def __init__(self, body_data_filepath: str):
         self.body_data_filepath = body_data_filepath
 
-    def _sections(self) -> typing.Iterable[bytes]:
+    def _section_headers(
+        self, f: typing.BinaryIO
+    ) -> typing.Iterable[SectionHeader]:
+        """Return headers of all the sections of the dict body.
+
+        Only the headers are read, the compressed data of each section
+        is skipped over. `f` can be a file or an mmap of Body.data.
+        """
+        # first 64 bytes of a Body.data file are always all-zeroes,
+        # skip them
+        f.seek(0x40)
+
+        # The next four bytes represent an integer denoting remaining
+        # number of bytes in the Body.data file
+        limit = 0x40 + read_int(f)
+
+        # There seem to be two distinct formats of the header.
+        # One where the body begins at 0x60, and another where
+        # the body begins at 0x44.
+        #
+        # Look at these two examples:
+        # "New Oxford American Dictionary.dictionary" that comes
+        # pre-installed on macOS
+        # ❯ xxd Body.data | head
+        #    ... skipped ...
+        # 00000030: 0000 0000 0000 0000 0000 0000 0000 0000
+        # 00000040: d39b 8001 0000 0000 ffff ffff 2000 0000
+        # 00000050: 0000 0000 fa02 0000 ffff ffff ffff ffff
+        # 00000060: 6880 0000 6480 0000 0959 0400 78da ecbd
+        #
+        # "Littré.dictionary" found at
+        # https://www.competencemac.com/Bureautique-Dictionnaires-en-francais_a1737.html
+        # ❯ xxd Body.data | head
+        #    ... skipped ...
+        # 00000030: 0000 0000 0000 0000 0000 0000 0000 0000
+        # 00000040: 46a2 af02 9103 0000 8d03 0000 3906 0000
+        # 00000050: 789c 6d55 db6e db46 107d 8ebf 62a0 1725
+        # 00000060: a84c d67d 5469 0272 8c02 058a a040 9abc
+        #
+        # Based on the above two examples, and looking at the function
+        # guessFileOffsetLimit the pyglossary project,
+        # (https://github.com/ilius/pyglossary/blob/b41161d3f38a7e6523d315f4b8555083ef196e71/pyglossary/plugins/appledict_bin/appledict_file_tools.py#L58)
+        # looking for 0000 0000 ffff ffff at 0x44 seems to be a
+        # reliable enough (?) way to distinguish between these two
+        if (read_int(f), read_int(f)) == (0, -1):
+            pos = 0x60
+        else:
+            pos = 0x44
+
+        while pos < limit:
+            # Body.data file can contain multiple sections with the format:
+            # [section_size      (4 bytes (not including itself)),
+            #  ???               (4 bytes), (no idea what these are!)
+            #  decompressed_size (4 bytes),
+            #  compressed_data   (section_size-8 bytes)]
+            f.seek(pos)
+            compressed_size = read_int(f) - 8
+            _ = f.read(4)  # no idea about these 4 bytes
+            decompressed_size = read_int(f)
+            offset = pos + 12
+            yield SectionHeader(offset, compressed_size, decompressed_size)
+            pos = offset + compressed_size
+
+    def _sections(
+        self, workers: int = 1, window: typing.Optional[int] = None
+    ) -> typing.Iterable[bytes]:
         """Return decompressed sections of the dict body.
 
         Each decompressed chunk contains multiple definitions.
         Each definition is of the format:
           [defn_size (4 bytes (not including itself)),
            XML defn  (defn_size bytes)]
+
+        See `_decompressed_sections` for `workers` and `window`.
         """
         with open(self.body_data_filepath, "rb") as f:
-            # first 64 bytes of a Body.data file are always all-zeroes,
-            # skip them
-            f.seek(0x40)
-
-            # The next four bytes represent an integer denoting remaining
-            # number of bytes in the Body.data file
-            limit = 0x40 + read_int(f)
-
-            # There seem to be two distinct formats of the header.
-            # One where the body begins at 0x60, and another where
-            # the body begins at 0x44.
-            #
-            # Look at these two examples:
-            # "New Oxford American Dictionary.dictionary" that comes
-            # pre-installed on macOS
-            # ❯ xxd Body.data | head
-            #    ... skipped ...
-            # 00000030: 0000 0000 0000 0000 0000 0000 0000 0000
-            # 00000040: d39b 8001 0000 0000 ffff ffff 2000 0000
-            # 00000050: 0000 0000 fa02 0000 ffff ffff ffff ffff
-            # 00000060: 6880 0000 6480 0000 0959 0400 78da ecbd
-            #
-            # "Littré.dictionary" found at
-            # https://www.competencemac.com/Bureautique-Dictionnaires-en-francais_a1737.html
-            # ❯ xxd Body.data | head
-            #    ... skipped ...
-            # 00000030: 0000 0000 0000 0000 0000 0000 0000 0000
-            # 00000040: 46a2 af02 9103 0000 8d03 0000 3906 0000
-            # 00000050: 789c 6d55 db6e db46 107d 8ebf 62a0 1725
-            # 00000060: a84c d67d 5469 0272 8c02 058a a040 9abc
-            #
-            # Based on the above two examples, and looking at the function
-            # guessFileOffsetLimit the pyglossary project,
-            # (https://github.com/ilius/pyglossary/blob/b41161d3f38a7e6523d315f4b8555083ef196e71/pyglossary/plugins/appledict_bin/appledict_file_tools.py#L58)
-            # looking for 0000 0000 ffff ffff at 0x44 seems to be a
-            # reliable enough (?) way to distinguish between these two
-            if (read_int(f), read_int(f)) == (0, -1):
-                f.seek(0x60)
-            else:
-                f.seek(0x44)
-
-            while f.tell() < limit:
-                # Body.data file can contain multiple sections with the format:
-                # [section_size      (4 bytes (not including itself)),
-                #  ???               (4 bytes), (no idea what these are!)
-                #  decompressed_size (4 bytes),
-                #  compressed_data   (section_size-8 bytes)]
-                compressed_size = read_int(f) - 8
-                _ = f.read(4)  # no idea about these 4 bytes
-                decompressed_size = read_int(f)
-                decompressed = zlib.decompress(f.read(compressed_size))
-                yield decompressed[:decompressed_size]
-
-    def definitions(self) -> typing.Iterable[str]:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                for _, section in self._decompressed_sections(
+                    body, workers, window
+                ):
+                    yield section
+
+    def _decompressed_sections(
+        self,
+        body: mmap.mmap,
+        workers: int = 1,
+        window: typing.Optional[int] = None,
+    ) -> typing.Iterable[tuple[SectionHeader, bytes]]:
+        """Return (header, decompressed section) for each section of `body`.
+
+        With `workers` > 1, section headers are scanned upfront and the
+        sections are decompressed on a thread pool (zlib releases the GIL
+        while decompressing). Sections are still returned in their original
+        order, and at most `window` (by default 4 per worker) of them are
+        decompressed ahead of the consumer, bounding the memory used.
+        """
+
+        def read(header: SectionHeader) -> bytes:
+            end = header.offset + header.compressed_size
+            return decompress(body[header.offset : end], header)
+
+        headers = list(self._section_headers(body))
+        if workers <= 1:
+            for header in headers:
+                yield header, read(header)
+            return
+
+        window = window or 4 * workers
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque()
+            for header in headers:
+                pending.append((header, pool.submit(read, header)))
+                if len(pending) >= window:
+                    header, future = pending.popleft()
+                    yield header, future.result()
+            while pending:
+                header, future = pending.popleft()
+                yield header, future.result()
+
+    def decompressed_size(self) -> int:
+        """Return the size of the dict body once decompressed, as told by
+        the section headers (nothing is decompressed)."""
+        with open(self.body_data_filepath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                return sum(
+                    header.decompressed_size
+                    for header in self._section_headers(body)
+                )
+
+    def definitions(
+        self, workers: int = 1, window: typing.Optional[int] = None
+    ) -> typing.Iterable[str]:
         """Return definitions from the dict in XML format.
 
+        Sections are decompressed in parallel if `workers` > 1,
+        see `_decompressed_sections`.
+
         An example definition (just the opening tag):
          <d:entry
            xmlns:d=".apple.com/DTDs/DictionaryService-1.0.rng"
@@ -88,18 +209,354 @@ class DictBody:
            d:title="apple"
            class="entry">
         """
-        for section in self._sections():
-            # each decompressed chunk:
-            # 1) either contains one single definition,
-            # 2) or multiple definitions of the format:
-            #    [defn_size (4 bytes (not including itself)),
-            #     XML defn  (defn_size bytes)]
-            opening_tag = b"<d:entry"
-            if section[: len(opening_tag)] == opening_tag:
-                yield section.decode("utf-8")
-            else:
-                section_size = len(section)
-                section = io.BytesIO(section)  # convert to typing.BinaryIO
-                while section.tell() < section_size:
-                    defn_size = read_int(section)
-                    yield section.read(defn_size).decode("utf-8")
+        for section in self._sections(workers, window):
+            for start, size in entry_spans(section):
+                yield section[start : start + size].decode("utf-8")
+
+    def raw_entries(
+        self, workers: int = 1, window: typing.Optional[int] = None
+    ) -> typing.Iterable[RawEntry]:
+        """Return the definitions, like `definitions`, but as views over
+        the decompressed sections, with their `d:title` and `id` matched
+        at the bytes level. A definition is only copied and decoded if
+        its `text()` is asked for.
+
+        The views keep the sections they point into alive.
+        """
+        with open(self.body_data_filepath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                sections = self._decompressed_sections(body, workers, window)
+                for section_idx, (_, section) in enumerate(sections):
+                    view = memoryview(section)
+                    for start, size in entry_spans(section):
+                        defn = view[start : start + size]
+                        yield RawEntry(
+                            section_idx,
+                            start,
+                            defn,
+                            _raw_attr(TITLE_RE, defn),
+                            _raw_attr(ENTRY_ID_RE, defn),
+                        )
+
+
+class IndexedDictBody(DictBody):
+    """Random access to the definitions of a dict body.
+
+    Body.data is mmap-ed, and a table of section offsets and of entry
+    offsets within (decompressed) sections is built, so that looking up
+    one entry decompresses only the one section containing it.
+    Recently decompressed sections are kept in a small LRU cache.
+
+    If `index_filepath` is given, the table is persisted there, and
+    reused as long as Body.data doesn't change. When the table has to be
+    built, sections are decompressed on `workers` threads.
+    """
+
+    INDEX_MAGIC = b"BDIX"
+    INDEX_VERSION = 1
+    # magic, version, body size, body mtime, section count, entry count
+    INDEX_HEADER = struct.Struct("<4sHQqII")
+
+    def __init__(
+        self,
+        body_data_filepath: str,
+        index_filepath: typing.Optional[str] = None,
+        cache_size: int = 8,
+        workers: int = 1,
+    ):
+        super().__init__(body_data_filepath)
+        self.index_filepath = index_filepath
+        self.cache_size = cache_size
+        self.workers = workers
+        self._cache = collections.OrderedDict()
+
+        self._file = open(body_data_filepath, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        stat = os.fstat(self._file.fileno())
+        self._body_stamp = (stat.st_size, stat.st_mtime_ns)
+
+        # per section
+        self._section_offsets = array.array("Q")
+        self._compressed_sizes = array.array("I")
+        self._decompressed_sizes = array.array("I")
+        # per entry
+        self._entry_sections = array.array("I")
+        self._entry_starts = array.array("I")
+        self._entry_sizes = array.array("I")
+        self._entry_ids = []
+        self._titles = []
+
+        if not (index_filepath and self._load_index(index_filepath)):
+            self._build_index()
+            if index_filepath:
+                self._save_index(index_filepath)
+
+        self._by_id = {
+            entry_id: i for i, entry_id in enumerate(self._entry_ids)
+        }
+        self._by_title = collections.defaultdict(list)
+        for i, title in enumerate(self._titles):
+            self._by_title[title].append(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._cache.clear()
+        self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self._entry_ids)
+
+    def titles(self) -> typing.Iterable[str]:
+        return self._by_title.keys()
+
+    def get(self, entry_id: str) -> typing.Optional[str]:
+        """Return the definition whose `id` attribute is `entry_id`."""
+        i = self._by_id.get(entry_id)
+        if i is None:
+            return None
+        return self._entry(i)
+
+    def get_by_title(self, word: str) -> list[str]:
+        """Return all the definitions whose `d:title` is `word`."""
+        return [self._entry(i) for i in self._by_title.get(word, [])]
+
+    def _entry(self, i: int) -> str:
+        section = self._section(self._entry_sections[i])
+        start = self._entry_starts[i]
+        return section[start : start + self._entry_sizes[i]].decode("utf-8")
+
+    def _section(self, section_idx: int) -> bytes:
+        if section_idx in self._cache:
+            self._cache.move_to_end(section_idx)
+            return self._cache[section_idx]
+
+        offset = self._section_offsets[section_idx]
+        header = SectionHeader(
+            offset,
+            self._compressed_sizes[section_idx],
+            self._decompressed_sizes[section_idx],
+        )
+        section = decompress(
+            self._mmap[offset : offset + header.compressed_size], header
+        )
+        self._cache[section_idx] = section
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return section
+
+    def _build_index(self):
+        sections = self._decompressed_sections(self._mmap, self.workers)
+        for section_idx, (header, section) in enumerate(sections):
+            self._section_offsets.append(header.offset)
+            self._compressed_sizes.append(header.compressed_size)
+            self._decompressed_sizes.append(header.decompressed_size)
+            view = memoryview(section)
+            for start, size in entry_spans(section):
+                defn = view[start : start + size]
+                self._entry_sections.append(section_idx)
+                self._entry_starts.append(start)
+                self._entry_sizes.append(size)
+                self._entry_ids.append(_attr(ENTRY_ID_RE, defn))
+                self._titles.append(_attr(TITLE_RE, defn))
+
+    def _save_index(self, index_filepath: str):
+        tmp_path = f"{index_filepath}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                self.INDEX_HEADER.pack(
+                    self.INDEX_MAGIC,
+                    self.INDEX_VERSION,
+                    *self._body_stamp,
+                    len(self._section_offsets),
+                    len(self._entry_ids),
+                )
+            )
+            for arr in self._arrays():
+                arr.tofile(f)
+            for strings in (self._entry_ids, self._titles):
+                blob = "\0".join(strings).encode("utf-8")
+                f.write(struct.pack("<Q", len(blob)))
+                f.write(blob)
+        os.replace(tmp_path, index_filepath)
+
+    def _load_index(self, index_filepath: str) -> bool:
+        """Load a persisted index, return False if it is missing or stale."""
+        if not os.path.exists(index_filepath):
+            return False
+        with open(index_filepath, "rb") as f:
+            header = f.read(self.INDEX_HEADER.size)
+            if len(header) != self.INDEX_HEADER.size:
+                return False
+            magic, version, size, mtime, n_sections, n_entries = (
+                self.INDEX_HEADER.unpack(header)
+            )
+            if (magic, version, (size, mtime)) != (
+                self.INDEX_MAGIC,
+                self.INDEX_VERSION,
+                self._body_stamp,
+            ):
+                return False
+            section_arrays, entry_arrays = (
+                self._arrays()[:3],
+                self._arrays()[3:],
+            )
+            for arr in section_arrays:
+                arr.fromfile(f, n_sections)
+            for arr in entry_arrays:
+                arr.fromfile(f, n_entries)
+            (ids_size,) = struct.unpack("<Q", f.read(8))
+            ids = f.read(ids_size).decode("utf-8")
+            (titles_size,) = struct.unpack("<Q", f.read(8))
+            titles = f.read(titles_size).decode("utf-8")
+        self._entry_ids = ids.split("\0") if n_entries else []
+        self._titles = titles.split("\0") if n_entries else []
+        return True
+
+    def _arrays(self) -> list[array.array]:
+        return [
+            self._section_offsets,
+            self._compressed_sizes,
+            self._decompressed_sizes,
+            self._entry_sections,
+            self._entry_starts,
+            self._entry_sizes,
+        ]
+
+
+class EntryTable(DictBody):
+    """The definitions of a dict body, grouped by title, in about as much
+    memory as the decompressed body itself.
+
+    The decompressed sections are kept as they are, and each entry is
+    only a row of four columns: the index of its title, its section, and
+    its start and size within the section. Titles are interned, as UTF-8,
+    in one buffer. Nothing is decoded before `groups()` returns the group
+    it belongs to.
+
+    Same interface as `extsort.TitleGrouper`. Sections are decompressed
+    on `workers` threads, see `_decompressed_sections`.
+    """
+
+    def __init__(self, body_data_filepath: str, workers: int = 1):
+        super().__init__(body_data_filepath)
+        self.sections = []
+        # title i is titles[title_starts[i] : title_starts[i + 1]]
+        self.titles = bytearray()
+        self.title_starts = array.array("I")
+        # per entry
+        self.entry_titles = array.array("I")
+        self.entry_sections = array.array("I")
+        self.entry_starts = array.array("I")
+        self.entry_sizes = array.array("I")
+        self.grouped = False
+        self._build(workers)
+
+    def __len__(self):
+        """Number of definitions."""
+        return len(self.entry_titles)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the sections and the table."""
+        columns = [
+            self.title_starts,
+            self.entry_titles,
+            self.entry_sections,
+            self.entry_starts,
+            self.entry_sizes,
+        ]
+        return (
+            sum(len(section) for section in self.sections)
+            + len(self.titles)
+            + sum(column.itemsize * len(column) for column in columns)
+        )
+
+    def _build(self, workers: int):
+        title_indexes = {}
+        with open(self.body_data_filepath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                sections = self._decompressed_sections(body, workers)
+                for section_idx, (_, section) in enumerate(sections):
+                    self.sections.append(section)
+                    for start, size in entry_spans(section):
+                        match = TITLE_RE.search(section, start, start + size)
+                        title = match.group(1) if match else b""
+                        title_idx = title_indexes.get(title)
+                        if title_idx is None:
+                            title_idx = title_indexes[title] = len(
+                                title_indexes
+                            )
+                            self.title_starts.append(len(self.titles))
+                            self.titles += title
+                        self.entry_titles.append(title_idx)
+                        self.entry_sections.append(section_idx)
+                        self.entry_starts.append(start)
+                        self.entry_sizes.append(size)
+        self.title_starts.append(len(self.titles))
+
+    def _title(self, title_idx: int) -> bytes:
+        start, end = self.title_starts[title_idx : title_idx + 2]
+        return bytes(self.titles[start:end])
+
+    def _definition(self, i: int) -> str:
+        section = self.sections[self.entry_sections[i]]
+        start = self.entry_starts[i]
+        return section[start : start + self.entry_sizes[i]].decode("utf-8")
+
+    def groups(self) -> typing.Iterable[tuple[str, list[str]]]:
+        """Return (title, definitions) pairs, sorted by title, the
+        definitions of a title in the order they are in the body.
+
+        Single pass: the sections are freed once the groups are all
+        returned, so it can be called only once."""
+        if self.grouped:
+            raise RuntimeError("EntryTable.groups() can be called only once")
+        self.grouped = True
+        return self._groups()
+
+    def _groups(self) -> typing.Iterable[tuple[str, list[str]]]:
+        n_titles = len(self.title_starts) - 1
+        # entries, bucketed by title (a counting sort, which keeps the
+        # entries of a title in order)
+        bucket_starts = array.array("I", bytes(4 * (n_titles + 1)))
+        for title_idx in self.entry_titles:
+            bucket_starts[title_idx + 1] += 1
+        for title_idx in range(n_titles):
+            bucket_starts[title_idx + 1] += bucket_starts[title_idx]
+        filled = array.array("I", bucket_starts[:-1])
+        buckets = array.array("I", bytes(4 * len(self)))
+        for i, title_idx in enumerate(self.entry_titles):
+            buckets[filled[title_idx]] = i
+            filled[title_idx] += 1
+        del filled
+
+        # UTF-8 sorts like the code points it encodes, that is, like str
+        titles = sorted((self._title(i), i) for i in range(n_titles))
+        for title, title_idx in titles:
+            start, end = bucket_starts[title_idx : title_idx + 2]
+            yield title.decode("utf-8"), [
+                self._definition(i) for i in buckets[start:end]
+            ]
+        self.sections = []
+
+
+# See the example opening tag in DictBody.definitions
+ENTRY_ID_RE = re.compile(rb'\sid="(.*?)"')
+TITLE_RE = re.compile(rb'd:title="(.*?)"')
+
+
+def _raw_attr(
+    attr_re: re.Pattern, defn: typing.Union[bytes, memoryview]
+) -> bytes:
+    match = attr_re.search(defn)
+    return match.group(1) if match else b""
+
+
+def _attr(attr_re: re.Pattern, defn: typing.Union[bytes, memoryview]) -> str:
+    return _raw_attr(attr_re, defn).decode("utf-8")
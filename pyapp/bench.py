@@ -0,0 +1,1111 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import plistlib
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import click
+import meilisearch
+
+import appledict
+import checkpoint
+import defstore
+import headwords
+import importstats
+import querycache
+import reversesearch
+import searchbackend
+import searchstandin
+import synthdict
+from extsort import TitleGrouper
+from entryfields import extract_fields
+from entryfields import extract_fields_bs4
+
+
+def entries_per_second(func, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+@click.group()
+def main():
+    """Micro-benchmarks of the import pipeline."""
+    pass
+
+
+@main.command()
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--limit", default=5000, help="Number of definitions to use.")
+def extract(body_data_path: str, limit: int):
+    """Compare extract_fields with the BeautifulSoup based extraction.
+
+    Checks that both produce identical fields for each definition, and
+    reports definitions/second for each.
+    """
+    definitions = list(
+        itertools.islice(
+            appledict.DictBody(body_data_path).definitions(), limit
+        )
+    )
+
+    mismatches = 0
+    for definition in definitions:
+        expected = extract_fields_bs4(definition)
+        actual = extract_fields(definition)
+        if actual != expected:
+            mismatches += 1
+            print(f"MISMATCH: {definition[:200]}", file=sys.stderr)
+            print(f"  bs4:  {expected}", file=sys.stderr)
+            print(f"  fast: {actual}", file=sys.stderr)
+
+    before = entries_per_second(extract_fields_bs4, definitions)
+    after = entries_per_second(extract_fields, definitions)
+    print(f"definitions:    {len(definitions)}")
+    print(f"mismatches:     {mismatches}")
+    print(f"bs4 (entries/s):  {before:10.1f}")
+    print(f"fast (entries/s): {after:10.1f}  ({after / before:.1f}x)")
+    if mismatches:
+        sys.exit(1)
+
+
+def title_grouper(body_data_path: str, tmp_dir: str) -> TitleGrouper:
+    """the definitions of Body.data, grouped as by group_definitions,
+    without ever spilling"""
+    grouper = TitleGrouper(tmp_dir, memory_limit=1 << 62)
+    for defn in appledict.DictBody(body_data_path).definitions():
+        grouper.add(re.search('d:title="(.*?)"', defn).group(1), defn)
+    return grouper
+
+
+def held_mb(build) -> tuple[float, float]:
+    """(MB held by what <build>() returns, peak MB while building it and
+    going through its groups), as traced by tracemalloc"""
+    tracemalloc.start()
+    try:
+        grouped = build()
+        held = tracemalloc.get_traced_memory()[0]
+        for _ in grouped.groups():
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return held / 2**20, peak / 2**20
+
+
+@main.command()
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--runs", default=3, help="Best of this many runs is kept.")
+def grouping(body_data_path: str, runs: int):
+    """Compare grouping the definitions by title in an EntryTable with the
+    TitleGrouper of decoded definitions.
+
+    Checks that both produce identical groups, and reports the seconds
+    taken to build and go through the groups, and the memory held once
+    built, next to the size of the decompressed body.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        grouped = {
+            "TitleGrouper": lambda: title_grouper(body_data_path, tmp_dir),
+            "EntryTable": lambda: appledict.EntryTable(body_data_path),
+        }
+        expected, actual = (
+            list(build().groups()) for build in grouped.values()
+        )
+        if expected != actual:
+            print("MISMATCH between the groups", file=sys.stderr)
+            sys.exit(1)
+
+        body_mb = appledict.DictBody(body_data_path).decompressed_size()
+        print(f"definitions:       {sum(len(defs) for _, defs in actual)}")
+        print(f"decompressed (MB): {body_mb / 2**20:8.1f}")
+        print(f"{'':14} {'seconds':>8} {'held MB':>8} {'peak MB':>8}")
+        for name, build in grouped.items():
+            seconds = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                for _ in build().groups():
+                    pass
+                seconds.append(time.perf_counter() - start)
+            held, peak = held_mb(build)
+            print(f"{name:14} {min(seconds):8.3f} {held:8.1f} {peak:8.1f}")
+
+
+def traced_mb(func) -> tuple[float, float]:
+    """(MB still held, peak MB) after calling <func>, as traced by
+    tracemalloc"""
+    tracemalloc.start()
+    try:
+        kept = func()
+        held, peak = tracemalloc.get_traced_memory()
+        del kept
+    finally:
+        tracemalloc.stop()
+    return held / 2**20, peak / 2**20
+
+
+@main.command()
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--runs", default=3, help="Best of this many runs is kept.")
+def entries(body_data_path: str, runs: int):
+    """Compare DictBody.raw_entries with DictBody.definitions, each
+    definition's title matched the way group_definitions does.
+
+    Checks that both produce the same definitions and titles, and reports
+    entries/second, the peak memory while going through the entries, and
+    the memory held when all of them are kept.
+    """
+    body = appledict.DictBody(body_data_path)
+
+    def definitions():
+        for defn in body.definitions():
+            yield re.search('d:title="(.*?)"', defn).group(1), defn
+
+    def raw_entries():
+        for entry in body.raw_entries():
+            yield entry.title, entry
+
+    iterators = {"definitions": definitions, "raw_entries": raw_entries}
+    expected = list(definitions())
+    actual = [(title.decode(), e.text()) for title, e in raw_entries()]
+    if actual != expected:
+        print("MISMATCH between the entries", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"definitions: {len(expected)}")
+    print(f"{'':12} {'entries/s':>10} {'peak MB':>8} {'kept MB':>8}")
+    for name, iterator in iterators.items():
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            for _ in iterator():
+                pass
+            seconds.append(time.perf_counter() - start)
+        _, peak = traced_mb(lambda: sum(1 for _ in iterator()))
+        kept, _ = traced_mb(lambda: list(iterator()))
+        rate = len(expected) / min(seconds)
+        print(f"{name:12} {rate:10.0f} {peak:8.1f} {kept:8.1f}")
+
+
+@main.command()
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--lookups", default=200, help="Headwords looked up.")
+@click.option("--seed", default=0)
+def lookup(body_data_path: str, lookups: int, seed: int):
+    """Compare looking up the definitions of a headword with
+    IndexedDictBody and with DictBody.
+
+    DictBody has to go through all the definitions, IndexedDictBody only
+    decompresses the section holding them, once its table is built (or
+    loaded from where it was persisted). Checks that both find the same
+    definitions for --lookups headwords picked at random, and reports the
+    time to go through the definitions, to build and to load the table,
+    and per lookup.
+    """
+    start = time.perf_counter()
+    expected = collections.defaultdict(list)
+    for defn in appledict.DictBody(body_data_path).definitions():
+        expected[re.search('d:title="(.*?)"', defn).group(1)].append(defn)
+    scan_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_path = f"{tmp_dir}/entries.idx"
+        timings = {}
+        for name in ["build", "load"]:
+            start = time.perf_counter()
+            body = appledict.IndexedDictBody(body_data_path, index_path)
+            timings[name] = time.perf_counter() - start
+            if name == "build":
+                body.close()
+
+        words = random.Random(seed).sample(
+            sorted(expected), min(lookups, len(expected))
+        )
+        with body:
+            start = time.perf_counter()
+            found = {word: body.get_by_title(word) for word in words}
+            lookup_s = (time.perf_counter() - start) / len(words)
+    if any(found[word] != expected[word] for word in words):
+        print("MISMATCH between the definitions", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"definitions: {sum(len(defs) for defs in expected.values())}")
+    print(f"{'DictBody scan':>20}: {scan_s * 1000:10.1f} ms")
+    print(f"{'table build':>20}: {timings['build'] * 1000:10.1f} ms")
+    print(f"{'table load':>20}: {timings['load'] * 1000:10.1f} ms")
+    print(f"{'lookup':>20}: {lookup_s * 1000:10.3f} ms")
+
+
+@main.command(name="query-cache")
+def query_cache():
+    """Check which queries the query daemon's cache answers alike.
+
+    Queries differing only in case or in runs of whitespace share a
+    response, but not queries differing in a trailing space, which
+    Meilisearch answers differently (the last word is no longer matched
+    as a prefix). Exits with 1 if the cache doesn't tell them apart.
+    """
+    same = [("ab", "AB"), ("ab cd", "  ab \t cd"), ("ab ", "ab  ")]
+    different = [("ab", "ab "), ("ab cd", "ab cd ")]
+    checks = {}
+    with tempfile.TemporaryDirectory() as import_base_dir:
+        for expected, pairs in [(True, same), (False, different)]:
+            for cached, query in pairs:
+                cache = querycache.QueryCache(
+                    f"{import_base_dir}/query-cache.json", import_base_dir
+                )
+                cache.put("bench", cached, 9, cached.encode("utf-8"))
+                hit = cache.get("bench", query, 9) is not None
+                shared = "shares" if expected else "doesn't share"
+                checks[f"{query!r} {shared} {cached!r}'s response"] = (
+                    hit == expected
+                )
+
+    for name, ok in checks.items():
+        print(f"{name:>38}: {'ok' if ok else 'FAILED'}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+# what search.sh did for every keystroke before the query daemon
+OLD_SEARCH_SH = """
+pgrep alfred-dict-server > /dev/null
+items=$(curl -s "http://127.0.0.1:6789/indexes/$2/search" \\
+        -H 'Content-Type: application/json' \\
+        --data "{ \\"q\\": \\"$1\\", \\"limit\\": 9 }" \\
+        | ./jq '.hits')
+echo "{ \\"items\\": $items }"
+"""
+
+
+def latencies_ms(cmd, queries, runs, cwd) -> list[float]:
+    latencies = []
+    for _ in range(runs):
+        for query in queries:
+            start = time.perf_counter()
+            subprocess.run(
+                cmd(query), cwd=cwd, stdout=subprocess.DEVNULL, check=True
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+
+def percentile(sorted_values, p) -> float:
+    return sorted_values[
+        min(len(sorted_values) - 1, len(sorted_values) * p // 100)
+    ]
+
+
+@main.command()
+@click.argument("dict_id")
+@click.argument("queries", nargs=-1, required=True)
+@click.option("--runs", default=20, help="Repetitions of each query.")
+@click.option(
+    "--workflow-dir",
+    type=click.Path(exists=True, file_okay=False),
+    default=".",
+    help="Directory containing search.sh, jq, etc.",
+)
+def keystroke(dict_id: str, queries: list[str], runs: int, workflow_dir: str):
+    """End-to-end latency of one script filter run.
+
+    Compares the old curl + jq pipeline with search.sh talking to the
+    query daemon. Both the search server and the query daemon must be
+    running, and alfred_workflow_data and alfred_workflow_bundleid must
+    be set.
+    """
+    paths = {
+        "curl + jq": lambda q: ["bash", "-c", OLD_SEARCH_SH, "-", q, dict_id],
+        "query daemon": lambda q: ["bash", "./search.sh", q, dict_id],
+    }
+    for name, cmd in paths.items():
+        ms = latencies_ms(cmd, queries, runs, workflow_dir)
+        print(
+            f"{name:>14}: median {percentile(ms, 50):6.1f} ms, "
+            f"p90 {percentile(ms, 90):6.1f} ms"
+        )
+
+
+def alfred_items(body_data_path, limit, store):
+    """the alfred items an import would index, for the first <limit>
+    definitions of Body.data"""
+    # needs the workflow's info.plist, unlike the other benchmarks
+    import BetterDict
+
+    word_defs = {}
+    definitions = appledict.DictBody(body_data_path).definitions()
+    for definition in itertools.islice(definitions, limit):
+        word = re.search('d:title="(.*?)"', definition).group(1)
+        word_defs.setdefault(word, []).append(definition)
+    return [
+        BetterDict.make_alfred_item(word, filename, definition, store)
+        for word, defs in word_defs.items()
+        for filename, definition in BetterDict.filename_defn_pairs(word, defs)
+        if word != ""
+    ]
+
+
+@main.command()
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("queries", nargs=-1, required=True)
+@click.option("--limit", default=20000, help="Number of definitions to use.")
+@click.option("--runs", default=20, help="Repetitions of each query.")
+@click.option(
+    "--backend",
+    "backend_names",
+    type=click.Choice(searchbackend.BACKENDS),
+    multiple=True,
+    default=searchbackend.BACKENDS,
+    help="Backends to compare (all by default).",
+)
+@click.option(
+    "--profile",
+    "profile_names",
+    type=click.Choice(list(searchbackend.INDEX_PROFILES)),
+    multiple=True,
+    default=list(searchbackend.INDEX_PROFILES),
+    help="Index profiles to compare (all by default).",
+)
+@click.option(
+    "--workflow-data-dir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    envvar="alfred_workflow_data",
+    help="Where the Meilisearch db is (the search server is started if "
+    "needed).",
+)
+def backends(
+    body_data_path: str,
+    queries: list[str],
+    limit: int,
+    runs: int,
+    backend_names: list[str],
+    profile_names: list[str],
+    workflow_data_dir: str,
+):
+    """Index size, build time and query latency of the search backends,
+    with each index profile.
+
+    Indexes the definitions into a throwaway index of each backend, the
+    same way an import does, then searches for each of QUERIES. Leaner
+    profiles find fewer hits, their average number is reported too. The
+    same goes for the reverse-search index, searched for QUERIES too.
+    """
+    import BetterDict
+
+    dict_id = f"bench-{os.getpid()}"
+    with tempfile.TemporaryDirectory() as import_base_dir:
+        dest_dir = f"{import_base_dir}/{dict_id}"
+        os.makedirs(dest_dir)
+        store = defstore.PackStore(dest_dir, dict_id)
+        items = alfred_items(body_data_path, limit, store)
+        print(f"documents: {len(items)}")
+
+        for name, profile in itertools.product(backend_names, profile_names):
+            if name == searchbackend.MeilisearchBackend.name:
+                if workflow_data_dir is None:
+                    raise click.UsageError(
+                        "--workflow-data-dir is needed for meilisearch"
+                    )
+                client = BetterDict.search_client(workflow_data_dir)
+                backend = BetterDict.search_backend(
+                    name, dict_id, workflow_data_dir, profile
+                )
+                searcher = searchbackend.MeilisearchSearcher(
+                    BetterDict.SEARCH_IP, BetterDict.SEARCH_PORT
+                )
+
+                # growth of the database shared by all the indexes
+                def index_size():
+                    return client.get_all_stats()["databaseSize"]
+
+            else:
+                backend = BetterDict.search_backend(
+                    name, dict_id, import_base_dir, profile
+                )
+                searcher = searchbackend.SqliteSearcher(import_base_dir)
+                path = searchbackend.sqlite_index_path(dest_dir)
+
+                def index_size():
+                    return os.path.getsize(path) if os.path.exists(path) else 0
+
+            print(
+                f"{name:>12} {profile:>8}: "
+                + measure_index(
+                    dict_id,
+                    items,
+                    backend.indexer(),
+                    searcher,
+                    index_size,
+                    queries,
+                    runs,
+                )
+            )
+            backend.drop()
+
+        # reverse searches, whatever the backend and profile
+        path = reversesearch.reverse_index_path(dest_dir)
+        print(
+            f"{'reverse':>21}: "
+            + measure_index(
+                dict_id,
+                items,
+                reversesearch.ReverseIndexer(path),
+                reversesearch.ReverseSearcher(import_base_dir),
+                lambda: os.path.getsize(path) if os.path.exists(path) else 0,
+                queries,
+                runs,
+            )
+        )
+
+
+def check_ranking(name, indexer, searcher, dict_id, items, query, runs):
+    """index <items>, search for <query>, and print whether all the hits
+    are the best matches (those whose title starts with z), with the
+    latency of the search"""
+    indexer.add(items)
+    indexer.finish()
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        hits = searcher.search(dict_id, query, RANKING_LIMIT)
+        latencies.append((time.perf_counter() - start) * 1000)
+    best = sum(hit["title"].startswith("z") for hit in hits)
+    print(
+        f"{name:>10}: {best}/{RANKING_LIMIT} best matches in the top hits,"
+        f" median {percentile(sorted(latencies), 50):6.2f} ms"
+    )
+    return best == RANKING_LIMIT
+
+
+# hits per search, as in querydaemon.py
+RANKING_LIMIT = 9
+
+
+@main.command()
+@click.option(
+    "--entries",
+    default=30000,
+    help="Definitions early in the alphabet mentioning the term.",
+)
+@click.option(
+    "--late",
+    default=20,
+    help="Definitions late in the alphabet about the term.",
+)
+@click.option("--runs", default=20, help="Repetitions of each search.")
+def ranking(entries: int, late: int, runs: int):
+    """Check that full-text matches are ranked among all the matches.
+
+    Indexes <entries> definitions of headwords early in the alphabet,
+    each mentioning a term in passing, and <late> definitions of
+    headwords late in the alphabet, about that term, into the sqlite
+    backend (with the full profile) and the reverse-search index.
+    Searching for the term should return the latter first, however many
+    of the former match too. Exits with 1 if it doesn't.
+    """
+    term = "cobalt"
+    passing = f"{term} " + " ".join(f"filler{i}" for i in range(30))
+    items = [
+        {
+            "id": f"early{i}",
+            "title": f"a{i:06}",
+            "forms": "",
+            "subtitle": "",
+            "fulltext": passing,
+            "reverse_terms": ("", passing),
+        }
+        for i in range(entries)
+    ] + [
+        {
+            "id": f"late{i}",
+            "title": f"z{i:06}",
+            "forms": "",
+            "subtitle": term,
+            "fulltext": "",
+            "reverse_terms": (term, ""),
+        }
+        for i in range(late)
+    ]
+
+    dict_id = "bench"
+    with tempfile.TemporaryDirectory() as import_base_dir:
+        dest_dir = f"{import_base_dir}/{dict_id}"
+        os.makedirs(dest_dir)
+        ok = check_ranking(
+            "sqlite",
+            searchbackend.SqliteBackend(dest_dir, "full").indexer(),
+            searchbackend.SqliteSearcher(import_base_dir),
+            dict_id,
+            items,
+            term,
+            runs,
+        )
+        ok &= check_ranking(
+            "reverse",
+            reversesearch.ReverseIndexer(
+                reversesearch.reverse_index_path(dest_dir)
+            ),
+            reversesearch.ReverseSearcher(import_base_dir),
+            dict_id,
+            items,
+            term,
+            runs,
+        )
+    if not ok:
+        sys.exit(1)
+
+
+def measure_index(
+    dict_id, items, indexer, searcher, index_size, queries, runs
+) -> str:
+    """size and build time of an index of <items>, and latency and mean
+    number of hits of searching it for each of <queries>"""
+    size_before = index_size()
+    start = time.perf_counter()
+    indexer.add(items)
+    indexer.finish()
+    build_s = time.perf_counter() - start
+    size_mb = (index_size() - size_before) / (1 << 20)
+
+    ms = []
+    hits = 0
+    for _ in range(runs):
+        for query in queries:
+            start = time.perf_counter()
+            hits += len(searcher.search(dict_id, query, 9))
+            ms.append((time.perf_counter() - start) * 1000)
+    ms.sort()
+    return (
+        f"index {size_mb:8.1f} MB, "
+        f"build {build_s:7.1f} s, "
+        f"query median {percentile(ms, 50):6.2f} ms, "
+        f"p90 {percentile(ms, 90):6.2f} ms, "
+        f"hits {hits / len(ms):4.1f}"
+    )
+
+
+@main.command(name="make-body")
+@click.argument("body_data_path", type=click.Path(dir_okay=False))
+@click.option("--entries", default=20000, help="Number of definitions.")
+@click.option(
+    "--definition-size",
+    default=1000,
+    help="Average size of a definition, in bytes.",
+)
+@click.option("--entries-per-section", default=100)
+@click.option(
+    "--layout",
+    type=click.Choice(list(synthdict.LAYOUTS)),
+    default="0x60",
+    help="Where the body starts, after the header.",
+)
+@click.option(
+    "--single-entry-every",
+    default=0,
+    help="Make every Nth section hold one unprefixed definition.",
+)
+@click.option("--seed", default=0)
+def make_body(
+    body_data_path: str,
+    entries: int,
+    definition_size: int,
+    entries_per_section: int,
+    layout: str,
+    single_entry_every: int,
+    seed: int,
+):
+    """Write a synthetic Body.data, to benchmark imports with."""
+    sections = synthdict.write_body(
+        body_data_path,
+        synthdict.entries(entries, definition_size, seed),
+        entries_per_section,
+        layout,
+        single_entry_every,
+    )
+    size_mb = os.path.getsize(body_data_path) / (1 << 20)
+    print(f"{entries} definitions, {sections} sections, {size_mb:.1f} MB")
+
+
+# slowdowns of less than this are noise rather than regressions, however
+# large relative to the baseline
+MIN_REGRESSION_S = 0.05
+
+
+@contextlib.contextmanager
+def timed(stages: dict, name: str):
+    start = time.perf_counter()
+    yield
+    stages[name] = time.perf_counter() - start
+
+
+def import_stages(
+    body_data_path, store_name, backends, workers
+) -> tuple[int, dict]:
+    """(number of definitions, {stage: seconds}) of importing Body.data,
+    one stage after the other, in this process"""
+    # needs the workflow's info.plist, unlike the other benchmarks
+    import BetterDict
+
+    dict_id = f"bench-{os.getpid()}"
+    stages = {}
+    with tempfile.TemporaryDirectory() as import_base_dir:
+        dest_dir = f"{import_base_dir}/{dict_id}"
+        os.makedirs(dest_dir)
+        body = appledict.DictBody(body_data_path)
+
+        with timed(stages, "decompress"):
+            sections = list(body._sections(workers))
+        with timed(stages, "split"):
+            definitions = [
+                section[start : start + size].decode("utf-8")
+                for section in sections
+                for start, size in appledict.entry_spans(section)
+            ]
+        del sections
+        with tempfile.TemporaryDirectory(dir=dest_dir) as tmp_dir:
+            with timed(stages, "group"):
+                groups = list(
+                    BetterDict.group_definitions(definitions, tmp_dir).groups()
+                )
+
+        store = defstore.STORES[store_name](dest_dir, dict_id)
+        with timed(stages, "prepare"):
+            results = [
+                BetterDict.import_word(word, defs, store, {})
+                for word, defs in groups
+            ]
+        with timed(stages, "store"):
+            for pages, _, _ in results:
+                for def_id, page in pages:
+                    store.add(def_id, page)
+            store.finish()
+
+        items = [item for _, items, _ in results for item in items]
+        for name, make_backend in backends.items():
+            backend = make_backend(dict_id, import_base_dir)
+            with timed(stages, f"index:{name}"):
+                indexer = backend.indexer()
+                indexer.add(items)
+                indexer.finish()
+            backend.drop()
+        with timed(stages, "headwords"):
+            indexer = headwords.HeadwordIndexer(
+                headwords.headword_index_path(dest_dir)
+            )
+            indexer.add(items)
+            indexer.finish()
+        with timed(stages, "reverse"):
+            indexer = reversesearch.ReverseIndexer(
+                reversesearch.reverse_index_path(dest_dir)
+            )
+            indexer.add(items)
+            indexer.finish()
+    return len(definitions), stages
+
+
+@main.command(name="import-stages")
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--runs", default=3, help="Best of this many runs is kept.")
+@click.option(
+    "--store",
+    "store_name",
+    type=click.Choice(list(defstore.STORES)),
+    default="pack",
+)
+@click.option(
+    "--backend",
+    "backend_names",
+    type=click.Choice(searchbackend.BACKENDS),
+    multiple=True,
+    default=searchbackend.BACKENDS,
+    help="Backends to index into (all by default).",
+)
+@click.option(
+    "--search-url",
+    help="Meilisearch server to index into, instead of an in-process "
+    "stand-in (see searchstandin.py).",
+)
+@click.option(
+    "--workers",
+    default=os.cpu_count() or 1,
+    help="Threads decompressing sections.",
+)
+@click.option(
+    "--baselines",
+    "baselines_path",
+    type=click.Path(dir_okay=False),
+    default="bench-baselines.json",
+    show_default=True,
+)
+@click.option(
+    "--name",
+    help="Name of the baseline to compare with (by default, the file "
+    "name of BODY_DATA_PATH).",
+)
+@click.option("--save-baseline", is_flag=True, help="Save as the baseline.")
+@click.option(
+    "--tolerance",
+    default=0.2,
+    help="Slowdown of a stage, relative to the baseline, reported as a "
+    "regression.",
+)
+def import_stages_(
+    body_data_path: str,
+    runs: int,
+    store_name: str,
+    backend_names: list[str],
+    search_url: str,
+    workers: int,
+    baselines_path: str,
+    name: str,
+    save_baseline: bool,
+    tolerance: float,
+):
+    """Time each stage of importing a Body.data (see make-body).
+
+    Stages run one after the other, in this process, rather than on the
+    worker processes of a real import, so that each is timed on its own:
+    decompressing the sections, splitting them into definitions, grouping
+    definitions by word, preparing pages and alfred items, storing the
+    pages, indexing into each backend, and building the headword and
+    reverse-search indexes.
+
+    Compares the timings with the baseline saved under --name, and exits
+    with 1 if a stage got slower by more than --tolerance.
+    """
+    if (
+        searchbackend.MeilisearchBackend.name in backend_names
+        and not search_url
+    ):
+        ip, port = searchstandin.start_in_background().server_address
+        search_url = f"http://{ip}:{port}"
+
+    backends = {
+        searchbackend.MeilisearchBackend.name: lambda dict_id, _: (
+            searchbackend.MeilisearchBackend(
+                dict_id, lambda: meilisearch.Client(search_url)
+            )
+        ),
+        searchbackend.SqliteBackend.name: lambda dict_id, import_base_dir: (
+            searchbackend.SqliteBackend(f"{import_base_dir}/{dict_id}")
+        ),
+    }
+    backends = {n: backends[n] for n in backend_names}
+
+    best = {}
+    for _ in range(runs):
+        count, stages = import_stages(
+            body_data_path, store_name, backends, workers
+        )
+        for stage, seconds in stages.items():
+            best[stage] = min(seconds, best.get(stage, seconds))
+
+    name = name or os.path.basename(body_data_path)
+    baselines = {}
+    if os.path.exists(baselines_path):
+        with open(baselines_path) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(name, {})
+
+    regressions = []
+    print(f"definitions: {count}")
+    for stage, seconds in best.items():
+        line = f"{stage:>20}: {seconds:8.3f} s {count / seconds:10.0f} /s"
+        if stage in baseline:
+            change = seconds / baseline[stage] - 1
+            line += f"  {change:+7.1%} vs {baseline[stage]:.3f} s"
+            if (
+                change > tolerance
+                and seconds - baseline[stage] > MIN_REGRESSION_S
+            ):
+                regressions.append(stage)
+                line += "  REGRESSION"
+        print(line)
+
+    if save_baseline:
+        baselines[name] = best
+        with open(baselines_path, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"saved as baseline {name!r} in {baselines_path}")
+    elif regressions:
+        sys.exit(1)
+
+
+def dictionary_bundle(body_data_path: str, parent_dir: str) -> str:
+    """path of a dictionary bundle made in <parent_dir> around
+    <body_data_path>"""
+    dict_path = f"{parent_dir}/Bench.dictionary"
+    os.makedirs(f"{dict_path}/Contents")
+    os.symlink(
+        os.path.abspath(body_data_path), f"{dict_path}/Contents/Body.data"
+    )
+    with open(f"{dict_path}/Contents/Info.plist", "wb") as f:
+        plistlib.dump(
+            {"CFBundleIdentifier": "bench.resume", "CFBundleName": "Bench"}, f
+        )
+    return dict_path
+
+
+def import_digests(dest_dir: str) -> dict:
+    """digests of the content hashes and of the pages of an import into
+    <dest_dir>, in an order that doesn't depend on the workers"""
+    with open(f"{dest_dir}/manifest.tsv") as f:
+        f.readline()
+        hashes = "".join(sorted(f)).encode("utf-8")
+    pack = defstore.PackReader(f"{dest_dir}/defs.pack")
+    pages = hashlib.md5()
+    for def_id in sorted(pack.positions):
+        pages.update(def_id.encode("utf-8") + b"\0" + pack.get(def_id))
+    pack.close()
+    return {
+        "manifest": hashlib.md5(hashes).hexdigest(),
+        "pages": pages.hexdigest(),
+    }
+
+
+def checkpoint_count(journal_path: str) -> int:
+    try:
+        with open(journal_path) as f:
+            # past the header
+            return max(0, sum(1 for _ in f) - 1)
+    except OSError:
+        return 0
+
+
+@main.command()
+@click.argument("body_data_path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--checkpoints",
+    default=4,
+    help="Checkpoints after which the import is killed.",
+)
+@click.option("--workers", default=2, help="Import worker processes.")
+@click.option(
+    "--timeout", default=300, help="Seconds an import may take, at most."
+)
+def resume(body_data_path: str, checkpoints: int, workers: int, timeout: int):
+    """Check that a killed import resumes to the same result.
+
+    Imports a dictionary around BODY_DATA_PATH (see make-body) into the
+    sqlite backend twice, with BetterDict.py: once in one go, and once
+    SIGKILL-ing the import process, but not its workers, after
+    --checkpoints checkpoints, then resuming it. Exits with 1 if the
+    resumed import stores or records different definitions than the
+    other, or if resuming times out (say, on a lock the killed import's
+    workers still hold).
+
+    Imports register the dictionary in the workflow's info.plist, which
+    is restored afterwards.
+    """
+    # needs the workflow's info.plist, unlike the other benchmarks
+    import BetterDict
+
+    script = f"{os.path.dirname(os.path.abspath(__file__))}/BetterDict.py"
+    env = {
+        **os.environ,
+        "PROGRESS_SINK": "none",
+        "DEFINITION_STORE": "pack",
+        "IMPORT_WORKERS": str(workers),
+    }
+
+    # each import runs in a process group of its own, so that whatever
+    # it leaves behind is killed once done
+    groups = []
+
+    def start_command(*args) -> subprocess.Popen:
+        process = subprocess.Popen(
+            [sys.executable, script, *args], env=env, start_new_session=True
+        )
+        groups.append(process.pid)
+        return process
+
+    def run_command(*args):
+        if start_command(*args).wait(timeout=timeout) != 0:
+            raise click.ClickException(f"{args[0]} failed")
+
+    info_plist_path = f"{BetterDict.WORKFLOW_DIR}/info.plist"
+    with open(info_plist_path, "rb") as f:
+        info_plist = f.read()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            dict_path = dictionary_bundle(body_data_path, tmp_dir)
+            dict_id = BetterDict.get_dict_id(BetterDict.dict_info(dict_path))
+            clean_dir = f"{tmp_dir}/clean"
+            resumed_dir = f"{tmp_dir}/resumed"
+            for import_base_dir in [clean_dir, resumed_dir]:
+                os.makedirs(import_base_dir)
+            import_args = ["import", dict_path, "--backend", "sqlite"]
+
+            run_command(*import_args, clean_dir)
+
+            journal_path = checkpoint.journal_path(f"{resumed_dir}/{dict_id}")
+            process = start_command(*import_args, resumed_dir)
+            while checkpoint_count(journal_path) < checkpoints:
+                if process.poll() is not None:
+                    raise click.ClickException(
+                        "The import ended before it could be killed, "
+                        "lower --checkpoints"
+                    )
+                time.sleep(0.05)
+            process.kill()
+            process.wait()
+
+            start = time.perf_counter()
+            try:
+                run_command("resume", resumed_dir)
+            except subprocess.TimeoutExpired:
+                print(f"resume: timed out after {timeout} s")
+                sys.exit(1)
+            seconds = time.perf_counter() - start
+
+            report = importstats.load(
+                f"{resumed_dir}/{importstats.STATS_FILE}"
+            )[dict_id]
+            resumed = sum(
+                stage["breakdown"].get("resumed", 0)
+                for stage in report["stages"]
+                if stage["name"] == "import_definitions"
+            )
+            print(f"resume: {seconds:.1f} s, {resumed} definitions resumed")
+
+            expected = import_digests(f"{clean_dir}/{dict_id}")
+            actual = import_digests(f"{resumed_dir}/{dict_id}")
+            for name in expected:
+                same = expected[name] == actual[name]
+                print(f"{name:>10}: {'same' if same else 'DIFFERENT'}")
+            if actual != expected:
+                sys.exit(1)
+        finally:
+            for group in groups:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(group, signal.SIGKILL)
+            with open(info_plist_path, "wb") as f:
+                f.write(info_plist)
+
+
+class StubFetcher:
+    """Fetcher of sayipa.py making up <size> bytes of audio per (IPA
+    text, voice), after <delay_s>, and counting its fetches"""
+
+    def __init__(self, size: int = 1024, delay_s: float = 0.0):
+        self.size = size
+        self.delay_s = delay_s
+        self.fetches = collections.Counter()
+        self.lock = threading.Lock()
+
+    def audio(self, ipa_text: str, voice_id: str) -> bytes:
+        digest = hashlib.sha256(f"{voice_id}\t{ipa_text}".encode("utf-8"))
+        return digest.digest() * (self.size // digest.digest_size)
+
+    def fetch(self, ipa_text: str, voice_id: str) -> bytes:
+        time.sleep(self.delay_s)
+        with self.lock:
+            self.fetches[ipa_text, voice_id] += 1
+        return self.audio(ipa_text, voice_id)
+
+
+# plays a cached MP3 with sayipa.py (argv[1:] being its arguments), any
+# import of boto3 failing
+SAYIPA_WITHOUT_BOTO3 = """
+import runpy, sys
+sys.modules["boto3"] = None
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+@main.command(name="audio-cache")
+@click.option(
+    "--workflow-dir",
+    type=click.Path(exists=True, file_okay=False),
+    default=".",
+    help="Directory containing sayipa.py.",
+)
+def audio_cache(workflow_dir: str):
+    """Check sayipa.py's AudioCache, with a stub fetcher.
+
+    A hit makes no fetch, each voice gets its own entry, concurrent
+    misses for the same audio leave one complete file, the least
+    recently used files are evicted first, and the command line plays a
+    hit without boto3. Exits with 1 if any of these doesn't hold.
+    """
+    sys.path.insert(0, workflow_dir)
+    import sayipa
+
+    script = f"{workflow_dir}/sayipa.py"
+    word, voice = "həˈloʊ", "Salli"
+    checks = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fetcher = StubFetcher()
+        cache_dir = pathlib.Path(tmp_dir, "hits")
+        cache = sayipa.AudioCache(cache_dir, 1 << 20, fetcher)
+        path = cache.get(word, voice)
+        checks["a hit makes no fetch"] = (
+            cache.get(word, voice) == path and fetcher.fetches[word, voice] == 1
+        )
+        checks["each voice gets its own entry"] = (
+            cache.get(word, "Joey") != path
+            and fetcher.fetches[word, "Joey"] == 1
+        )
+
+        def play(*args) -> int:
+            return subprocess.run(
+                [sys.executable, "-c", SAYIPA_WITHOUT_BOTO3, script, *args]
+                + ["--no-play", "--cache-dir", str(cache_dir)]
+            ).returncode
+
+        checks["a hit is played without boto3"] = play(word) == 0
+        checks["a miss is reported by --cached-only"] = (
+            play("wɜːd", "--cached-only") == sayipa.EXIT_NOT_CACHED
+        )
+
+        fetcher = StubFetcher(delay_s=0.05)
+        cache = sayipa.AudioCache(
+            pathlib.Path(tmp_dir, "concurrent"), 1 << 20, fetcher
+        )
+        with concurrent.futures.ThreadPoolExecutor(16) as pool:
+            paths = set(pool.map(lambda _: cache.get(word, voice), range(16)))
+        checks["concurrent misses leave one complete file"] = (
+            paths == {cache.path(word, voice)}
+            and os.listdir(cache.cache_dir) == [cache.path(word, voice).name]
+            and cache.path(word, voice).read_bytes()
+            == fetcher.audio(word, voice)
+        )
+
+        fetcher = StubFetcher()
+        cache = sayipa.AudioCache(
+            pathlib.Path(tmp_dir, "lru"), 3 * fetcher.size, fetcher
+        )
+        for ipa_text in ["a", "b", "c", "a", "d"]:
+            cache.get(ipa_text, voice)
+            # mtimes far enough apart to be ordered
+            time.sleep(0.01)
+        kept = {path.name for path in cache.cache_dir.iterdir()}
+        checks["the least recently used file is evicted"] = kept == {
+            cache.path(ipa_text, voice).name for ipa_text in ["a", "c", "d"]
+        }
+
+    for name, ok in checks.items():
+        print(f"{name:>42}: {'ok' if ok else 'FAILED'}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import typing
+
+
+def journal_path(dest_dir: str) -> str:
+    return f"{dest_dir}/checkpoints.jsonl"
+
+
+def read_header(path: str) -> typing.Optional[dict]:
+    """header of the journal at <path>, if there is one"""
+    try:
+        with open(path) as f:
+            return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def sync(f: typing.IO):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class Journal:
+    """Durable progress of an import, for an interrupted one to resume
+    from: a JSON line per checkpoint, at <path>.
+
+    The first line is the <header> of the import (what is imported, and
+    how). The checkpoints of an import with a different header are
+    ignored. Each checkpoint is appended (and fsync-ed) once what it
+    records is durable: the content hashes of the definitions added since
+    the previous checkpoint, and what the definitions store and the
+    indexers need to resume from there. A checkpoint cut short by an
+    interruption is ignored.
+
+    The journal is only opened on start(), as it is handed over to the
+    process that accumulates the import results.
+    """
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.header = header
+        self.f = None
+
+    def checkpoints(self) -> list[dict]:
+        """checkpoints of an interrupted run of the same import"""
+        if read_header(self.path) != self.header:
+            return []
+        checkpoints = []
+        with open(self.path) as f:
+            f.readline()
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                checkpoints.append(json.loads(line))
+        return checkpoints
+
+    def start(self, checkpoints: list[dict]):
+        """start the journal over, from <checkpoints>"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for record in [self.header, *checkpoints]:
+                f.write(json.dumps(record) + "\n")
+            sync(f)
+        os.replace(tmp_path, self.path)
+        self.f = open(self.path, "a")
+
+    def append(self, checkpoint: dict):
+        self.f.write(json.dumps(checkpoint) + "\n")
+        sync(self.f)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        """the import is complete, there's nothing left to resume"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
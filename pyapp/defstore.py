@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+import array
+import collections
+import os
+import struct
+import threading
+import typing
+import zlib
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+DEFS_IP = os.environ.get("DEFS_IP", "127.0.0.1")
+DEFS_PORT = os.environ.get("DEFS_PORT", "6790")
+
+
+def html_page(definition: str) -> bytes:
+    return f"""<!DOCTYPE html>
+        <html lang="en">
+          <head>
+            <meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>
+          </head>
+          <body> {definition} </body>
+        </html>""".encode("utf-8")
+
+
+class HtmlFileStore:
+    """One HTML file per definition, in <dest_dir>/html.
+
+    The files are written by the worker processes themselves.
+    """
+
+    name = "html"
+
+    def __init__(self, dest_dir: str, dict_id: str):
+        self.html_dir = f"{dest_dir}/html"
+        os.makedirs(self.html_dir, exist_ok=True)
+
+    def url(self, def_id: str) -> str:
+        return f"{self.html_dir}/{def_id}.html"
+
+    def prepare(self, def_id: str, definition: str) -> typing.Optional[bytes]:
+        with open(self.url(def_id), "wb") as f:
+            f.write(html_page(definition))
+        return None
+
+    def add(self, def_id: str, page: bytes):
+        pass
+
+    def keepable(self, hashes: dict[str, str]) -> dict[str, str]:
+        """the <hashes> of the definitions whose page from the previous
+        import is still there to be kept"""
+        present = {name[: -len(".html")] for name in os.listdir(self.html_dir)}
+        return {k: v for k, v in hashes.items() if k in present}
+
+    def keep(self, def_id: str):
+        """keep the page of <def_id> from the previous import"""
+        pass
+
+    def remove(self, def_ids: typing.Iterable[str]):
+        for def_id in def_ids:
+            if os.path.exists(self.url(def_id)):
+                os.remove(self.url(def_id))
+
+    def checkpoint(self):
+        """make the pages added so far durable, and return what's needed
+        to resume from there (see checkpoint.py)"""
+        # the pages are already in their files
+        return None
+
+    def resumable(self, states: list) -> bool:
+        return True
+
+    def resume(self, states: list):
+        pass
+
+    def finish(self):
+        pass
+
+
+class PackStore:
+    """All the definitions of a dictionary in one compressed pack file.
+
+    Worker processes only render the pages, which are then `add`-ed, in a
+    single process, to <dest_dir>/defs.pack. The pages are served by
+    `serve` (see the `serve-definitions` command), so the url of a
+    definition is an http url.
+    """
+
+    name = "pack"
+
+    def __init__(self, dest_dir: str, dict_id: str):
+        self.pack_path = f"{dest_dir}/defs.pack"
+        self.dict_id = dict_id
+        self.writer = None
+        self.previous = None
+
+    def url(self, def_id: str) -> str:
+        return f"http://{DEFS_IP}:{DEFS_PORT}/{self.dict_id}/{def_id}.html"
+
+    def prepare(self, def_id: str, definition: str) -> typing.Optional[bytes]:
+        return html_page(definition)
+
+    def add(self, def_id: str, page: bytes):
+        if self.writer is None:
+            self.writer = PackWriter(self.pack_path)
+        self.writer.add(def_id, page)
+
+    def keepable(self, hashes: dict[str, str]) -> dict[str, str]:
+        """the <hashes> of the definitions in the pack of the previous
+        import"""
+        if not os.path.exists(self.pack_path):
+            return {}
+        # not kept open: the store is sent to the worker processes
+        previous = PackReader(self.pack_path)
+        previous.close()
+        return {k: v for k, v in hashes.items() if k in previous}
+
+    def keep(self, def_id: str):
+        """copy the page of <def_id> from the pack of the previous import"""
+        if self.previous is None:
+            self.previous = PackReader(self.pack_path)
+        self.add(def_id, self.previous.get(def_id))
+
+    def remove(self, def_ids: typing.Iterable[str]):
+        # pages that are neither added nor kept don't make it to the new pack
+        pass
+
+    def checkpoint(self) -> dict:
+        if self.writer is None:
+            self.writer = PackWriter(self.pack_path)
+        return self.writer.checkpoint()
+
+    def resumable(self, states: list[dict]) -> bool:
+        """whether the pack being written when the <states> were
+        checkpointed is still there"""
+        try:
+            size = os.path.getsize(f"{self.pack_path}.tmp")
+        except OSError:
+            return False
+        return size >= states[-1]["end"]
+
+    def resume(self, states: list[dict]):
+        self.writer = PackWriter(self.pack_path, states)
+
+    def finish(self):
+        if self.writer is None:
+            self.writer = PackWriter(self.pack_path)
+        self.writer.close()
+        if self.previous is not None:
+            self.previous.close()
+
+
+STORES = {store.name: store for store in [HtmlFileStore, PackStore]}
+
+
+class PackWriter:
+    """Writes a pack: zlib compressed blocks of concatenated values,
+    followed by an index of (block, offset, size) per key.
+
+    Layout of the file:
+      [compressed blocks...,
+       index: header, block offsets, block sizes,
+              entry blocks, entry offsets, entry sizes, keys,
+       index offset (8 bytes)]
+
+    The pack is written to a temporary file, and only replaces <path>
+    once complete. A writer can resume writing it from a checkpoint
+    (see checkpoint()), given the <states> of all the checkpoints so far.
+    """
+
+    MAGIC = b"BDPK"
+    VERSION = 1
+    # magic, version, block count, entry count, size of the keys
+    HEADER = struct.Struct("<4sHIIQ")
+    BLOCK_SIZE = 64 << 10
+
+    def __init__(self, path: str, states: typing.Optional[list[dict]] = None):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.block = []
+        self.block_size = 0
+        self.block_offsets = array.array("Q")
+        self.block_sizes = array.array("I")
+        self.entry_blocks = array.array("I")
+        self.entry_offsets = array.array("I")
+        self.entry_sizes = array.array("I")
+        self.keys = []
+        # blocks and entries already returned by checkpoint()
+        self.checkpointed_blocks = 0
+        self.checkpointed_entries = 0
+        if states:
+            self._resume(states)
+        else:
+            self.f = open(self.tmp_path, "wb")
+
+    def _resume(self, states: list[dict]):
+        for state in states:
+            for offset, size in state["blocks"]:
+                self.block_offsets.append(offset)
+                self.block_sizes.append(size)
+            for key, block, offset, size in state["entries"]:
+                self.keys.append(key)
+                self.entry_blocks.append(block)
+                self.entry_offsets.append(offset)
+                self.entry_sizes.append(size)
+        self.checkpointed_blocks = len(self.block_offsets)
+        self.checkpointed_entries = len(self.keys)
+        # anything written after the last checkpoint is dropped
+        self.f = open(self.tmp_path, "r+b")
+        self.f.truncate(states[-1]["end"])
+        self.f.seek(states[-1]["end"])
+
+    def checkpoint(self) -> dict:
+        """Write the values added so far to disk, durably, and return the
+        blocks and entries added since the previous checkpoint."""
+        self._flush_block()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        blocks, entries = self.checkpointed_blocks, self.checkpointed_entries
+        state = {
+            "end": self.f.tell(),
+            "blocks": list(
+                zip(self.block_offsets[blocks:], self.block_sizes[blocks:])
+            ),
+            "entries": list(
+                zip(
+                    self.keys[entries:],
+                    self.entry_blocks[entries:],
+                    self.entry_offsets[entries:],
+                    self.entry_sizes[entries:],
+                )
+            ),
+        }
+        self.checkpointed_blocks = len(self.block_offsets)
+        self.checkpointed_entries = len(self.keys)
+        return state
+
+    def add(self, key: str, value: bytes):
+        self.keys.append(key)
+        self.entry_blocks.append(len(self.block_offsets))
+        self.entry_offsets.append(self.block_size)
+        self.entry_sizes.append(len(value))
+        self.block.append(value)
+        self.block_size += len(value)
+        if self.block_size >= self.BLOCK_SIZE:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self.block:
+            return
+        compressed = zlib.compress(b"".join(self.block))
+        self.block_offsets.append(self.f.tell())
+        self.block_sizes.append(len(compressed))
+        self.f.write(compressed)
+        self.block = []
+        self.block_size = 0
+
+    def close(self):
+        self._flush_block()
+        index_offset = self.f.tell()
+        keys = "\0".join(self.keys).encode("utf-8")
+        self.f.write(
+            self.HEADER.pack(
+                self.MAGIC,
+                self.VERSION,
+                len(self.block_offsets),
+                len(self.keys),
+                len(keys),
+            )
+        )
+        for arr in [self.block_offsets, self.block_sizes]:
+            arr.tofile(self.f)
+        for arr in [self.entry_blocks, self.entry_offsets, self.entry_sizes]:
+            arr.tofile(self.f)
+        self.f.write(keys)
+        self.f.write(struct.pack("<Q", index_offset))
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+
+class PackReader:
+    """Random access to the values of a pack written by PackWriter.
+
+    The most recently decompressed blocks are kept in a small LRU cache.
+    """
+
+    def __init__(self, path: str, cache_size: int = 16):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.f = open(path, "rb")
+        self.mtime_ns = os.fstat(self.f.fileno()).st_mtime_ns
+
+        self.f.seek(-8, os.SEEK_END)
+        (index_offset,) = struct.unpack("<Q", self.f.read(8))
+        self.f.seek(index_offset)
+        magic, version, n_blocks, n_entries, keys_size = (
+            PackWriter.HEADER.unpack(self.f.read(PackWriter.HEADER.size))
+        )
+        if (magic, version) != (PackWriter.MAGIC, PackWriter.VERSION):
+            raise ValueError(f"{path} is not a definitions pack")
+
+        self.block_offsets = array.array("Q")
+        self.block_sizes = array.array("I")
+        for arr in [self.block_offsets, self.block_sizes]:
+            arr.fromfile(self.f, n_blocks)
+        self.entry_blocks = array.array("I")
+        self.entry_offsets = array.array("I")
+        self.entry_sizes = array.array("I")
+        for arr in [self.entry_blocks, self.entry_offsets, self.entry_sizes]:
+            arr.fromfile(self.f, n_entries)
+        keys = self.f.read(keys_size).decode("utf-8")
+        self.positions = {
+            key: i
+            for i, key in enumerate(keys.split("\0") if n_entries else [])
+        }
+
+    def close(self):
+        self.f.close()
+
+    def __contains__(self, key: str):
+        return key in self.positions
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        i = self.positions.get(key)
+        if i is None:
+            return None
+        block = self._block(self.entry_blocks[i])
+        offset = self.entry_offsets[i]
+        return block[offset : offset + self.entry_sizes[i]]
+
+    def _block(self, block_idx: int) -> bytes:
+        with self.lock:
+            if block_idx in self.cache:
+                self.cache.move_to_end(block_idx)
+                return self.cache[block_idx]
+            self.f.seek(self.block_offsets[block_idx])
+            compressed = self.f.read(self.block_sizes[block_idx])
+        block = zlib.decompress(compressed)
+        with self.lock:
+            self.cache[block_idx] = block
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return block
+
+
+class PackRegistry:
+    """Open PackReaders of all the imported dictionaries, reopened
+    whenever a dictionary is re-imported."""
+
+    def __init__(self, import_base_dir: str):
+        self.import_base_dir = import_base_dir
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def get(self, dict_id: str, def_id: str) -> typing.Optional[bytes]:
+        path = f"{self.import_base_dir}/{dict_id}/defs.pack"
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            reader = self.readers.get(dict_id)
+            if reader is None or reader.mtime_ns != mtime_ns:
+                # the previous reader may still be in use by other threads,
+                # its file is closed once they are done with it
+                reader = self.readers[dict_id] = PackReader(path)
+        return reader.get(def_id)
+
+
+def serve(import_base_dir: str, ip: str = DEFS_IP, port: str = DEFS_PORT):
+    """Serve /<dict_id>/<def_id>.html from the packs of <import_base_dir>."""
+    packs = PackRegistry(import_base_dir)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            page = None
+            if len(parts) == 2 and parts[1].endswith(".html"):
+                page = packs.get(parts[0], parts[1][: -len(".html")])
+            if page is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer((ip, int(port)), Handler).serve_forever()
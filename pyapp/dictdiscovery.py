@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import os
+import sys
+import typing
+
+# Bump whenever what's cached changes
+VERSION = 1
+# While all dictionaries that come bundled with macOS store Body.data in
+# the Contents/Resources folder, https://agiletortoise.com/terminology/mac/
+# stores the Body.data directly in the Contents folder.
+BODY_DATA_PATHS = ["Contents/Resources/Body.data", "Contents/Body.data"]
+# Info.plist files read concurrently on a cache miss
+NAME_READERS = 8
+
+
+def list_dir(dir_path: str) -> tuple[list[str], list[str]]:
+    """(subdirectories, *.dictionary bundles) in <dir_path>, leaving
+    hidden ones out like glob does"""
+    subdirs, bundles = [], []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.name.endswith(".dictionary"):
+                        if entry.is_dir():
+                            bundles.append(entry.name)
+                    elif entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return sorted(subdirs), sorted(bundles)
+
+
+def signature(dict_path: str) -> typing.Optional[list]:
+    """where Body.data is, and the mtimes and sizes of it and of
+    Info.plist. None if the bundle has no Body.data."""
+    for body_data_path in BODY_DATA_PATHS:
+        try:
+            body = os.stat(f"{dict_path}/{body_data_path}")
+            break
+        except OSError:
+            continue
+    else:
+        return None
+    try:
+        info = os.stat(f"{dict_path}/Contents/Info.plist")
+        info_sig = [info.st_mtime_ns, info.st_size]
+    except OSError:
+        info_sig = None
+    return [body_data_path, body.st_mtime_ns, body.st_size, info_sig]
+
+
+class DictionaryDiscovery:
+    """Finds the dictionaries (*.dictionary bundles with a Body.data)
+    under <roots>, and their names, remembering both in the JSON file at
+    <cache_path> for the next time.
+
+    Every directory walked is remembered with its mtime, subdirectories
+    and bundles. As adding or removing an entry changes the mtime of the
+    directory holding it, only the directories whose mtime changed are
+    listed again, the others are only stat-ed. Names are read (with
+    <read_name>, NAME_READERS at a time) only for new dictionaries, and
+    those whose Info.plist or Body.data changed.
+    """
+
+    def __init__(
+        self,
+        cache_path: str,
+        roots: list[str],
+        read_name: typing.Callable[[str], str],
+    ):
+        self.cache_path = cache_path
+        self.roots = roots
+        self.read_name = read_name
+
+    def load(self) -> dict:
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("version") != VERSION:
+            return {}
+        return cache
+
+    def save(self, cache: dict):
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def walk(self, cached_dirs: dict) -> tuple[dict, list[str]]:
+        """({dir: [mtime, subdirs, bundles]} of all the directories under
+        the roots, paths of the bundles found in them)"""
+        dirs = {}
+        bundle_paths = []
+        stack = list(reversed(self.roots))
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            cached = cached_dirs.get(dir_path)
+            if cached is not None and cached[0] == mtime_ns:
+                subdirs, bundles = cached[1], cached[2]
+            else:
+                subdirs, bundles = list_dir(dir_path)
+            dirs[dir_path] = [mtime_ns, subdirs, bundles]
+            bundle_paths.extend(f"{dir_path}/{name}" for name in bundles)
+            stack.extend(f"{dir_path}/{name}" for name in reversed(subdirs))
+        return dirs, bundle_paths
+
+    def dictionaries(self) -> dict[str, str]:
+        """{path: name} of the dictionaries found, in the order of the
+        roots, then alphabetical. Dictionaries whose name can't be read
+        are left out (and reported on stderr)."""
+        cache = self.load()
+        cached_dicts = cache.get("dicts", {})
+        dirs, bundle_paths = self.walk(cache.get("dirs", {}))
+
+        dicts = {}
+        misses = []
+        for dict_path in bundle_paths:
+            sig = signature(dict_path)
+            if sig is None:
+                continue
+            cached = cached_dicts.get(dict_path)
+            if cached is not None and cached["sig"] == sig:
+                dicts[dict_path] = cached
+            else:
+                misses.append((dict_path, sig))
+
+        if misses:
+            with concurrent.futures.ThreadPoolExecutor(NAME_READERS) as pool:
+                futures = [
+                    (dict_path, sig, pool.submit(self.read_name, dict_path))
+                    for dict_path, sig in misses
+                ]
+            for dict_path, sig, future in futures:
+                try:
+                    dicts[dict_path] = {"sig": sig, "name": future.result()}
+                except Exception as e:
+                    print(
+                        f'Unable to process "{dict_path}": {e}',
+                        file=sys.stderr,
+                    )
+
+        # in the order of bundle_paths
+        dicts = {path: dicts[path] for path in bundle_paths if path in dicts}
+        updated = {"version": VERSION, "dirs": dirs, "dicts": dicts}
+        if updated != cache:
+            self.save(updated)
+        return {path: details["name"] for path, details in dicts.items()}
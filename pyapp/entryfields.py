@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import typing
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+
+class EntryFields(typing.NamedTuple):
+    fulltext: str
+    # text of the definition proper (without headword, pronunciation, etc.)
+    snippet: str
+    # forms of a word typically include:
+    # plural forms of a noun: (mouse, mice)
+    # intensifiers for odjectives: (good, better, best)
+    # past-tense variations of verbs: (fly, flew, flown)
+    forms: str
+    ipa: typing.Optional[str]
+
+
+def extract_fields_bs4(definition: str) -> EntryFields:
+    """Reference implementation of `extract_fields`, using BeautifulSoup."""
+    soup = BeautifulSoup(definition, "lxml")
+    fulltext = soup.get_text()
+    snippet = fulltext
+    snippet_div = soup.find(attrs={"d:def": "1"})
+    if snippet_div is not None:
+        snippet = snippet_div.get_text()
+
+    forms = ""
+    forms_div = soup.find(attrs={"class": "infg"})
+    if forms_div is not None:
+        forms = forms_div.get_text()
+
+    ipa = None
+    ipa_div = soup.find(attrs={"d:prn": "IPA solitary"})
+    if ipa_div is None:
+        ipa_div = soup.find(attrs={"d:prn": "IPA"})
+    if ipa_div is not None:
+        ipa = ipa_div.get_text()
+
+    return EntryFields(fulltext, snippet, forms, ipa)
+
+
+def extract_fields(definition: str) -> EntryFields:
+    """Extract the fields of an XML definition in one pass.
+
+    Produces exactly the same output as `extract_fields_bs4`, but instead
+    of building a BeautifulSoup tree and traversing it once per field,
+    the parse events of the very same (lxml) HTML parser are consumed
+    directly.
+    """
+    collector = _FieldsCollector()
+    parser = etree.HTMLParser(target=collector, strip_cdata=False, recover=True)
+    try:
+        parser.feed(definition)
+        return parser.close()
+    except (UnicodeDecodeError, LookupError, etree.ParserError):
+        # BeautifulSoup retries such markup with a different encoding,
+        # let it do that.
+        return extract_fields_bs4(definition)
+
+
+class _Element:
+    """Text collected from the first element matching some attributes."""
+
+    def __init__(self, attr: str, value: str):
+        self.attr = attr
+        self.value = value
+        self.depth = None  # tag stack depth of the element, once found
+        self.closed = False
+        self.strings = []
+
+    def matches(self, attrib) -> bool:
+        attr_value = attrib.get(self.attr)
+        if attr_value is None:
+            return False
+        if self.attr == "class":
+            # BeautifulSoup treats 'class' as a multi-valued attribute
+            return self.value in attr_value.split()
+        return attr_value == self.value
+
+    def text(self) -> typing.Optional[str]:
+        return None if self.depth is None else "".join(self.strings)
+
+
+class _FieldsCollector:
+    """lxml parser target mirroring how BeautifulSoup builds strings.
+
+    See BeautifulSoup.endData: adjacent data is joined into one string
+    at every tag boundary, and strings consisting only of ASCII
+    whitespace collapse to a single space (or newline), except inside
+    whitespace-preserving tags. Comments, doctypes and processing
+    instructions only end the current string, and are not text.
+    """
+
+    ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+    PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+
+    def __init__(self):
+        self.pending = []
+        self.strings = []
+        self.depth = 0
+        self.preserve_whitespace_depth = 0
+        self.snippet = _Element("d:def", "1")
+        self.forms = _Element("class", "infg")
+        self.ipa_solitary = _Element("d:prn", "IPA solitary")
+        self.ipa = _Element("d:prn", "IPA")
+        self.elements = [self.snippet, self.forms, self.ipa_solitary, self.ipa]
+
+    def _end_data(self):
+        if not self.pending:
+            return
+        string = "".join(self.pending)
+        self.pending = []
+        if not self.preserve_whitespace_depth and all(
+            c in self.ASCII_SPACES for c in string
+        ):
+            string = "\n" if "\n" in string else " "
+        self.strings.append(string)
+        for element in self.elements:
+            if element.depth is not None and not element.closed:
+                element.strings.append(string)
+
+    def start(self, tag, attrib, nsmap=None):
+        self._end_data()
+        self.depth += 1
+        if tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_depth += 1
+        for element in self.elements:
+            if element.depth is None and element.matches(attrib):
+                element.depth = self.depth
+
+    def end(self, tag):
+        self._end_data()
+        for element in self.elements:
+            if element.depth == self.depth:
+                element.closed = True
+        if tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_depth -= 1
+        self.depth -= 1
+
+    def data(self, content):
+        self.pending.append(content)
+
+    def comment(self, text):
+        self._end_data()
+
+    def doctype(self, name, pubid, system):
+        self._end_data()
+
+    def pi(self, target, data=None):
+        self._end_data()
+
+    def close(self) -> EntryFields:
+        self._end_data()
+        fulltext = "".join(self.strings)
+        snippet = self.snippet.text()
+        ipa = self.ipa_solitary.text()
+        if ipa is None:
+            ipa = self.ipa.text()
+        return EntryFields(
+            fulltext=fulltext,
+            snippet=fulltext if snippet is None else snippet,
+            forms=self.forms.text() or "",
+            ipa=ipa,
+        )
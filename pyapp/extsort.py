@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import os
+import pickle
+import typing
+
+
+class TitleGrouper:
+    """Group definitions by their title using bounded memory.
+
+    Definitions are buffered in memory until they add up to `memory_limit`
+    bytes, at which point the buffer is sorted by title and spilled to a
+    run file in `tmp_dir`. `groups()` then merges the runs (an external
+    merge sort), so no more than one buffer's worth of definitions is ever
+    held in memory.
+
+    Definitions of the same title are returned in the order they were added.
+    """
+
+    def __init__(self, tmp_dir: str, memory_limit: int):
+        self.tmp_dir = tmp_dir
+        self.memory_limit = memory_limit
+        self.buffer = []
+        self.buffer_size = 0
+        self.run_paths = []
+        self.count = 0
+        self.grouped = False
+
+    def __len__(self):
+        """Number of definitions added so far."""
+        return self.count
+
+    def add(self, title: str, definition: str):
+        self.buffer.append((title, self.count, definition))
+        self.buffer_size += len(title) + len(definition)
+        self.count += 1
+        if self.buffer_size >= self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        run_path = f"{self.tmp_dir}/run{len(self.run_paths)}.pickle"
+        with open(run_path, "wb") as f:
+            for record in self.buffer:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.run_paths.append(run_path)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def groups(self) -> typing.Iterable[tuple[str, list[str]]]:
+        """Return (title, definitions) pairs, sorted by title.
+
+        Single pass: the buffer and the runs are dropped once the groups
+        are all returned, so it can be called only once."""
+        if self.grouped:
+            raise RuntimeError("TitleGrouper.groups() can be called only once")
+        self.grouped = True
+        return self._groups()
+
+    def _groups(self) -> typing.Iterable[tuple[str, list[str]]]:
+        if self.run_paths and self.buffer:
+            self._spill()
+        self.buffer.sort()
+
+        runs = [_read_run(path) for path in self.run_paths] or [self.buffer]
+        records = heapq.merge(*runs)
+        for title, group in itertools.groupby(records, key=lambda r: r[0]):
+            yield title, [definition for _, _, definition in group]
+
+        self.buffer = []
+        for path in self.run_paths:
+            os.remove(path)
+        self.run_paths = []
+
+
+def _read_run(path: str) -> typing.Iterable[tuple[str, int, str]]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
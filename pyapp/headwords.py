@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import array
+import json
+import mmap
+import os
+import struct
+import threading
+import typing
+import unicodedata
+
+from searchbackend import displayed_item
+
+MAGIC = b"BDHW"
+VERSION = 1
+# magic, version, record count, size of the ids
+HEADER = struct.Struct("<4sHxxQQ")
+# sizes of the key, id and item of an added item, see HeadwordIndexer
+ADDED_RECORD = struct.Struct("<III")
+
+
+def normalize(text: str) -> str:
+    """case and diacritics insensitive form of <text>, like the search
+    backends match it"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def id_order(def_id: str):
+    # ids are base16(<word><n>): shorter ids have smaller n
+    return len(def_id), def_id
+
+
+class HeadwordIndexer:
+    """Same interface as the search backends' indexers, maintaining
+    <path>: the alfred items of all the definitions, sorted by normalized
+    headword, for HeadwordIndex to answer prefix queries from.
+
+    As with the search backends, a re-import only adds (replaces) and
+    deletes items. The file is rewritten by finish(), from the items of
+    the previous one and the added ones, which are spilled to <path>.added
+    in the meantime: [record header, key, id, item] per item, so that an
+    interrupted import can resume from a checkpoint of it.
+
+    Layout of the file:
+      [header, item offsets (n + 1), key offsets (n + 1),
+       keys, \\0-joined ids, items]
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.added_path = f"{path}.added"
+        self.added = None
+        # (key, id, offset, size) of each added item, in self.added
+        self.added_records = {}
+        self.deleted = set()
+
+    def add(self, items):
+        if self.added is None:
+            self.added = open(self.added_path, "w+b")
+        for item in items:
+            key = normalize(item["title"]).encode("utf-8")
+            def_id = item["id"].encode("utf-8")
+            data = json.dumps(displayed_item(item)).encode("utf-8")
+            self.added.write(
+                ADDED_RECORD.pack(len(key), len(def_id), len(data))
+                + key
+                + def_id
+            )
+            self.added_records[item["id"]] = (
+                key,
+                item["id"],
+                self.added.tell(),
+                len(data),
+            )
+            self.added.write(data)
+
+    def checkpoint(self) -> dict:
+        if self.added is None:
+            return {"size": 0}
+        self.added.flush()
+        os.fsync(self.added.fileno())
+        return {"size": self.added.tell()}
+
+    def resumable(self, states: list[dict]) -> bool:
+        size = states[-1]["size"]
+        try:
+            return size == 0 or os.path.getsize(self.added_path) >= size
+        except OSError:
+            return False
+
+    def resume(self, states: list[dict]):
+        """re-read the items added up to the last of the <states>"""
+        size = states[-1]["size"]
+        if size == 0:
+            return
+        self.added = open(self.added_path, "r+b")
+        self.added.truncate(size)
+        while self.added.tell() < size:
+            key_size, id_size, item_size = ADDED_RECORD.unpack(
+                self.added.read(ADDED_RECORD.size)
+            )
+            key = self.added.read(key_size)
+            def_id = self.added.read(id_size).decode("utf-8")
+            offset = self.added.tell()
+            self.added_records[def_id] = (key, def_id, offset, item_size)
+            self.added.seek(item_size, os.SEEK_CUR)
+
+    def delete(self, ids):
+        self.deleted.update(ids)
+
+    def finish(self):
+        previous = None
+        if os.path.exists(self.path):
+            try:
+                previous = HeadwordIndex(self.path)
+            except ValueError:
+                pass
+
+        # (key, id, source, offset, size)
+        records = [
+            (key, def_id, self.added, offset, size)
+            for key, def_id, offset, size in self.added_records.values()
+        ]
+        if previous is not None:
+            records.extend(
+                record
+                for record in previous.records()
+                if record[1] not in self.deleted
+                and record[1] not in self.added_records
+            )
+        records.sort(key=lambda r: (r[0], id_order(r[1])))
+
+        key_offsets = array.array("I", [0])
+        item_offsets = array.array("Q", [0])
+        for key, _, _, _, size in records:
+            key_offsets.append(key_offsets[-1] + len(key))
+            item_offsets.append(item_offsets[-1] + size)
+
+        ids = "\0".join(record[1] for record in records).encode("utf-8")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(records), len(ids)))
+            item_offsets.tofile(f)
+            key_offsets.tofile(f)
+            for key, *_ in records:
+                f.write(key)
+            f.write(ids)
+            for _, _, source, offset, size in records:
+                f.write(read_at(source, offset, size))
+        os.replace(tmp_path, self.path)
+
+        if previous is not None:
+            previous.close()
+        if self.added is not None:
+            self.added.close()
+            os.remove(self.added_path)
+
+
+def read_at(source, offset: int, size: int) -> bytes:
+    if isinstance(source, HeadwordIndex):
+        return source.item_bytes_at(offset, size)
+    source.seek(offset)
+    return source.read(size)
+
+
+class HeadwordIndex:
+    """Prefix lookups of headwords in a file written by HeadwordIndexer.
+
+    Lookups binary search the memory mapped file, so they take the same
+    time whatever the size of the dictionary.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, ids_size = HEADER.unpack_from(self.mm)
+        if (magic, version) != (MAGIC, VERSION):
+            self.mm.close()
+            raise ValueError(f"{path} is not a headword index")
+        self.n = n
+        pos = HEADER.size
+        self.item_offsets = array.array("Q")
+        self.item_offsets.frombytes(self.mm[pos : pos + 8 * (n + 1)])
+        pos += 8 * (n + 1)
+        self.key_offsets = array.array("I")
+        self.key_offsets.frombytes(self.mm[pos : pos + 4 * (n + 1)])
+        self.keys_start = pos + 4 * (n + 1)
+        self.ids_start = self.keys_start + self.key_offsets[n]
+        self.items_start = self.ids_start + ids_size
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.n
+
+    def key(self, i: int) -> bytes:
+        start = self.keys_start + self.key_offsets[i]
+        return self.mm[start : self.keys_start + self.key_offsets[i + 1]]
+
+    def item_bytes_at(self, offset: int, size: int) -> bytes:
+        start = self.items_start + offset
+        return self.mm[start : start + size]
+
+    def item(self, i: int) -> dict:
+        offset = self.item_offsets[i]
+        size = self.item_offsets[i + 1] - offset
+        return json.loads(self.item_bytes_at(offset, size))
+
+    def lower_bound(self, key: bytes) -> int:
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def search(self, prefix: str, limit: int) -> list[dict]:
+        """items of the headwords starting with <prefix>, in alphabetical
+        order (so an exact match comes first)"""
+        key = normalize(prefix).encode("utf-8")
+        hits = []
+        i = self.lower_bound(key)
+        while i < self.n and len(hits) < limit and self.key(i).startswith(key):
+            hits.append(self.item(i))
+            i += 1
+        return hits
+
+    def records(self) -> typing.Iterator[tuple]:
+        """(key, id, self, item offset, item size) of all the items"""
+        ids = self.mm[self.ids_start : self.items_start].decode("utf-8")
+        for i, def_id in enumerate(ids.split("\0") if self.n else []):
+            offset = self.item_offsets[i]
+            yield (
+                self.key(i),
+                def_id,
+                self,
+                offset,
+                self.item_offsets[i + 1] - offset,
+            )
+
+
+def headword_index_path(dest_dir: str) -> str:
+    return f"{dest_dir}/headwords.idx"
+
+
+class HeadwordRegistry:
+    """Open HeadwordIndexes of all the imported dictionaries, reopened
+    whenever a dictionary is re-imported."""
+
+    def __init__(self, import_base_dir: str):
+        self.import_base_dir = import_base_dir
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, dict_id: str) -> typing.Optional[HeadwordIndex]:
+        path = headword_index_path(f"{self.import_base_dir}/{dict_id}")
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            index = self.indexes.get(dict_id)
+            if index is None or index.mtime_ns != mtime_ns:
+                # the replaced index is left to the garbage collector, as
+                # other threads may still be searching it
+                index = self.indexes[dict_id] = HeadwordIndex(path)
+        return index
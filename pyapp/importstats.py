@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import typing
+
+# the latest report of each dictionary, next to imported.json
+STATS_FILE = "import-stats.json"
+# number of allocation sites kept in a tracemalloc capture
+TRACEMALLOC_TOP = 15
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(maxrss / (1 << (20 if sys.platform == "darwin" else 10)), 1)
+
+
+def cpu_s() -> float:
+    """CPU time of this process and of its (terminated, waited for)
+    children, such as the import's worker processes"""
+    times = os.times()
+    return (
+        times.user + times.system + times.children_user + times.children_system
+    )
+
+
+def tree_size(paths: typing.Iterable[str]) -> int:
+    size = 0
+    for path in paths:
+        for dir_path, _, file_names in os.walk(path):
+            for file_name in file_names:
+                with contextlib.suppress(OSError):
+                    size += os.lstat(f"{dir_path}/{file_name}").st_size
+    return size
+
+
+def timed_iter(iterable: typing.Iterable, timings: dict, key: str):
+    """iterate over <iterable>, adding the time spent getting each item
+    to timings[key]"""
+    timings.setdefault(key, 0.0)
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[key] += time.perf_counter() - start
+            return
+        timings[key] += time.perf_counter() - start
+        yield item
+
+
+class ImportStats:
+    """Per-stage measurements of one import of a dictionary.
+
+    Each stage records its wall and CPU time, the entries it processed
+    per second, the bytes it wrote (growth of the <watched_dirs>), and
+    the peak RSS of the importing process and of its children so far.
+    Stages can add their own breakdown of where the time went.
+
+    The stage named <profile_stage> is run under cProfile, its stats
+    dumped to <profile_dir>/<stage>.pstats; the one named
+    <tracemalloc_stage> under tracemalloc, its top allocation sites kept
+    in the report. Both only see this process, not its children.
+    """
+
+    def __init__(
+        self,
+        dict_id: str,
+        dict_name: str,
+        watched_dirs: list[str],
+        profile_stage: typing.Optional[str] = None,
+        tracemalloc_stage: typing.Optional[str] = None,
+        profile_dir: typing.Optional[str] = None,
+    ):
+        self.dict_id = dict_id
+        self.dict_name = dict_name
+        self.watched_dirs = watched_dirs
+        self.profile_stage = profile_stage
+        self.tracemalloc_stage = tracemalloc_stage
+        self.profile_dir = profile_dir
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_s()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, entries: typing.Optional[int] = None):
+        """measure the body of the with statement as stage <name>.
+
+        yields the record of the stage, for the body to set "entries"
+        (if not known upfront) or add a "breakdown" to. the stage is
+        recorded (and profiling stopped) even if the body raises."""
+        record = {"name": name}
+        if entries is not None:
+            record["entries"] = entries
+        size = tree_size(self.watched_dirs)
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if name == self.tracemalloc_stage:
+            tracemalloc.start()
+        start_cpu = cpu_s()
+        start_wall = time.perf_counter()
+
+        try:
+            yield record
+        finally:
+            wall_s = time.perf_counter() - start_wall
+            record["wall_s"] = round(wall_s, 3)
+            record["cpu_s"] = round(cpu_s() - start_cpu, 3)
+            if record.get("entries") and wall_s > 0:
+                record["entries_per_s"] = round(record["entries"] / wall_s, 1)
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = f"{self.profile_dir}/{name}.pstats"
+                profiler.dump_stats(path)
+                record["profile"] = path
+            if name == self.tracemalloc_stage:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                top = snapshot.statistics("lineno")[:TRACEMALLOC_TOP]
+                record["tracemalloc"] = {
+                    "peak_mb": round(peak / (1 << 20), 1),
+                    "top": [str(stat) for stat in top],
+                }
+            record["bytes_written"] = tree_size(self.watched_dirs) - size
+            record["peak_rss_mb"] = peak_rss_mb()
+            record["children_peak_rss_mb"] = peak_rss_mb(
+                resource.RUSAGE_CHILDREN
+            )
+            self.stages.append(record)
+
+    def report(self) -> dict:
+        return {
+            "dict_id": self.dict_id,
+            "dict_name": self.dict_name,
+            "started": self.started,
+            "wall_s": round(time.perf_counter() - self.start_wall, 3),
+            "cpu_s": round(cpu_s() - self.start_cpu, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "stages": self.stages,
+        }
+
+    def save(self, path: str):
+        """replace the report of the dictionary in <path>"""
+        reports = load(path)
+        reports[self.dict_id] = self.report()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(reports, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def load(path: str) -> dict:
+    """{dict_id: report} of the reports saved in <path>"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['dict_name']} ({report['dict_id']}), "
+        f"imported {report['started']}",
+        f"  total: {report['wall_s']:.1f} s wall, {report['cpu_s']:.1f} s CPU,"
+        f" peak RSS {report['peak_rss_mb']:.0f} MB"
+        f" (children {report['children_peak_rss_mb']:.0f} MB)",
+    ]
+    for stage in report["stages"]:
+        line = (
+            f"  {stage['name']:>20}: {stage['wall_s']:8.1f} s wall"
+            f" {stage['cpu_s']:8.1f} s CPU"
+            f" {stage['bytes_written'] / (1 << 20):8.1f} MB written"
+            f" {stage['peak_rss_mb']:6.0f} MB peak RSS"
+        )
+        if "entries_per_s" in stage:
+            line += f" {stage['entries_per_s']:9.0f} entries/s"
+        lines.append(line)
+        for key, value in stage.get("breakdown", {}).items():
+            lines.append(f"  {'':>20}  {key}: {value}")
+        if "profile" in stage:
+            lines.append(f"  {'':>20}  profile: {stage['profile']}")
+        if "tracemalloc" in stage:
+            traced = stage["tracemalloc"]
+            lines.append(f"  {'':>20}  traced peak: {traced['peak_mb']} MB")
+            for line in traced["top"]:
+                lines.append(f"  {'':>20}  {line}")
+    return "\n".join(lines)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+# Bump whenever what gets stored or indexed for a definition changes,
+# so that the next re-import redoes every definition.
+VERSION = 3
+
+
+def content_hash(definition: str) -> str:
+    return hashlib.blake2b(
+        definition.encode("utf-8"), digest_size=8
+    ).hexdigest()
+
+
+def read(
+    path: str, store_name: str, backend_name: str, profile_name: str
+) -> dict[str, str]:
+    """Return {definition id: content hash} of the previous import.
+
+    Empty if there was no previous import, or if it was done by a
+    different version, or into a different kind of definitions store or
+    search backend, or with a different index profile.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        header = _header(store_name, backend_name, profile_name)
+        if f.readline().strip() != header:
+            return {}
+        return dict(line.rstrip("\n").split("\t") for line in f)
+
+
+def write(
+    path: str,
+    store_name: str,
+    backend_name: str,
+    profile_name: str,
+    hashes: dict[str, str],
+):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(_header(store_name, backend_name, profile_name) + "\n")
+        for def_id, digest in hashes.items():
+            f.write(f"{def_id}\t{digest}\n")
+    os.replace(tmp_path, path)
+
+
+def _header(store_name: str, backend_name: str, profile_name: str) -> str:
+    return (
+        f"# version={VERSION} store={store_name} backend={backend_name}"
+        f" profile={profile_name}"
+    )
+
+
+def invalidate(path: str, backend_name: str):
+    """Forget the previous import if it was indexed into <backend_name>,
+    whose index is about to be dropped."""
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        fields = f.readline().split()
+    if f"backend={backend_name}" in fields:
+        os.remove(path)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import plistlib
 
 
@@ -9,5 +10,9 @@ def read(plist_path: str):
 
 
 def dump(obj, path: str):
-    with open(path, "wb") as f:
-        return plistlib.dump(obj, f)
+    """write <obj> to <path> atomically: readers (Alfred, other imports)
+    never see a partially written plist"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        plistlib.dump(obj, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import os
+import threading
+import time
+import typing
+
+
+def normalize(query: str) -> str:
+    # the search backends ignore case and extra whitespace, but for a
+    # trailing space: Meilisearch only matches the last word as a prefix
+    # while nothing follows it
+    normalized = " ".join(query.split()).casefold()
+    if normalized and query[-1].isspace():
+        normalized += " "
+    return normalized
+
+
+def dict_generation(import_base_dir: str, dict_id: str) -> int:
+    """changes whenever <dict_id> is (re-)imported, as the manifest is
+    rewritten at the end of every import.
+
+    dictionaries without an import of their own (all-dictionaries) change
+    whenever any dictionary is imported, as imported.json is rewritten at
+    the end of every import."""
+    for path in [
+        f"{import_base_dir}/{dict_id}/manifest.tsv",
+        f"{import_base_dir}/imported.json",
+    ]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+    return 0
+
+
+class QueryCache:
+    """Alfred responses of recent queries, keyed by (dict_id, normalized
+    query, limit).
+
+    Holds at most <max_entries> responses, evicting the least recently
+    used one, and none older than <ttl_s> seconds. Responses are tagged
+    with the generation of their dictionary, so that those from before a
+    re-import are never served.
+
+    The cache, along with hit and miss counters, is persisted to <path>
+    by save(), and loaded back by the next QueryCache on <path>.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        import_base_dir: str,
+        max_entries: int = 2000,
+        ttl_s: float = 7 * 24 * 3600,
+    ):
+        self.path = path
+        self.import_base_dir = import_base_dir
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        # key -> (generation, created, response)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def get(
+        self, dict_id: str, query: str, limit: int
+    ) -> typing.Optional[bytes]:
+        key = (dict_id, normalize(query), limit)
+        generation = dict_generation(self.import_base_dir, dict_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (
+                entry[0] != generation or time.time() - entry[1] > self.ttl_s
+            ):
+                del self.entries[key]
+                entry = None
+            self.dirty = True
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, dict_id: str, query: str, limit: int, response: bytes):
+        key = (dict_id, normalize(query), limit)
+        generation = dict_generation(self.import_base_dir, dict_id)
+        with self.lock:
+            self.entries[key] = (generation, time.time(), response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except ValueError:
+            return
+        self.hits = saved["hits"]
+        self.misses = saved["misses"]
+        now = time.time()
+        for dict_id, query, limit, generation, created, response in saved[
+            "entries"
+        ][-self.max_entries :]:
+            if now - created <= self.ttl_s:
+                self.entries[(dict_id, query, limit)] = (
+                    generation,
+                    created,
+                    response.encode("utf-8"),
+                )
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            saved = {
+                "hits": self.hits,
+                "misses": self.misses,
+                # least recently used first
+                "entries": [
+                    [*key, generation, created, response.decode("utf-8")]
+                    for key, (generation, created, response) in (
+                        self.entries.items()
+                    )
+                ],
+            }
+            self.dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, self.path)
+
+    def autosave(self, interval: float = 30):
+        """save() every <interval> seconds, in a background thread"""
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.save()
+
+        threading.Thread(target=run, daemon=True).start()
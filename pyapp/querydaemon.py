@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import http.client
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+import typing
+
+import headwords
+import querycache
+import reversesearch
+
+RESULT_LIMIT = 9
+# queries up to this long, of a single word, are answered from the
+# headword index (see headwords.py) instead of the search backend
+PREFIX_QUERY_MAX_CHARS = 2
+# queries starting with this find words by what their definitions say,
+# in the reverse-search index (see reversesearch.py)
+REVERSE_SEARCH_PREFIX = "?"
+# backend of the dictionaries imported before backends were selectable
+DEFAULT_BACKEND = "meilisearch"
+# pseudo dictionary searching all the imported dictionaries at once
+ALL_DICTS = "all-dictionaries"
+ALL_DICTS_NAME = "All dictionaries"
+# dictionaries searched concurrently by an all-dictionaries search
+FAN_OUT_WORKERS = 8
+# threads answering the script filters. They live as long as the daemon,
+# so that the connections the searchers keep per thread are reused from
+# one keystroke to the next.
+QUERY_WORKERS = 4
+
+
+def alfred_response(items: list, rerun: typing.Optional[float] = None) -> bytes:
+    response = {"items": items}
+    if rerun is not None:
+        response["rerun"] = rerun
+    return json.dumps(response).encode("utf-8")
+
+
+def not_ready_response() -> bytes:
+    return alfred_response(
+        [{"title": "Starting the search server...", "valid": False}],
+        rerun=0.5,
+    )
+
+
+def error_response(error: Exception) -> bytes:
+    return alfred_response(
+        [
+            {
+                "title": "Can't search the dictionary",
+                "subtitle": str(error),
+                "valid": False,
+            }
+        ]
+    )
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """Protocol: the client sends one line, "<dict_id>\\t<query>\\n",
+    and receives the Alfred script filter JSON, after which the connection
+    is closed."""
+
+    def handle(self):
+        line = self.rfile.readline().decode("utf-8").rstrip("\r\n")
+        dict_id, _, query = line.partition("\t")
+        self.wfile.write(self.server.search(dict_id, query))
+
+
+class QueryDaemon(socketserver.UnixStreamServer):
+    """Long-lived process answering the script filters of the workflow.
+
+    Short queries are answered from the headword index of the dictionary,
+    reverse searches (queries starting with REVERSE_SEARCH_PREFIX) from
+    its reverse-search index. Others are searched with the backend the
+    dictionary was imported with (see searchbackend.py), as recorded in
+    imported.json. Searchers keep their connections warm, and the Alfred
+    response is shaped here, so that a keystroke costs one round-trip
+    over a Unix socket instead of spawning curl and jq. Responses are
+    cached in <cache>, if given. <on_query> is called on every query.
+
+    Searching ALL_DICTS searches all the imported dictionaries
+    concurrently, see search_all. Requests are answered by a fixed pool
+    of QUERY_WORKERS threads.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        import_base_dir: str,
+        searchers: dict,
+        on_query: typing.Callable[[], None] = lambda: None,
+        on_search: typing.Callable[[str], None] = lambda backend_name: None,
+        on_unreachable: typing.Callable[[], None] = lambda: None,
+        cache: typing.Optional[querycache.QueryCache] = None,
+    ):
+        self.imported_json_path = f"{import_base_dir}/imported.json"
+        self.headwords = headwords.HeadwordRegistry(import_base_dir)
+        self.reverse = reversesearch.ReverseSearcher(import_base_dir)
+        self.searchers = searchers
+        self.on_query = on_query
+        self.on_search = on_search
+        self.on_unreachable = on_unreachable
+        self.cache = cache
+        self.imported = {}
+        self.imported_mtime_ns = None
+        self.lock = threading.Lock()
+        self.fan_out = concurrent.futures.ThreadPoolExecutor(FAN_OUT_WORKERS)
+        self.workers = concurrent.futures.ThreadPoolExecutor(QUERY_WORKERS)
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, QueryHandler)
+
+    def process_request(self, request, client_address):
+        self.workers.submit(
+            self.process_request_thread, request, client_address
+        )
+
+    def process_request_thread(self, request, client_address):
+        # as in socketserver.ThreadingMixIn
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.workers.shutdown(wait=False)
+        self.fan_out.shutdown(wait=False)
+
+    def imported_dicts(self) -> dict:
+        """{dict_id: (name, backend)} of the imported dictionaries, in
+        import order, re-reading imported.json whenever it changes"""
+        try:
+            mtime_ns = os.stat(self.imported_json_path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        with self.lock:
+            if mtime_ns != self.imported_mtime_ns:
+                self.imported = {}
+                if mtime_ns is not None:
+                    with open(self.imported_json_path) as f:
+                        imported = json.load(f)
+                    names = {i["arg"]: i["title"] for i in imported["items"]}
+                    self.imported = {
+                        dict_id: (
+                            names[dict_id],
+                            details.get("backend", DEFAULT_BACKEND),
+                        )
+                        for dict_id, details in dict_details(imported).items()
+                    }
+                self.imported_mtime_ns = mtime_ns
+            return self.imported
+
+    def backend_of(self, dict_id: str) -> str:
+        """name of the search backend <dict_id> was imported with"""
+        return self.imported_dicts().get(dict_id, (None, DEFAULT_BACKEND))[1]
+
+    def search_hits(self, dict_id: str, query: str, limit: int) -> list:
+        backend_name = self.backend_of(dict_id)
+        self.on_search(backend_name)
+        return self.searchers[backend_name].search(dict_id, query, limit)
+
+    def hits(self, dict_id: str, query: str, limit: int) -> list:
+        reverse_query = as_reverse_query(query)
+        if reverse_query is not None:
+            return self.reverse.search(dict_id, reverse_query, limit)
+        if is_prefix_query(query):
+            index = self.headwords.get(dict_id)
+            hits = [] if index is None else index.search(query, limit)
+            if hits:
+                return hits
+        return self.search_hits(dict_id, query, limit)
+
+    def search_all(self, query: str, limit: int) -> tuple[list, bool]:
+        """Search all the imported dictionaries concurrently, and merge
+        their hits (see merge_hits), each tagged with its dictionary.
+
+        Returns the hits, and whether they are complete: dictionaries
+        whose search server can't be reached are left out. So are those
+        whose index can't be read, which searching again won't fix.
+        """
+        dicts = self.imported_dicts()
+        futures = {
+            dict_id: self.fan_out.submit(self.hits, dict_id, query, limit)
+            for dict_id in dicts
+        }
+        results = []
+        complete = True
+        error = None
+        for dict_id, future in futures.items():
+            try:
+                hits = future.result()
+            except (OSError, http.client.HTTPException):
+                complete = False
+                continue
+            except sqlite3.Error as e:
+                error = e
+                continue
+            results.append([tag_hit(hit, dicts[dict_id][0]) for hit in hits])
+        if not results and not complete:
+            raise ConnectionError("no dictionary could be searched")
+        if not results and error is not None:
+            raise error
+        return merge_hits(results, query, limit), complete
+
+    def search(self, dict_id: str, query: str) -> bytes:
+        self.on_query()
+        if self.cache is not None:
+            cached = self.cache.get(dict_id, query, RESULT_LIMIT)
+            if cached is not None:
+                return cached
+        try:
+            if dict_id == ALL_DICTS:
+                hits, complete = self.search_all(query, RESULT_LIMIT)
+            else:
+                hits, complete = self.hits(dict_id, query, RESULT_LIMIT), True
+        except (OSError, http.client.HTTPException):
+            self.on_unreachable()
+            return not_ready_response()
+        except sqlite3.Error as e:
+            return error_response(e)
+        if not complete:
+            self.on_unreachable()
+            return alfred_response(hits, rerun=0.5)
+        response = alfred_response(hits)
+        if self.cache is not None:
+            self.cache.put(dict_id, query, RESULT_LIMIT, response)
+        return response
+
+
+def dict_details(imported: dict) -> dict:
+    """{dict_id: details} of the dictionaries in <imported> (the contents
+    of imported.json), in import order.
+
+    Dictionaries imported before their details were recorded only have
+    an item: they were imported into DEFAULT_BACKEND.
+    """
+    details = imported.get("dicts", {})
+    return {
+        item["arg"]: details.get(item["arg"], {"backend": DEFAULT_BACKEND})
+        for item in imported["items"]
+        if item["arg"] != ALL_DICTS
+    }
+
+
+def tag_hit(hit: dict, dict_name: str) -> dict:
+    return {**hit, "subtitle": f"[{dict_name}] {hit.get('subtitle', '')}"}
+
+
+def merge_hits(results: list[list[dict]], query: str, limit: int) -> list:
+    """Merge the ranked hits of several dictionaries into <limit> hits.
+
+    Unified ranking: hits whose headword is the query come first, then
+    hits by their rank within their dictionary, ties going to the
+    dictionary imported first. Each dictionary is guaranteed its quota
+    of the hits (an equal share) as long as it has that many; the slots
+    it leaves unused go to the next best hits of the others.
+    """
+    if not results:
+        return []
+    quota = -(-limit // len(results))
+    key = headwords.normalize(query.strip())
+    ranked = sorted(
+        (headwords.normalize(hit.get("title", "")) != key, rank, i)
+        for i, hits in enumerate(results)
+        for rank, hit in enumerate(hits)
+    )
+    taken = set()
+    counts = [0] * len(results)
+    for within_quota in [True, False]:
+        for position in ranked:
+            if len(taken) >= limit:
+                break
+            _, _, i = position
+            if position in taken or (within_quota and counts[i] >= quota):
+                continue
+            taken.add(position)
+            counts[i] += 1
+    return [results[i][rank] for _, rank, i in sorted(taken)]
+
+
+def is_prefix_query(query: str) -> bool:
+    query = query.strip()
+    return 0 < len(query) <= PREFIX_QUERY_MAX_CHARS and " " not in query
+
+
+def as_reverse_query(query: str) -> typing.Optional[str]:
+    """<query> without REVERSE_SEARCH_PREFIX, if it's a reverse search"""
+    query = query.lstrip()
+    if not query.startswith(REVERSE_SEARCH_PREFIX):
+        return None
+    return query[len(REVERSE_SEARCH_PREFIX) :]
+
+
+def remove_stale_socket(socket_path: str):
+    """Remove <socket_path> if no daemon is listening on it anymore,
+    raise if one is."""
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+            return
+    raise RuntimeError(f"A query daemon is already listening on {socket_path}")
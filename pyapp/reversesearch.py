@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import json
+import re
+import typing
+
+from entryfields import EntryFields
+from headwords import normalize
+from searchbackend import FtsIndexer
+from searchbackend import FtsSearcher
+
+# words as split by the unicode61 tokenizer. Only those of at least two
+# letters, and no digits (such as the numbers of senses), are terms.
+TERM_RE = re.compile(r"[^\W_]+")
+# words that say nothing about what a definition is about, be it English
+# function words or the labels dictionaries give their entries
+STOPWORDS = frozenset("""
+    about above after again against all also am an and any are as at be
+    because been before being below between both but by can could did do
+    does doing down during each either etc even ever every few for from
+    further had has have having he her here hers herself him himself his
+    how if in into is it its itself just least less let like may me might
+    more most much must my myself neither no nor not now of off often on
+    once one only onto or other our ours ourselves out over own per same
+    shall she should since so some such than that the their theirs them
+    themselves then there these they this those though through thus to
+    too under until up upon us usually very was we were what when where
+    whether which while who whom whose why will with within without would
+    yet you your yours yourself yourselves
+    abbreviation adjective adverb archaic chiefly conjunction dated
+    derogatory determiner dialect especially exclamation figurative
+    formal humorous informal literary noun origin phrase plural
+    preposition pronoun rare singular slang something someone typically
+    usage used verb
+    """.split())
+# bm25 weights of the columns of docs_fts: words of the definition proper
+# count more than those of the rest of the entry (examples, notes, etc.)
+COLUMN_WEIGHTS = "3.0, 1.0"
+
+
+def terms(text: str, skip: typing.Collection[str] = ()) -> list[str]:
+    """distinct normalized words of <text>, in order of appearance, but
+    for stopwords and the words in <skip>"""
+    seen = set(skip)
+    found = []
+    for term in TERM_RE.findall(normalize(text)):
+        if (
+            len(term) > 1
+            and term.isalpha()
+            and term not in seen
+            and term not in STOPWORDS
+        ):
+            seen.add(term)
+            found.append(term)
+    return found
+
+
+def definition_terms(word: str, fields: EntryFields) -> tuple[str, str]:
+    """(terms of the definition proper, terms of the rest of the entry) of
+    a definition of <word>, each term only once.
+
+    The headword, its inflected forms and its pronunciation are left out:
+    looking them up is what the headword index is for.
+    """
+    skip = set(terms(f"{word} {fields.forms} {fields.ipa or ''}"))
+    gloss = terms(fields.snippet, skip)
+    rest = terms(fields.fulltext, skip.union(gloss))
+    return " ".join(gloss), " ".join(rest)
+
+
+def reverse_index_path(dest_dir: str) -> str:
+    return f"{dest_dir}/reverse.sqlite"
+
+
+# docs holds the terms of the definitions, docs_fts indexes them without
+# storing them a second time. As each term occurs once per column of a
+# definition, positions aren't kept (detail=column).
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    gloss TEXT NOT NULL,
+    rest TEXT NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5 (
+    gloss, rest,
+    content='docs',
+    content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2',
+    detail=column
+);
+"""
+
+
+class ReverseIndexer(FtsIndexer):
+    """FtsIndexer of the reverse-search index at <path>, from the
+    "reverse_terms" (see definition_terms) of the alfred items."""
+
+    schema = SQLITE_SCHEMA
+    columns = ["gloss", "rest"]
+
+    def row(self, item: dict) -> tuple:
+        return tuple(item["reverse_terms"])
+
+
+def match_query(query: str) -> typing.Optional[str]:
+    """FTS5 query matching definitions containing all the terms of
+    <query>, the last one possibly incomplete (it's being typed)"""
+    query_terms = terms(query)
+    if not query_terms:
+        return None
+    phrases = [f'"{term}"' for term in query_terms]
+    return " ".join(phrases) + "*"
+
+
+class ReverseSearcher(FtsSearcher):
+    """Finds words by what their definitions say, in the reverse-search
+    indexes of the dictionaries in <import_base_dir>.
+
+    Definitions containing all the terms of the query are ranked by bm25:
+    rare terms weigh more than common ones, and short definitions more
+    than long ones.
+    """
+
+    column_weights = COLUMN_WEIGHTS
+    index_path = staticmethod(reverse_index_path)
+
+    def search(self, dict_id: str, query: str, limit: int) -> list:
+        match = match_query(query)
+        conn = self.connection(dict_id)
+        if conn is None or match is None:
+            return []
+        rows = self.ranked_matches(conn, match, limit)
+        return [json.loads(item) for _, item in rows]
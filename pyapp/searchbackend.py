@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+
+import http.client
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import typing
+from collections import deque
+from urllib.parse import quote
+
+from ProgressBar import IndefiniteProgressBar
+
+# attributes of an alfred item that are searched, by decreasing importance
+SEARCHABLE_ATTRIBUTES = ["title", "forms", "subtitle", "fulltext"]
+# everything except id, forms, and fulltext
+DISPLAYED_ATTRIBUTES = ["arg", "mods", "title", "subtitle", "quicklookurl"]
+# attributes searched by each index profile. Others are only stored if
+# displayed: leaner profiles make for much smaller and faster indexes.
+# Finding words by what's in their definitions is left to the dedicated
+# reverse-search index (see reversesearch.py), whatever the profile.
+INDEX_PROFILES = {
+    "headword": ["title", "forms"],
+    "snippet": ["title", "forms", "subtitle"],
+    "full": SEARCHABLE_ATTRIBUTES,
+}
+DEFAULT_INDEX_PROFILE = "headword"
+
+
+def noop():
+    pass
+
+
+def displayed_item(item: dict) -> dict:
+    return {k: item[k] for k in DISPLAYED_ATTRIBUTES if k in item}
+
+
+def indexed_item(item: dict, searchable: list[str]) -> dict:
+    """<item> without the attributes that are neither <searchable> nor
+    displayed"""
+    return {
+        k: v
+        for k, v in item.items()
+        if k == "id" or k in searchable or k in DISPLAYED_ATTRIBUTES
+    }
+
+
+class MeilisearchBackend:
+    """Indexes into, and searches, the alfred-dict-server (Meilisearch)
+    process shared by all the dictionaries."""
+
+    name = "meilisearch"
+
+    def __init__(
+        self,
+        dict_id: str,
+        client_factory: typing.Callable[[], typing.Any],
+        profile: str = DEFAULT_INDEX_PROFILE,
+    ):
+        self.dict_id = dict_id
+        # returns a meilisearch.Client of a running server
+        self.client_factory = client_factory
+        self.profile = profile
+
+    def indexer(self) -> "AccumulatedIndexer":
+        searchable = INDEX_PROFILES[self.profile]
+        return AccumulatedIndexer(
+            create_index(self.client_factory(), self.dict_id, searchable),
+            searchable,
+        )
+
+    def drop(self):
+        client = self.client_factory()
+        client.wait_for_task(
+            client.delete_index(self.dict_id).task_uid, timeout_in_ms=10000
+        )
+
+
+def create_index(client, dict_id, searchable=SEARCHABLE_ATTRIBUTES):
+    task_info = client.create_index(dict_id)
+    client.wait_for_task(task_info.task_uid, timeout_in_ms=10000)
+    index = client.get_index(dict_id)
+    index.update_searchable_attributes(searchable)
+    index.update_ranking_rules(
+        [
+            "exactness",
+            "attribute",
+            "typo",
+            "words",
+            "proximity",
+        ]
+    )
+    index.update_displayed_attributes(DISPLAYED_ATTRIBUTES)
+    return index
+
+
+class AccumulatedIndexer:
+    """Sends documents to the index in batches while they are being made.
+
+    A batch is sent once it holds BATCH_SIZE documents or roughly
+    BATCH_BYTES of text, whichever comes first. At most MAX_PENDING_TASKS
+    batches are left enqueued on the search server: adding more waits
+    for the oldest one to be processed, so that neither this process nor
+    the server's task queue has to hold the whole dictionary.
+    """
+
+    BATCH_SIZE = 2000
+    BATCH_BYTES = 8 << 20
+    MAX_PENDING_TASKS = 4
+
+    def __init__(self, index, searchable=SEARCHABLE_ATTRIBUTES):
+        self.items = []
+        self.items_size = 0
+        self.index = index
+        self.searchable = searchable
+        self.task_uids = []
+        self.pending_task_uids = deque()
+        # time spent waiting for the server to process batches
+        self.wait_s = 0.0
+
+    def add(self, items):
+        for item in items:
+            item = indexed_item(item, self.searchable)
+            self.items.append(item)
+            self.items_size += document_size(item)
+            if (
+                len(self.items) >= self.BATCH_SIZE
+                or self.items_size >= self.BATCH_BYTES
+            ):
+                self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        task_info = self.index.add_documents(self.items, primary_key="id")
+        self.task_uids.append(task_info.task_uid)
+        self.pending_task_uids.append(task_info.task_uid)
+        self.items = []
+        self.items_size = 0
+        while len(self.pending_task_uids) > self.MAX_PENDING_TASKS:
+            self.wait(self.pending_task_uids.popleft())
+
+    def delete(self, ids):
+        if not ids:
+            return
+        self.flush()
+        task_info = self.index.delete_documents(list(ids))
+        self.task_uids.append(task_info.task_uid)
+        self.pending_task_uids.append(task_info.task_uid)
+
+    def checkpoint(self):
+        """wait until the server acknowledges (has indexed) everything
+        added so far"""
+        self.flush()
+        while self.pending_task_uids:
+            self.wait(self.pending_task_uids.popleft())
+        return None
+
+    def resumable(self, states) -> bool:
+        # the acknowledged documents are in the index already
+        return True
+
+    def resume(self, states):
+        pass
+
+    def wait(self, task_uid, on_poll=noop):
+        start = time.perf_counter()
+        while (task := self.index.get_task(task_uid)).status in (
+            "enqueued",
+            "processing",
+        ):
+            on_poll()
+            time.sleep(0.1)
+        self.wait_s += time.perf_counter() - start
+        if task.status != "succeeded":
+            raise RuntimeError(
+                f"Indexing task {task_uid} {task.status}: {task.error}"
+            )
+
+    def finish(self):
+        self.flush()
+        # only shown if the server is still busy indexing
+        ipb = None
+
+        def on_poll():
+            nonlocal ipb
+            if ipb is None:
+                ipb = IndefiniteProgressBar(
+                    title="Waiting for index to be ready..."
+                )
+            ipb.update(message="")
+
+        while self.pending_task_uids:
+            self.wait(self.pending_task_uids.popleft(), on_poll=on_poll)
+        if ipb is not None:
+            ipb.finish()
+
+
+def document_size(doc):
+    """rough size of a document when sent to the index"""
+    return sum(len(v) for v in doc.values() if isinstance(v, str))
+
+
+class MeilisearchSearcher:
+    """Searches the Meilisearch server over a warm (keep-alive) HTTP
+    connection per thread.
+
+    Raises OSError or http.client.HTTPException if the server can't be
+    reached.
+    """
+
+    def __init__(self, search_ip: str, search_port: str):
+        self.search_ip = search_ip
+        self.search_port = int(search_port)
+        self.local = threading.local()
+
+    def connection(self, fresh=False) -> http.client.HTTPConnection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None or fresh:
+            if conn is not None:
+                conn.close()
+            conn = http.client.HTTPConnection(
+                self.search_ip, self.search_port, timeout=5
+            )
+            self.local.conn = conn
+        return conn
+
+    def post(self, path: str, body: dict) -> dict:
+        """POST to the search server, reconnecting once if the kept-alive
+        connection went stale."""
+        payload = json.dumps(body)
+        headers = {"Content-Type": "application/json"}
+        for fresh in (False, True):
+            conn = self.connection(fresh=fresh)
+            try:
+                conn.request("POST", path, payload, headers)
+                response = conn.getresponse()
+                return json.loads(response.read())
+            except (OSError, http.client.HTTPException):
+                if fresh:
+                    raise
+
+    def search(self, dict_id: str, query: str, limit: int) -> list:
+        path = f"/indexes/{quote(dict_id)}/search"
+        return self.post(path, {"q": query, "limit": limit}).get("hits", [])
+
+
+class SqliteBackend:
+    """An SQLite FTS5 index per dictionary, in <dest_dir>/index.sqlite,
+    searched in-process by the query daemon: no server to start, and no
+    cold start."""
+
+    name = "sqlite"
+
+    def __init__(self, dest_dir: str, profile: str = DEFAULT_INDEX_PROFILE):
+        self.path = sqlite_index_path(dest_dir)
+        self.profile = profile
+
+    def indexer(self) -> "SqliteIndexer":
+        return SqliteIndexer(self.path, INDEX_PROFILES[self.profile])
+
+    def drop(self):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+BACKENDS = [MeilisearchBackend.name, SqliteBackend.name]
+
+
+def sqlite_index_path(dest_dir: str) -> str:
+    return f"{dest_dir}/index.sqlite"
+
+
+# docs holds the documents, docs_fts indexes them without storing them
+# a second time (an "external content" FTS5 table).
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL COLLATE NOCASE,
+    forms TEXT NOT NULL,
+    subtitle TEXT NOT NULL,
+    fulltext TEXT NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_title ON docs (title);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5 (
+    title, forms, subtitle, fulltext,
+    content='docs',
+    content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+"""
+
+
+class FtsIndexer:
+    """Same interface as AccumulatedIndexer, for an SQLite FTS5 index at
+    <path>: a docs table of documents, and a docs_fts table indexing the
+    <columns> of docs without storing them a second time.
+
+    Subclasses give the <schema> creating both tables, and the values of
+    the columns of an alfred item (see row).
+
+    The database is only opened on the first add/delete, as the indexer is
+    handed over to the process that accumulates the import results.
+    """
+
+    BATCH_SIZE = 2000
+    schema: str
+    columns: list[str]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.items = []
+
+    def row(self, item: dict) -> tuple:
+        """values of the columns of <item>"""
+        raise NotImplementedError
+
+    def connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.executescript(self.schema)
+        return self.conn
+
+    def add(self, items):
+        self.items.extend(items)
+        if len(self.items) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        # like Meilisearch, the last document with a given id wins
+        rows = {
+            item["id"]: (
+                item["id"],
+                *self.row(item),
+                json.dumps(displayed_item(item)),
+            )
+            for item in self.items
+        }
+        columns = ", ".join(self.columns)
+        params = ", ".join("?" * (len(self.columns) + 2))
+        conn = self.connection()
+        with conn:
+            # documents being re-imported replace their previous version
+            self._delete(conn, rows.keys())
+            conn.executemany(
+                f"INSERT INTO docs (id, {columns}, item) VALUES ({params})",
+                rows.values(),
+            )
+            conn.executemany(
+                f"INSERT INTO docs_fts (rowid, {columns})"
+                f" SELECT rowid, {columns} FROM docs WHERE id = ?",
+                [(def_id,) for def_id in rows],
+            )
+        self.items = []
+
+    def delete(self, ids):
+        if not ids:
+            return
+        self.flush()
+        conn = self.connection()
+        with conn:
+            self._delete(conn, ids)
+
+    def checkpoint(self):
+        # committed documents are durable
+        self.flush()
+        return None
+
+    def resumable(self, states) -> bool:
+        return True
+
+    def resume(self, states):
+        pass
+
+    def _delete(self, conn, ids):
+        columns = ", ".join(self.columns)
+        params = [(def_id,) for def_id in ids]
+        conn.executemany(
+            f"INSERT INTO docs_fts (docs_fts, rowid, {columns})"
+            f" SELECT 'delete', rowid, {columns} FROM docs WHERE id = ?",
+            params,
+        )
+        conn.executemany("DELETE FROM docs WHERE id = ?", params)
+
+    def finish(self):
+        self.flush()
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT INTO docs_fts (docs_fts) VALUES ('optimize')")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        self.conn = None
+
+
+class SqliteIndexer(FtsIndexer):
+    """FtsIndexer of the search backend. Attributes that aren't
+    <searchable> are left empty."""
+
+    schema = SQLITE_SCHEMA
+    columns = SEARCHABLE_ATTRIBUTES
+
+    def __init__(self, path: str, searchable=SEARCHABLE_ATTRIBUTES):
+        super().__init__(path)
+        self.searchable = searchable
+
+    def row(self, item: dict) -> tuple:
+        return tuple(
+            item[k] if k in self.searchable else "" for k in self.columns
+        )
+
+
+# tokens as split by the unicode61 tokenizer
+TOKEN_RE = re.compile(r"[^\W_]+")
+# bm25 weights of the columns of docs_fts, in the spirit of Meilisearch's
+# "attribute" ranking rule
+COLUMN_WEIGHTS = "10.0, 5.0, 2.0, 1.0"
+
+
+def fts_query(query: str) -> typing.Optional[str]:
+    """FTS5 query matching documents containing all the words of <query>,
+    the last one possibly incomplete (it's being typed)."""
+    tokens = TOKEN_RE.findall(query)
+    if not tokens:
+        return None
+    phrases = ['"' + token.replace('"', '""') + '"' for token in tokens]
+    return " ".join(phrases) + "*"
+
+
+def like_prefix(query: str) -> str:
+    escaped = re.sub(r"([\\%_])", r"\\\1", query)
+    return escaped + "%"
+
+
+class FtsSearcher:
+    """Searches the FtsIndexer indexes of the dictionaries in
+    <import_base_dir>, with a read-only connection per dictionary and
+    thread.
+
+    Subclasses give the path of the index of a dictionary (index_path),
+    and the bm25 weights of the columns of docs_fts (column_weights).
+    """
+
+    column_weights: str
+
+    def __init__(self, import_base_dir: str):
+        self.import_base_dir = import_base_dir
+        self.local = threading.local()
+
+    @staticmethod
+    def index_path(dest_dir: str) -> str:
+        raise NotImplementedError
+
+    def connection(self, dict_id: str) -> typing.Optional[sqlite3.Connection]:
+        conns = self.local.__dict__.setdefault("conns", {})
+        if dict_id not in conns:
+            path = self.index_path(f"{self.import_base_dir}/{dict_id}")
+            if not os.path.exists(path):
+                return None
+            conns[dict_id] = sqlite3.connect(
+                f"file:{quote(path)}?mode=ro", uri=True
+            )
+        return conns[dict_id]
+
+    def ranked_matches(self, conn, match: str, limit: int) -> sqlite3.Cursor:
+        """(id, item) of the <limit> best documents matching <match>,
+        ranked by bm25 among all the matches.
+
+        Ranking only the first matches would rank the documents first in
+        rowid order, that is, the headwords first in alphabetical order.
+        """
+        return conn.execute(
+            "SELECT docs.id, docs.item FROM ("
+            f"  SELECT rowid, bm25(docs_fts, {self.column_weights}) AS score"
+            "   FROM docs_fts WHERE docs_fts MATCH ?"
+            "   ORDER BY score LIMIT ?"
+            ") AS matches JOIN docs ON docs.rowid = matches.rowid"
+            " ORDER BY matches.score",
+            (match, limit),
+        )
+
+
+class SqliteSearcher(FtsSearcher):
+    """Searches the SQLite indexes of the search backend.
+
+    Ranking, in tiers:
+      1. headwords starting with the query (case-insensitively), in
+         alphabetical order, so that an exact match comes first,
+      2. headwords and forms containing all the words of the query,
+      3. any definition containing all the words of the query,
+    tiers 2 and 3 being ranked by bm25 among all their matches.
+    """
+
+    column_weights = COLUMN_WEIGHTS
+    index_path = staticmethod(sqlite_index_path)
+
+    def search(self, dict_id: str, query: str, limit: int) -> list:
+        query = query.strip()
+        conn = self.connection(dict_id)
+        if conn is None or not query:
+            return []
+
+        hits = dict(
+            conn.execute(
+                "SELECT id, item FROM docs"
+                " WHERE title LIKE ? ESCAPE '\\'"
+                " ORDER BY title, rowid LIMIT ?",
+                (like_prefix(query), limit),
+            )
+        )
+
+        match = fts_query(query)
+        for tier in [f"{{title forms}} : ({match})", match]:
+            if len(hits) >= limit or match is None:
+                break
+            for def_id, item in self.ranked_matches(conn, tier, limit):
+                hits.setdefault(def_id, item)
+
+        return [json.loads(item) for item in list(hits.values())[:limit]]
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import fcntl
+import http.client
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+import typing
+from urllib.parse import quote
+
+# a few short queries touching most of an index, so that its pages are
+# read back in from disk before the first real search
+WARM_UP_QUERIES = ["a", "e", "s", "the", "of"]
+
+
+def process_start_time(pid: int) -> typing.Optional[str]:
+    """when process <pid> started, as told by ps, None if there is no such
+    process"""
+    result = subprocess.run(
+        ["ps", "-o", "lstart=", "-p", str(pid)],
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or None
+
+
+class SearchServer:
+    """Lifecycle of the alfred-dict-server (Meilisearch) process.
+
+    The server is started at most once, even by concurrent callers: the
+    starter holds <state_dir>/search-server.lock until the server is
+    ready, and records its pid in <state_dir>/search-server.pid, along
+    with when it started: after a reboot, the pid may well be another
+    process's.
+    Readiness is the server's own /health endpoint reporting
+    "available", rather than the process merely existing.
+
+    Processes relying on the server for a while (imports) hold it
+    `in_use`, which keeps `stop_if_unused` from stopping it under them.
+    """
+
+    def __init__(
+        self,
+        binary: str,
+        db_path: str,
+        ip: str,
+        port: str,
+        state_dir: str,
+    ):
+        self.binary = binary
+        self.db_path = db_path
+        self.ip = ip
+        self.port = int(port)
+        self.pid_path = f"{state_dir}/search-server.pid"
+        self.lock_path = f"{state_dir}/search-server.lock"
+        self.users_path = f"{state_dir}/search-server.users"
+        # the server, if started by this process (to reap it once stopped)
+        self.proc = None
+        self.starting = threading.Lock()
+
+    def request(self, method: str, path: str, body=None, timeout=5) -> dict:
+        conn = http.client.HTTPConnection(self.ip, self.port, timeout=timeout)
+        try:
+            headers = {"Content-Type": "application/json"}
+            payload = None if body is None else json.dumps(body)
+            conn.request(method, path, payload, headers)
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+    def is_ready(self) -> bool:
+        try:
+            health = self.request("GET", "/health", timeout=0.5)
+        except (OSError, http.client.HTTPException, ValueError):
+            return False
+        return health.get("status") == "available"
+
+    def pid(self) -> typing.Optional[int]:
+        """pid of the server, if it's running. A pid file of a server
+        that is gone is removed."""
+        try:
+            with open(self.pid_path) as f:
+                pid, started, _ = f.read().split("\n")
+            pid = int(pid)
+        except (OSError, ValueError):
+            # no pid file, or one being written
+            return None
+        if self.proc is not None and self.proc.pid == pid:
+            return pid if self.proc.poll() is None else None
+        if process_start_time(pid) != started:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.pid_path)
+            return None
+        return pid
+
+    def status(self) -> dict:
+        return {
+            "pid": self.pid(),
+            "ready": self.is_ready(),
+            "address": f"{self.ip}:{self.port}",
+            "db_path": self.db_path,
+        }
+
+    def start(self, timeout: float = 30) -> bool:
+        """Start the server unless it is already running, and wait until
+        it is ready. Returns whether it was started by this call."""
+        if self.is_ready():
+            return False
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # somebody else may have started it while we waited for the lock
+            started = self.pid() is None and not self.is_ready()
+            if started:
+                self.spawn()
+            self.wait_ready(timeout)
+        return started
+
+    def start_in_background(self, on_ready: typing.Callable[[], None]):
+        """start() in a thread, unless one is already starting the
+        server, then call <on_ready>"""
+        if not self.starting.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.start()
+                on_ready()
+            finally:
+                self.starting.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def spawn(self):
+        with open(f"{self.db_path}.log", "wb") as logfile:
+            cmd = [
+                self.binary,
+                "--db-path",
+                self.db_path,
+                "--http-addr",
+                f"{self.ip}:{self.port}",
+            ]
+            self.proc = subprocess.Popen(
+                cmd, stdout=logfile, stderr=logfile, start_new_session=True
+            )
+        started = process_start_time(self.proc.pid)
+        with open(self.pid_path, "w") as f:
+            f.write(f"{self.proc.pid}\n{started}\n")
+
+    def wait_ready(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while not self.is_ready():
+            if self.proc is not None and self.proc.poll() is not None:
+                raise RuntimeError(
+                    f"Search server exited with {self.proc.returncode}, "
+                    f"see {self.db_path}.log"
+                )
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    f"Search server not ready after {timeout} s, "
+                    f"see {self.db_path}.log"
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    def stop(self, timeout: float = 10) -> bool:
+        """Stop the server. Returns whether it was running."""
+        pid = self.pid()
+        if pid is None:
+            return False
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + timeout
+            while self.pid() is not None and time.monotonic() < deadline:
+                time.sleep(0.05)
+            if self.pid() is not None:
+                os.kill(pid, signal.SIGKILL)
+        if self.proc is not None:
+            self.proc.wait()
+            self.proc = None
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.pid_path)
+        return True
+
+    @contextlib.contextmanager
+    def in_use(self):
+        with open(self.users_path, "w") as users:
+            fcntl.flock(users, fcntl.LOCK_SH)
+            yield self
+
+    def stop_if_unused(self) -> bool:
+        """Stop the server unless some process holds it in_use.
+        Returns whether it was stopped."""
+        with open(self.users_path, "w") as users:
+            try:
+                fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return self.stop()
+
+    def warm_up(self, dict_ids: typing.Iterable[str], queries=WARM_UP_QUERIES):
+        """Search each of <dict_ids> for each of <queries>, to have the
+        indexes in memory before the first real search."""
+        for dict_id in dict_ids:
+            for query in queries:
+                try:
+                    self.request(
+                        "POST",
+                        f"/indexes/{quote(dict_id)}/search",
+                        {"q": query, "limit": 9},
+                    )
+                except (OSError, http.client.HTTPException, ValueError):
+                    return
+
+
+class IdleShutdown:
+    """Stops <server> once it hasn't been searched for <idle_seconds>,
+    freeing the memory of its indexes. It is started again, by whoever
+    needs it, on the next search."""
+
+    def __init__(self, server: SearchServer, idle_seconds: float):
+        self.server = server
+        self.idle_seconds = idle_seconds
+        self.last_used = time.monotonic()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def run(self):
+        while True:
+            idle = time.monotonic() - self.last_used
+            if idle >= self.idle_seconds:
+                self.server.stop_if_unused()
+                self.touch()
+            time.sleep(max(1.0, self.idle_seconds - idle))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import re
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import click
+
+INDEX_PATH_RE = re.compile(r"^/indexes/([^/]+)(/.*)?$")
+
+
+def now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S.%fZ"
+    )
+
+
+class Index:
+    def __init__(self, uid: str, primary_key: typing.Optional[str]):
+        self.uid = uid
+        self.primary_key = primary_key
+        self.created_at = now()
+        self.documents = {}
+        self.settings = {}
+
+    def info(self) -> dict:
+        return {
+            "uid": self.uid,
+            "primaryKey": self.primary_key,
+            "createdAt": self.created_at,
+            "updatedAt": self.created_at,
+        }
+
+    def search(self, query: str, limit: int) -> list[dict]:
+        """documents containing <query> in a searchable attribute, those
+        whose title is, or starts with, <query> first"""
+        query = query.casefold()
+        attributes = self.settings.get("searchable-attributes", ["*"])
+        displayed = self.settings.get("displayed-attributes", ["*"])
+        ranked = []
+        for doc in self.documents.values():
+            title = str(doc.get("title", "")).casefold()
+            if title == query:
+                rank = 0
+            elif title.startswith(query):
+                rank = 1
+            elif any(
+                query in str(value).casefold()
+                for key, value in doc.items()
+                if attributes == ["*"] or key in attributes
+            ):
+                rank = 2
+            else:
+                continue
+            ranked.append((rank, len(ranked), doc))
+        ranked.sort(key=lambda r: r[:2])
+        return [
+            {
+                k: v
+                for k, v in doc.items()
+                if displayed == ["*"] or k in displayed
+            }
+            for _, _, doc in ranked[:limit]
+        ]
+
+    def size(self) -> int:
+        return len(json.dumps(list(self.documents.values())))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """In-memory stand-in for the alfred-dict-server (Meilisearch),
+    implementing just what the workflow uses of its HTTP API: creating,
+    configuring and deleting indexes, adding and deleting documents,
+    searching, tasks, stats and health.
+
+    Tasks are processed as they are enqueued, so they are always reported
+    as succeeded. Nothing is persisted. Searching is a plain scan of the
+    documents, with none of Meilisearch's ranking: the stand-in is meant
+    for benchmarking imports, and for trying the workflow out, on machines
+    without the real server.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, ip: str, port: int):
+        self.indexes = {}
+        self.tasks = []
+        # requests are handled one at a time
+        self.lock = threading.RLock()
+        super().__init__((ip, port), StandInHandler)
+
+    def enqueue(self, task_type: str, index_uid: typing.Optional[str]) -> dict:
+        with self.lock:
+            task = {
+                "uid": len(self.tasks),
+                "indexUid": index_uid,
+                "status": "succeeded",
+                "type": task_type,
+                "enqueuedAt": now(),
+                "startedAt": now(),
+                "finishedAt": now(),
+                "error": None,
+            }
+            self.tasks.append(task)
+        return {
+            "taskUid": task["uid"],
+            "indexUid": index_uid,
+            "status": "enqueued",
+            "type": task_type,
+            "enqueuedAt": task["enqueuedAt"],
+        }
+
+    def stats(self) -> dict:
+        sizes = {uid: index.size() for uid, index in self.indexes.items()}
+        return {
+            "databaseSize": sum(sizes.values()),
+            "lastUpdate": now(),
+            "indexes": {
+                uid: {
+                    "numberOfDocuments": len(index.documents),
+                    "isIndexing": False,
+                    "fieldDistribution": {},
+                }
+                for uid, index in self.indexes.items()
+            },
+        }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status: int, body: typing.Any):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def not_found(self, what: str):
+        self.reply(
+            404,
+            {
+                "message": f"{what} not found.",
+                "code": "not_found",
+                "type": "invalid_request",
+                "link": "",
+            },
+        )
+
+    def body(self) -> typing.Any:
+        size = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(size)) if size else None
+
+    def handle_request(self, method: str):
+        body = self.body()
+        with self.server.lock:
+            self.route(method, body)
+
+    def route(self, method: str, body: typing.Any):
+        server = self.server
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+
+        if path == "/health":
+            return self.reply(200, {"status": "available"})
+        if path == "/stats":
+            return self.reply(200, server.stats())
+        if path.startswith("/tasks/"):
+            uid = int(path.split("/")[2])
+            if uid >= len(server.tasks):
+                return self.not_found(f"Task `{uid}`")
+            return self.reply(200, server.tasks[uid])
+        if path == "/indexes" and method == "POST":
+            uid = body["uid"]
+            server.indexes.setdefault(uid, Index(uid, body.get("primaryKey")))
+            return self.reply(202, server.enqueue("indexCreation", uid))
+
+        match = INDEX_PATH_RE.match(path)
+        if match is None:
+            return self.not_found(f"`{path}`")
+        uid, rest = unquote(match.group(1)), match.group(2) or ""
+        index = server.indexes.get(uid)
+
+        if rest == "/documents" and method in ("POST", "PUT"):
+            if index is None:
+                index = server.indexes[uid] = Index(uid, None)
+            primary_key = index.primary_key or "id"
+            for param in url.query.split("&"):
+                if param.startswith("primaryKey="):
+                    primary_key = index.primary_key = param.split("=", 1)[1]
+            for doc in body:
+                index.documents[str(doc[primary_key])] = doc
+            return self.reply(
+                202, server.enqueue("documentAdditionOrUpdate", uid)
+            )
+        if index is None:
+            return self.not_found(f"Index `{uid}`")
+        if rest == "" and method == "GET":
+            return self.reply(200, index.info())
+        if rest == "" and method == "DELETE":
+            del server.indexes[uid]
+            return self.reply(202, server.enqueue("indexDeletion", uid))
+        if rest == "/documents/delete-batch":
+            for doc_id in body:
+                index.documents.pop(str(doc_id), None)
+            return self.reply(202, server.enqueue("documentDeletion", uid))
+        if rest.startswith("/settings/"):
+            index.settings[rest.split("/")[2]] = body
+            return self.reply(202, server.enqueue("settingsUpdate", uid))
+        if rest == "/search":
+            limit = body.get("limit", 20)
+            hits = index.search(body.get("q") or "", limit)
+            return self.reply(
+                200,
+                {
+                    "hits": hits,
+                    "query": body.get("q"),
+                    "limit": limit,
+                    "offset": 0,
+                    "estimatedTotalHits": len(hits),
+                    "processingTimeMs": 0,
+                },
+            )
+        return self.not_found(f"`{path}`")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_in_background(ip: str = "127.0.0.1", port: int = 0) -> StandInServer:
+    """start a StandInServer in a thread, on a free port by default (see
+    server_address)"""
+    server = StandInServer(ip, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option("--db-path", help="Ignored, nothing is persisted.")
+@click.option("--http-addr", default="127.0.0.1:7700", show_default=True)
+def main(db_path: str, http_addr: str):
+    """Serve the stand-in on HTTP_ADDR.
+
+    Takes the same arguments as the alfred-dict-server.
+    """
+    ip, port = http_addr.rsplit(":", 1)
+    StandInServer(ip, int(port)).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
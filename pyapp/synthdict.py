@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import random
+import struct
+import typing
+import zlib
+
+# where the first section starts, see appledict.DictBody._section_headers
+LAYOUTS = {"0x60": 0x60, "0x44": 0x44}
+
+SYLLABLES = [
+    "ab", "ac", "al", "am", "an", "ar", "ba", "be", "bi", "bo", "ca", "ce",
+    "co", "da", "de", "di", "do", "el", "en", "er", "es", "fa", "fi", "fo",
+    "ga", "ge", "go", "ha", "he", "hi", "in", "is", "ja", "ka", "la", "le",
+    "li", "lo", "ma", "me", "mi", "mo", "na", "ne", "no", "or", "pa", "pe",
+    "pi", "po", "qu", "ra", "re", "ri", "ro", "sa", "se", "si", "so", "ta",
+    "te", "ti", "to", "un", "va", "ve", "vi", "wa", "we", "ya", "za", "zé",
+]  # fmt: skip
+IPA_SYMBOLS = "aæɑɒbdðeəɛfɡhiɪjklmnŋoɔprsʃtθuʊvwzʒˈˌː"
+PARTS_OF_SPEECH = ["noun", "verb", "adjective", "adverb", "preposition"]
+INFLECTIONS = {
+    "noun": ["{w}s"],
+    "verb": ["{w}s", "{w}ing", "{w}ed"],
+    "adjective": ["{w}er", "{w}est"],
+}
+
+
+class SyntheticEntry(typing.NamedTuple):
+    title: str
+    xml: str
+
+
+def make_word(rng: random.Random) -> str:
+    word = "".join(rng.choices(SYLLABLES, k=rng.choice([1, 2, 2, 3, 3, 4])))
+    if rng.random() < 0.05:
+        word = f"{word} {make_word(rng)}"
+    return word.capitalize() if rng.random() < 0.05 else word
+
+
+def make_sentence(rng: random.Random, words: int) -> str:
+    return " ".join(make_word(rng) for _ in range(words))
+
+
+def make_ipa(rng: random.Random) -> str:
+    return "".join(rng.choices(IPA_SYMBOLS, k=rng.randint(4, 10)))
+
+
+def entry_xml(entry_id: str, title: str, size: int, rng: random.Random) -> str:
+    """a definition of <title> marked up like those of the dictionaries
+    that come with macOS (headword, pronunciation, inflected forms, then
+    senses with examples), of about <size> bytes"""
+    part_of_speech = rng.choice(PARTS_OF_SPEECH)
+    parts = [
+        '<d:entry xmlns:d="http://www.apple.com/DTDs/DictionaryService-1.0.rng"'
+        f' id="{entry_id}" d:title="{title}" class="entry">',
+        '<span class="hg x_xh0">',
+        f'<span d:dhw="1" role="text" class="hw">{title}</span>',
+    ]
+    # most entries have a pronunciation, some with the alternate attribute
+    if rng.random() < 0.9:
+        prn = "IPA solitary" if rng.random() < 0.2 else "IPA"
+        ipas = ", ".join(make_ipa(rng) for _ in range(rng.randint(1, 2)))
+        parts.append(
+            f'<span class="prx"> | <span d:prn="{prn}" class="ph">{ipas}'
+            "</span> | </span>"
+        )
+    parts.append("</span>")
+    parts.append(
+        '<span class="sg"><span class="se1">'
+        f'<span class="posg"><span d:pos="1" class="pos">{part_of_speech}'
+        "</span></span>"
+    )
+    inflections = INFLECTIONS.get(part_of_speech)
+    if inflections and rng.random() < 0.6:
+        forms = " ".join(
+            f'<span class="inf">{form.format(w=title)}</span>'
+            for form in inflections
+        )
+        parts.append(f'<span class="infg"> ({forms})</span>')
+
+    body_size = sum(len(part) for part in parts)
+    sense = 1
+    while sense == 1 or body_size < size:
+        # the first sense is the definition proper
+        df_attrs = ' d:def="1"' if sense == 1 else ""
+        sense_parts = [
+            f'<span class="se2"><span class="sn">{sense}</span> ',
+            f'<span class="df"{df_attrs}>'
+            f"{make_sentence(rng, rng.randint(4, 16))}.</span>",
+        ]
+        if rng.random() < 0.7:
+            sense_parts.append(
+                '<span class="eg">: <span class="ex">'
+                f"{make_sentence(rng, rng.randint(3, 10))}</span></span>"
+            )
+        sense_parts.append("</span>")
+        parts.extend(sense_parts)
+        body_size += sum(len(part) for part in sense_parts)
+        sense += 1
+    parts.append("</span></span></d:entry>")
+    return "".join(parts)
+
+
+def entries(
+    count: int, definition_size: int = 1000, seed: int = 0
+) -> typing.Iterator[SyntheticEntry]:
+    """<count> synthetic entries, of <definition_size> bytes on average.
+
+    Like in real dictionaries, some titles have several entries
+    (homographs), and some entries are titled by a phrase.
+    """
+    rng = random.Random(seed)
+    previous_title = None
+    for i in range(count):
+        if previous_title is not None and rng.random() < 0.1:
+            title = previous_title
+        else:
+            title = make_word(rng)
+        size = rng.randint(definition_size // 2, definition_size * 3 // 2)
+        yield SyntheticEntry(title, entry_xml(f"syn{i:08d}", title, size, rng))
+        previous_title = title
+
+
+def section(definitions: list[bytes], single: bool = False) -> bytes:
+    """a Body.data section: either one bare definition, or length prefixed
+    definitions (see appledict.entry_spans)"""
+    if single:
+        assert len(definitions) == 1
+        decompressed = definitions[0]
+    else:
+        decompressed = b"".join(
+            struct.pack("<i", len(definition)) + definition
+            for definition in definitions
+        )
+    compressed = zlib.compress(decompressed)
+    # [section_size (not including itself), ??? (4 bytes),
+    #  decompressed_size, compressed_data]
+    return (
+        struct.pack("<iii", len(compressed) + 8, 0, len(decompressed))
+        + compressed
+    )
+
+
+def write_body(
+    path: str,
+    synthetic_entries: typing.Iterable[SyntheticEntry],
+    entries_per_section: int = 100,
+    layout: str = "0x60",
+    single_entry_every: int = 0,
+) -> int:
+    """Write <synthetic_entries> to a Body.data file at <path>, in one of
+    the two LAYOUTS of the header.
+
+    Every <single_entry_every>th section (never, if 0) holds a single,
+    unprefixed, definition. Returns the number of sections written.
+    """
+    with open(path, "wb") as f:
+        f.write(bytes(0x40))
+        f.write(struct.pack("<i", 0))  # remaining size, patched below
+        if LAYOUTS[layout] == 0x60:
+            # recognized by the (0, -1) right after the remaining size
+            f.write(struct.pack("<ii", 0, -1))
+            f.write(bytes(0x60 - f.tell()))
+
+        sections = 0
+        pending = []
+        for entry in synthetic_entries:
+            definition = entry.xml.encode("utf-8")
+            if single_entry_every and (sections + 1) % single_entry_every == 0:
+                f.write(section([definition], single=True))
+                sections += 1
+                continue
+            pending.append(definition)
+            if len(pending) >= entries_per_section:
+                f.write(section(pending))
+                sections += 1
+                pending = []
+        if pending:
+            f.write(section(pending))
+            sections += 1
+
+        end = f.tell()
+        f.seek(0x40)
+        f.write(struct.pack("<i", end - 0x40))
+    return sections
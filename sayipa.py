@@ -1,20 +1,39 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
+import os
 import pathlib
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
+import typing
 from urllib import request
 
-import boto3
-
 
 REGION = "us-west-2"
 POOL_ID = "us-west-2:42521701-f77a-4555-8b1c-e160ad0210da"
 REFERER = "https://ipa-reader.com/"
+# Alfred gives each workflow a cache folder
+DEFAULT_CACHE_DIR = (
+    pathlib.Path(os.environ["alfred_workflow_cache"]) / "ipa-audio"
+    if "alfred_workflow_cache" in os.environ
+    else pathlib.Path.home() / "Library/Caches/sayipa"
+)
+DEFAULT_CACHE_MAX_MB = 50
+# downloads left behind by a process that died, older than this, are removed
+STALE_PART_S = 3600
+# exit status of --cached-only when the audio has to be fetched (see sayipa.sh)
+EXIT_NOT_CACHED = 3
 
 
 def build_signed_url(ipa_text: str, voice_id: str) -> str:
+    # only needed on a cache miss, and slow to import
+    import boto3
+
     cog = boto3.client("cognito-identity", region_name=REGION)
     identity_id = cog.get_id(IdentityPoolId=POOL_ID)["IdentityId"]
     creds = cog.get_credentials_for_identity(IdentityId=identity_id)["Credentials"]
@@ -42,11 +61,99 @@ def build_signed_url(ipa_text: str, voice_id: str) -> str:
     )
 
 
-def download_audio(url: str, output_path: pathlib.Path) -> None:
+def download_audio(url: str) -> bytes:
     req = request.Request(url, headers={"Referer": REFERER})
     with request.urlopen(req) as resp:
-        data = resp.read()
-    output_path.write_bytes(data)
+        return resp.read()
+
+
+class Fetcher(typing.Protocol):
+    def fetch(self, ipa_text: str, voice_id: str) -> bytes:
+        """MP3 of <ipa_text> read by <voice_id>"""
+        ...
+
+
+class PollyFetcher:
+    """IPA Reader's Polly flow: Cognito credentials, a presigned URL, and
+    a download."""
+
+    def fetch(self, ipa_text: str, voice_id: str) -> bytes:
+        return download_audio(build_signed_url(ipa_text, voice_id))
+
+
+class AudioCache:
+    """MP3s fetched with <fetcher>, kept in <cache_dir>, named after a hash
+    of (IPA text, voice).
+
+    A file is written under a name of its own, then renamed into place,
+    so that concurrent fetches of the same audio don't clobber each other.
+    A file's mtime is its last use: once the cache holds more than
+    <max_bytes>, the least recently used files are removed.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path, max_bytes: int, fetcher: Fetcher):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher
+
+    def path(self, ipa_text: str, voice_id: str) -> pathlib.Path:
+        key = json.dumps([voice_id, ipa_text], ensure_ascii=False)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{digest}.mp3"
+
+    def cached(self, ipa_text: str, voice_id: str) -> typing.Optional[pathlib.Path]:
+        """path of the MP3 if it is cached (marking it as used), else None"""
+        path = self.path(ipa_text, voice_id)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def get(self, ipa_text: str, voice_id: str) -> pathlib.Path:
+        """path of the MP3, fetched only if it isn't cached yet"""
+        path = self.cached(ipa_text, voice_id)
+        if path:
+            return path
+
+        path = self.path(ipa_text, voice_id)
+        data = self.fetcher.fetch(ipa_text, voice_id)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, part_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(part_path, path)
+        except BaseException:
+            os.unlink(part_path)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: pathlib.Path) -> None:
+        """remove the least recently used files (but <keep>) until the
+        cache fits in max_bytes"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # evicted by a concurrent process
+                continue
+            if entry.name.endswith(".part"):
+                if now - stat.st_mtime > STALE_PART_S:
+                    pathlib.Path(entry.path).unlink(missing_ok=True)
+            elif entry.name.endswith(".mp3"):
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path != str(keep):
+                pathlib.Path(path).unlink(missing_ok=True)
+                total -= size
 
 
 def play_audio(output_path: pathlib.Path) -> None:
@@ -59,22 +166,46 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument("ipa", help="IPA text, e.g. [həˈloʊ]")
     parser.add_argument("--voice", default="Salli", help="Polly voice id")
-    parser.add_argument("--out", default="/tmp/ipa.mp3", help="Output MP3 path")
+    parser.add_argument("--out", help="Also copy the MP3 to this path")
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=DEFAULT_CACHE_DIR,
+        help="Where fetched MP3s are kept",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help="Least recently used MP3s are removed past this size",
+    )
     parser.add_argument(
         "--no-play", action="store_true", help="Generate MP3 without playing it"
     )
+    parser.add_argument(
+        "--cached-only",
+        action="store_true",
+        help=f"Exit with {EXIT_NOT_CACHED} instead of fetching an MP3 that "
+        "isn't cached (doesn't need boto3)",
+    )
     return parser.parse_args()
 
 
 def main() -> int:
     args = parse_args()
-    out_path = pathlib.Path(args.out)
+    cache = AudioCache(args.cache_dir, args.cache_max_mb << 20, PollyFetcher())
 
     try:
-        url = build_signed_url(args.ipa, args.voice)
-        download_audio(url, out_path)
+        if args.cached_only:
+            audio_path = cache.cached(args.ipa, args.voice)
+            if not audio_path:
+                return EXIT_NOT_CACHED
+        else:
+            audio_path = cache.get(args.ipa, args.voice)
+        if args.out:
+            shutil.copyfile(audio_path, args.out)
         if not args.no_play:
-            play_audio(out_path)
+            play_audio(audio_path)
     except Exception as exc:
         print(f"sayipa error: {exc}", file=sys.stderr)
         return 1
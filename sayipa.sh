@@ -3,4 +3,17 @@
 set -euo pipefail
 
 SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+PYTHON="${alfred_workflow_data:-}/.venv/bin/python"
+
+# Playing cached audio doesn't need boto3: try the cache with the
+# workflow's own python first, and only pay for `uv run --with boto3` on a
+# miss (3 is EXIT_NOT_CACHED in sayipa.py).
+if [ -x "$PYTHON" ]; then
+  status=0
+  "$PYTHON" "$SCRIPT_DIR/sayipa.py" --cached-only "$@" || status=$?
+  if [ "$status" -ne 3 ]; then
+    exit "$status"
+  fi
+fi
+
 exec "$SCRIPT_DIR/uv" run --with boto3 "$SCRIPT_DIR/sayipa.py" "$@"
@@ -2,29 +2,52 @@
 
 query="$1"
 dict_id="$2"
-PORT=6789
-IP=127.0.0.1
+# the same as QUERY_SOCKET in pyapp/BetterDict.py
+SOCKET="/tmp/$alfred_workflow_bundleid-$UID.sock"
 
-function is_server_up() {
-  pgrep alfred-dict-server > /dev/null
+# Fast path: the query daemon (pyapp/querydaemon.py) answers with the
+# complete Alfred JSON. nc fails if the daemon isn't running (e.g. a stale
+# socket after a reboot), in which case we fall through to the slow path.
+if [ -S "$SOCKET" ] &&
+   printf '%s\t%s\n' "$dict_id" "${query//$'\t'/ }" \
+     | nc -U "$SOCKET" 2> /dev/null; then
+  exit 0
+fi
+
+PYTHON="$alfred_workflow_data/.venv/bin/python"
+
+# Slow path: start whatever isn't running. The query daemon starts (and
+# warms up) the search server, and Alfred reruns the script filter, which
+# then takes the fast path.
+
+# serves definitions of dictionaries imported into packs (see defstore.py)
+function is_defs_server_up() {
+  pgrep -f "BetterDict.py serve-definitions" > /dev/null
+}
+
+function start_defs_server() {
+  "$PYTHON" pyapp/BetterDict.py serve-definitions "$alfred_workflow_data" \
+    > "$alfred_workflow_data/defs.log" 2>&1 &
+}
+
+function is_query_daemon_up() {
+  pgrep -f "BetterDict.py serve-queries" > /dev/null
 }
 
-function start_server() {
-  mkdir -p "$alfred_workflow_data"
-  ./alfred-dict-server \
-     --db-path "$alfred_workflow_data/db" \
-     --http-payload-size-limit 1000000000 \
-     --http-addr "$IP:$PORT" > "$alfred_workflow_data/db.log" 2>&1 & 
+function start_query_daemon() {
+  "$PYTHON" pyapp/BetterDict.py serve-queries "$alfred_workflow_data" \
+    > "$alfred_workflow_data/queries.log" 2>&1 &
 }
 
-if ! is_server_up; then
-  start_server
+mkdir -p "$alfred_workflow_data"
+
+if ! is_defs_server_up; then
+  start_defs_server
 fi
 
-search_endpoint="http://$IP:$PORT/indexes/$dict_id/search"
-items=$(curl "$search_endpoint" \
-        -H 'Content-Type: application/json' \
-        --data "{ \"q\": \"$query\", \"limit\": 9 }" \
-        | ./jq '.hits')
+if ! is_query_daemon_up; then
+  open -g ./AlfredExtraPane.app
+  start_query_daemon
+fi
 
-echo "{ \"items\": $items }"
+echo '{ "items": [{ "title": "Starting the search server...", "valid": false }], "rerun": 0.5 }'
@@ -60,3 +60,5 @@ open ./AlfredExtraPane.app
 
 # Kill instances running from previous version of workflow
 killall -q alfred-dict-server || true
+pkill -f "BetterDict.py serve-definitions" || true
+pkill -f "BetterDict.py serve-queries" || true